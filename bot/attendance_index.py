@@ -0,0 +1,187 @@
+# attendance_index.py
+import bisect
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from .entry_times import stamp
+from .participant import Participant
+
+logger = logging.getLogger(__name__)
+
+
+def _poll_key(entry: Dict[str, Any]) -> Optional[tuple]:
+    try:
+        return int(entry["chat_id"]), int(entry["message_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _poll_info(entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Запись истории -> сведения об опросе для индекса; None — опрос без даты не учитывается."""
+    ts, day = stamp(entry)
+    key = _poll_key(entry)
+    if ts is None or key is None:
+        return None
+    return {
+        "key": key,
+        "expires_ts": ts,
+        "expires_at": entry["expires_at"],
+        "date": day,
+        "command": entry.get("command") or "",
+    }
+
+
+class AttendanceIndex:
+    """
+    Индекс посещаемости: uid -> список (expires_ts, command, key) опросов, где он отмечен,
+    отсортированный по времени. Строится один раз по всей истории (build) — в пуле задач по снимку:
+    start() -> пустой индекс, его build(entries) в фоне, adopt() в цикле бота доигрывает изменения,
+    пришедшие за время сборки. Дальше индекс обновляется по одному опросу (refresh): голос, закрытие
+    опроса, правка участников админом — строки меняются только у тех, кто пришёл или ушёл.
+    Выборка по пользователю стоит O(его посещений), а не O(всех участий).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Забывает индекс (после перезагрузки истории); сборка, начатая до этого, не примется."""
+        self.built = False
+        self.by_uid: Dict[int, List[tuple]] = {}
+        # key -> сведения об опросе (_poll_info) и участники uid -> Participant
+        self.polls: Dict[tuple, Dict[str, Any]] = {}
+        self.members: Dict[tuple, Dict[int, Participant]] = {}
+        # опросы, изменённые пока индекс собирается (start ... adopt)
+        self._pending: Optional[Dict[tuple, Dict[str, Any]]] = None
+
+    def __len__(self):
+        return sum(map(len, self.by_uid.values()))
+
+    # -----------------------------
+    # СБОРКА
+    # -----------------------------
+    def start(self) -> "AttendanceIndex":
+        """Начало сборки в фоновой задаче: -> пустой индекс для build(); изменения до adopt() запоминаются."""
+        if self._pending is None:
+            self._pending = {}
+        return AttendanceIndex()
+
+    def build(self, entries: Iterable[Dict[str, Any]]):
+        """Полная сборка; при повторе ключа (запись и в памяти, и в архиве) выигрывает первая."""
+        self.by_uid.clear()
+        self.polls.clear()
+        self.members.clear()
+        rows: Dict[int, List[tuple]] = {}
+        for entry in entries:
+            info = _poll_info(entry)
+            if info is None or info["key"] in self.polls:
+                continue
+            self._add(info, entry, rows)
+        for uid, items in rows.items():
+            items.sort()
+            self.by_uid[uid] = items
+        self.built = True
+        logger.info("Built attendance index: %d polls, %d users", len(self.polls), len(self.by_uid))
+
+    def adopt(self, fresh: "AttendanceIndex"):
+        """Берёт индекс, собранный в фоне, и доигрывает опросы, изменённые за время сборки."""
+        if self._pending is None:
+            # индекс сброшен (reset) после start() — сборка по старой истории не нужна
+            return
+        pending, self._pending = self._pending, None
+        self.by_uid, self.polls, self.members = fresh.by_uid, fresh.polls, fresh.members
+        self.built = True
+        for entry in pending.values():
+            self.refresh(entry)
+
+    def _add(self, info: Dict[str, Any], entry: Dict[str, Any], rows: Dict[int, List[tuple]]):
+        key = info["key"]
+        members = {}
+        for p in entry.get("participants", []):
+            if not p.uid or p.uid in members:
+                continue
+            members[p.uid] = p
+            rows.setdefault(p.uid, []).append((info["expires_ts"], info["command"], key))
+        self.polls[key] = info
+        self.members[key] = members
+
+    def _insert(self, uid: int, row: tuple):
+        bisect.insort(self.by_uid.setdefault(uid, []), row)
+
+    def _delete(self, uid: int, row: tuple):
+        items = self.by_uid.get(uid)
+        if not items:
+            return
+        i = bisect.bisect_left(items, row)
+        if i < len(items) and items[i] == row:
+            del items[i]
+        if not items:
+            del self.by_uid[uid]
+
+    def remove(self, key: tuple):
+        info = self.polls.pop(key, None)
+        if info is None:
+            return
+        row = (info["expires_ts"], info["command"], key)
+        for uid in self.members.pop(key, {}):
+            self._delete(uid, row)
+
+    def refresh(self, entry: Dict[str, Any]):
+        """Пересчитывает строки одного опроса после его изменения."""
+        key = _poll_key(entry)
+        if key is None:
+            return
+        if not self.built:
+            if self._pending is not None:
+                self._pending[key] = entry
+            return
+        info = _poll_info(entry)
+        old = self.polls.get(key)
+        if info is None or old is None or (old["expires_ts"], old["command"]) != (info["expires_ts"], info["command"]):
+            # новый опрос или сменились время/тип — строки всех участников другие
+            self.remove(key)
+            if info is not None:
+                rows: Dict[int, List[tuple]] = {}
+                self._add(info, entry, rows)
+                for uid, items in rows.items():
+                    for row in items:
+                        self._insert(uid, row)
+            return
+        # голос или правка участников: строки у тех, кто пришёл или ушёл
+        row = (info["expires_ts"], info["command"], key)
+        members = {}
+        for p in entry.get("participants", []):
+            if p.uid and p.uid not in members:
+                members[p.uid] = p
+        before = self.members[key]
+        for uid in before.keys() - members.keys():
+            self._delete(uid, row)
+        for uid in members.keys() - before.keys():
+            self._insert(uid, row)
+        self.polls[key] = info
+        self.members[key] = members
+
+    # -----------------------------
+    # ЗАПРОСЫ
+    # -----------------------------
+    def rows(self, uid: int) -> List[tuple]:
+        """(expires_ts, command, key) опросов пользователя по возрастанию времени."""
+        return self.by_uid.get(uid, [])
+
+    def participant(self, uid: int) -> Optional[Participant]:
+        """Данные пользователя из его последнего опроса (None — в индексе его нет)."""
+        items = self.by_uid.get(uid)
+        return self.members[items[-1][2]][uid] if items else None
+
+    def participations(self, uid: int) -> Iterator[Dict[str, Any]]:
+        """Строки участия одного пользователя в формате HistoryStore.participations, новейшие первыми."""
+        for _, command, key in reversed(self.rows(uid)):
+            p = self.members[key][uid]
+            yield {
+                "uid": uid,
+                "fullname": p.fullname,
+                "username": p.username,
+                "expires_at": self.polls[key]["expires_at"],
+                "date": self.polls[key]["date"],
+                "command": command,
+            }
@@ -0,0 +1,246 @@
+# attendance_matrix.py
+"""
+Статистика посещаемости на numpy: история опросов в виде колонок.
+
+    опросы    ts (epoch), day (порядковый номер локальной даты), kind (код типа, -1 — без типа),
+              counted (quorum или не меньше 4 участников)
+    участия   poll (номер опроса), pos (место в списке), user (номер участника), name (номер имени, -1 — пустое)
+
+Для окна и каждого вида зачёта строится матрица участники × дни тренировок (bool):
+суммы по строкам — число тренировок, плотные места — np.unique по суммам.
+Ответы те же, что у scan_attendance() / AttendanceSummary, включая имена и порядок участников.
+
+Включается STATS_BACKEND=numpy; колонки собираются заново после изменения закрытых опросов —
+в пуле задач по снимку истории (start/build/adopt), там же идут и запросы по готовым колонкам.
+"""
+import logging
+from datetime import date, datetime
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .attendance_stats import BREAKDOWN, AttendanceSummary
+from .entry_times import stamp
+from .history_view import freeze
+
+logger = logging.getLogger(__name__)
+
+
+def dense_places(totals: np.ndarray) -> np.ndarray:
+    """Плотные места по убыванию: [5, 3, 5, 1] -> [1, 2, 1, 3]."""
+    _, inverse = np.unique(-totals, return_inverse=True)
+    return inverse + 1
+
+
+class _Columns:
+    __slots__ = ("ts", "chat", "message", "day", "kind", "counted", "row_poll", "row_user", "row_name",
+                 "uids", "names", "kinds", "keys")
+
+
+class AttendanceMatrix:
+    """
+    Колонки закрытых опросов из source() (history, затем архив; повтор ключа — берётся первый)
+    и запросы по ним за любое окно. Изменённые после загрузки записи берутся из памяти,
+    а не из source(): в SQLite правка попадает только после фоновой записи.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[Dict[str, Any]]]):
+        self.source = source
+        self._columns: Optional[_Columns] = None
+        # изменённые записи: источник (база) может увидеть правку только после фоновой записи
+        self._changed: Dict[tuple, Dict[str, Any]] = {}
+        # растёт, когда колонки устаревают: собранные в фоне ставятся, только если за сборку ничего не изменилось
+        self.version = 0
+
+    @property
+    def built(self) -> bool:
+        return self._columns is not None
+
+    def invalidate(self):
+        self.version += 1
+        self._columns = None
+        self._changed.clear()
+
+    def refresh(self, entry: Dict[str, Any]):
+        """Колонки устарели, если изменился закрытый опрос (или опрос, который в них уже есть)."""
+        try:
+            key = (int(entry["chat_id"]), int(entry["message_id"]))
+        except (KeyError, TypeError, ValueError):
+            return
+        if not entry.get("active", False) or key in self._changed or (self._columns and key in self._columns.keys):
+            self._changed[key] = entry
+            self.version += 1
+            self._columns = None
+
+    # -----------------------------
+    # СБОРКА КОЛОНОК
+    # -----------------------------
+    def columns(self) -> _Columns:
+        if self._columns is None:
+            self._columns = self._build(self.source())
+        return self._columns
+
+    def start(self) -> "AttendanceMatrix":
+        """Копия для сборки колонок в фоновой задаче: изменённые записи в ней — замороженные виды."""
+        fresh = AttendanceMatrix(self.source)
+        fresh._changed = {key: freeze(entry) for key, entry in self._changed.items()}
+        fresh.version = self.version
+        return fresh
+
+    def build(self, entries: Iterable[Dict[str, Any]]):
+        self._columns = self._build(entries)
+
+    def adopt(self, fresh: "AttendanceMatrix"):
+        """Ставит колонки, собранные в фоне, если после start() опросы не менялись (иначе они уже устарели)."""
+        if fresh.version == self.version:
+            self._columns = fresh._columns
+
+    def _build(self, entries: Iterable[Dict[str, Any]]) -> _Columns:
+        ts, chat, message, day, kind, counted = [], [], [], [], [], []
+        row_poll, row_user, row_name = [], [], []
+        keys = set()
+        users: Dict[int, int] = {}
+        names: Dict[str, int] = {}
+        kinds: Dict[str, int] = {}
+        changed = dict(self._changed)
+        for entry in chain(entries, changed.values()):
+            try:
+                key = (int(entry["chat_id"]), int(entry["message_id"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if key in keys:
+                continue
+            keys.add(key)
+            # правка из памяти на место записи источника
+            entry = changed.get(key, entry)
+            expires_ts, training_date = stamp(entry)
+            if entry.get("active", False) or expires_ts is None:
+                continue
+            poll = len(ts)
+            participants = entry.get("participants", [])
+            command = entry.get("command", "")
+            ts.append(expires_ts)
+            chat.append(key[0])
+            message.append(key[1])
+            day.append(training_date.toordinal())
+            if isinstance(command, str) and command and command != "all":
+                kind.append(kinds.setdefault(command, len(kinds)))
+            else:
+                kind.append(-1)
+            counted.append(bool(entry.get("quorum", False)) or len(participants) >= 4)
+            for p in participants:
+                if not p.uid:
+                    continue
+                username = p.username or ""
+                name = f"@{username}" if username else (p.fullname or "")
+                row_poll.append(poll)
+                row_user.append(users.setdefault(p.uid, len(users)))
+                row_name.append(names.setdefault(name, len(names)) if name else -1)
+
+        c = _Columns()
+        c.ts = np.asarray(ts, dtype=np.float64)
+        c.chat = np.asarray(chat, dtype=np.int64)
+        c.message = np.asarray(message, dtype=np.int64)
+        c.day = np.asarray(day, dtype=np.int64)
+        c.kind = np.asarray(kind, dtype=np.int32)
+        c.counted = np.asarray(counted, dtype=bool)
+        c.row_poll = np.asarray(row_poll, dtype=np.int64)
+        c.row_user = np.asarray(row_user, dtype=np.int64)
+        c.row_name = np.asarray(row_name, dtype=np.int64)
+        c.uids = np.asarray(list(users), dtype=np.int64)
+        c.names = list(names)
+        c.kinds = kinds
+        c.keys = keys
+        logger.info("Built attendance matrix columns: %d polls, %d rows, %d users", len(ts), len(row_poll), len(users))
+        return c
+
+    # -----------------------------
+    # ЗАПРОСЫ
+    # -----------------------------
+    def _section(self, c: _Columns, polls: np.ndarray, rows: np.ndarray, r_user: np.ndarray,
+                 r_name: np.ndarray, r_day: np.ndarray, r_kind: np.ndarray, with_breakdown: bool):
+        """Один вид зачёта: строки участий уже в порядке обработки (от поздних опросов к ранним)."""
+        days = np.unique(c.day[polls])
+        if not len(days):
+            return None, None
+        ru, rn, rd, rk = r_user[rows], r_name[rows], r_day[rows], r_kind[rows]
+        uniq, first = np.unique(ru, return_index=True)
+        ui = np.searchsorted(uniq, ru)
+        di = np.searchsorted(days, rd)
+
+        # участники × дни тренировок
+        matrix = np.zeros((len(uniq), len(days)), dtype=bool)
+        matrix[ui, di] = True
+        totals = matrix.sum(axis=1)
+
+        # имя — последнее непустое в порядке обработки (то есть из самого старого опроса)
+        name_of = np.full(len(uniq), -1, dtype=np.int64)
+        named = rn >= 0
+        if named.any():
+            rev_u, rev_n = ui[named][::-1], rn[named][::-1]
+            last_u, idx = np.unique(rev_u, return_index=True)
+            name_of[last_u] = rev_n[idx]
+
+        breakdown = {}
+        if with_breakdown:
+            # тип дня — у первого в порядке обработки (последнего по времени) опроса этого дня
+            _, first_of_day = np.unique(ui * len(days) + di, return_index=True)
+            for command, field in BREAKDOWN.items():
+                code = c.kinds.get(command)
+                hit = ui[first_of_day][rk[first_of_day] == code] if code is not None else ui[:0]
+                breakdown[field] = np.bincount(hit, minlength=len(uniq))
+
+        appearance = np.argsort(first, kind="stable")
+        users = []
+        for i in appearance.tolist():
+            row = {"uid": int(c.uids[uniq[i]]), "name": c.names[name_of[i]] if name_of[i] >= 0 else "",
+                   "total": int(totals[i])}
+            for field, counts in breakdown.items():
+                row[field] = int(counts[i])
+            users.append(row)
+
+        places = dense_places(totals)
+        # как в AttendanceSummary: по месту, при равенстве — порядок первого появления
+        rank_of = np.empty(len(uniq), dtype=np.int64)
+        rank_of[appearance] = np.arange(len(uniq))
+        ranked = [{"place": int(places[i]), **users[rank_of[i]]}
+                  for i in np.lexsort((rank_of, places)).tolist()]
+        section = {"users": users, "days": len(days), "first_date": date.fromordinal(int(days[0]))}
+        return section, ranked
+
+    def query(self, since: datetime, until: datetime,
+              columns: Optional[_Columns] = None) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        """
+        -> (сводка в формате scan_attendance, участники каждого вида зачёта по местам).
+        columns — готовые колонки (запрос в пуле задач не должен собирать их из source()).
+        """
+        c = columns if columns is not None else self.columns()
+        polls = c.counted & (c.ts >= since.timestamp()) & (c.ts <= until.timestamp())
+        # порядок обработки опросов: от поздних к ранним, при равенстве — по убыванию (chat_id, message_id)
+        order = np.lexsort((-c.message, -c.chat, -c.ts))
+        rank = np.empty(len(c.ts), dtype=np.int64)
+        rank[order] = np.arange(len(c.ts))
+
+        in_window = np.flatnonzero(polls[c.row_poll])
+        # стабильная сортировка сохраняет порядок участников внутри опроса
+        in_window = in_window[np.argsort(rank[c.row_poll[in_window]], kind="stable")]
+        r_poll = c.row_poll[in_window]
+        r_user, r_name = c.row_user[in_window], c.row_name[in_window]
+        r_day, r_kind = c.day[r_poll], c.kind[r_poll]
+
+        report, ranked = {}, {}
+        everything = np.ones(len(r_poll), dtype=bool)
+        section, ranks = self._section(c, polls, everything, r_user, r_name, r_day, r_kind, with_breakdown=True)
+        if section is not None:
+            report["all"], ranked["all"] = section, ranks
+        for command, code in c.kinds.items():
+            section, ranks = self._section(c, polls & (c.kind == code), r_kind == code,
+                                           r_user, r_name, r_day, r_kind, with_breakdown=False)
+            if section is not None:
+                report[command], ranked[command] = section, ranks
+        return report, ranked
+
+    def summary(self, since: datetime, until: datetime, columns: Optional[_Columns] = None) -> AttendanceSummary:
+        report, ranked = self.query(since, until, columns)
+        return AttendanceSummary(report, ranked=ranked)
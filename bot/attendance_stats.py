@@ -0,0 +1,772 @@
+# attendance_stats.py
+"""
+Счётчики посещаемости для /top_sum, /top_saber, /top_rapier, /top_open и /my_stat.
+
+Правила подсчёта (как в прежнем полном проходе по истории в обработчиках команд):
+    - берутся закрытые опросы с expires_at в окне [until - days, until]
+      (наивное время считается местным, как и везде в хранилище);
+    - опрос засчитывается, если у него quorum или не меньше 4 участников;
+    - посещения считаются по дням (локальная дата, entry_times): несколько опросов
+      за день — одна тренировка (и в общем зачёте, и внутри каждого типа);
+    - имя участника — из самого старого опроса окна, где оно непустое;
+    - разбивка по типам в общем зачёте (/top_sum) берёт тип последнего (по expires_at) опроса дня.
+
+Сводка (report) — словарь по видам зачёта: "all" и имя команды ("saber", "rapier", ...):
+    {"users": [{"uid", "name", "total"[, "saber", "rapier", "open"]}, ...],
+     "days": число учтённых дней, "first_date": первый учтённый день}
+Пользователи идут в порядке первого появления при проходе от новых опросов к старым.
+
+scan_attendance() — эталонный полный проход; AttendanceAggregator держит те же числа
+инкрементально и обновляется по одному опросу (закрытие, правка админом).
+AttendanceSummary — итог для команд (места, счётчики по типам), кэшируется по версии счётчиков;
+итог AttendanceAggregator читает неизменяемый срез счётчиков этой версии (AttendanceState).
+AttendanceDays — те же правила по дням за всю историю: любое окно дат (/top_sum 365,
+/my_stat 2025-01-01..2025-06-30) без прохода по опросам окна.
+"""
+import bisect
+import logging
+import math
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .entry_times import stamp
+from .leaderboard import Leaderboard
+
+logger = logging.getLogger(__name__)
+
+# поле разбивки в общем зачёте для каждого типа тренировки
+BREAKDOWN = {"saber": "saber", "rapier": "rapier", "openfight": "open"}
+# «бесконечное» будущее для выборки досрочно закрытых опросов
+FAR_FUTURE = datetime(9999, 12, 31, tzinfo=timezone.utc)
+# ключ больше любого (chat_id, message_id) — для bisect по времени
+_MAX_KEY = (math.inf,)
+
+EMPTY_SECTION = {"users": [], "days": 0, "first_date": None}
+
+
+def _kinds(command) -> Tuple[str, ...]:
+    """Виды зачёта, в которые идёт опрос этого типа."""
+    if isinstance(command, str) and command and command != "all":
+        return "all", command
+    return ("all",)
+
+
+def section(report: Dict[str, Dict[str, Any]], kind: str) -> Dict[str, Any]:
+    return report.get(kind, EMPTY_SECTION)
+
+
+# -----------------------------
+#     ЭТАЛОННЫЙ ПОЛНЫЙ ПРОХОД
+# -----------------------------
+def scan_attendance(entries: Iterable[Dict[str, Any]], since: datetime, until: datetime) -> Dict[str, Dict[str, Any]]:
+    """Сводка за окно полным проходом по закрытым опросам, от поздних expires_at к ранним."""
+    stats: Dict[str, Dict[int, Dict[str, Any]]] = {}
+    day_attendance: Dict[str, Dict[date, set]] = {}
+    since_ts, until_ts = since.timestamp(), until.timestamp()
+    polls = []
+    for entry in entries:
+        if entry.get("active", False):
+            continue
+        ts, training_date = stamp(entry)
+        if ts is None or ts < since_ts or ts > until_ts:
+            continue
+        polls.append((ts, _poll_key(entry) or (), training_date, entry))
+    # день и имя решает время окончания; при равном — больший (chat_id, message_id), как в _summarize
+    polls.sort(key=lambda item: item[:2], reverse=True)
+
+    for _, _, training_date, entry in polls:
+        participants = entry.get("participants", [])
+        if not entry.get("quorum", False) and len(participants) < 4:
+            continue
+        command = entry.get("command", "")
+        for kind in _kinds(command):
+            days = day_attendance.setdefault(kind, {}).setdefault(training_date, set())
+            users = stats.setdefault(kind, {})
+            for p in participants:
+                uid = p.uid
+                if not uid:
+                    continue
+                username = p.username or ""
+                fullname = p.fullname or ""
+                name = f"@{username}" if username else fullname
+                if uid not in users:
+                    users[uid] = {"uid": uid, "name": name, "total": 0}
+                    if kind == "all":
+                        users[uid].update({field: 0 for field in BREAKDOWN.values()})
+                if name:
+                    users[uid]["name"] = name
+                if uid not in days:
+                    days.add(uid)
+                    users[uid]["total"] += 1
+                    if kind == "all" and command in BREAKDOWN:
+                        users[uid][BREAKDOWN[command]] += 1
+
+    return {
+        kind: {
+            "users": list(stats.get(kind, {}).values()),
+            "days": len(days),
+            "first_date": min(days, default=None),
+        }
+        for kind, days in day_attendance.items()
+    }
+
+
+def compare_reports(actual: Dict[str, Dict[str, Any]], expected: Dict[str, Dict[str, Any]]) -> List[str]:
+    """Расхождения двух сводок (порядок пользователей с равным числом тренировок не сравнивается)."""
+    problems = []
+    for kind in sorted(set(actual) | set(expected)):
+        a, e = section(actual, kind), section(expected, kind)
+        for field in ("days", "first_date"):
+            if a[field] != e[field]:
+                problems.append(f"{kind}.{field}: {a[field]!r} != {e[field]!r}")
+        a_users = {u["uid"]: u for u in a["users"]}
+        e_users = {u["uid"]: u for u in e["users"]}
+        for uid in sorted(set(a_users) | set(e_users)):
+            if a_users.get(uid) != e_users.get(uid):
+                problems.append(f"{kind}.users[{uid}]: {a_users.get(uid)!r} != {e_users.get(uid)!r}")
+    return problems
+
+
+# -----------------------------
+#     ИТОГ ДЛЯ КОМАНД
+# -----------------------------
+class AttendanceSummary:
+    """
+    Итог статистики за окно по всем видам зачёта и всем участникам сразу:
+    число тренировок, плотные места (dense ranking), учтённые дни, первый день.
+    /top_sum, /top_saber, /top_rapier, /top_open и /my_stat читают его, а не историю.
+    """
+
+    def __init__(self, report: Optional[Dict[str, Dict[str, Any]]], version: Optional[int] = None,
+                 ranked: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        """
+        ranked — уже расставленные по местам участники (attendance_matrix считает их сам);
+        report=None — сводку соберёт подкласс по запросу (_RankedSummary).
+        """
+        self._report = report
+        self.version = version
+        # сверка с полным проходом (STATS_VERIFY) — один раз на объект
+        self.verified = False
+        self._ranked: Dict[str, List[Dict[str, Any]]] = {}
+        self._places: Dict[str, Dict[int, int]] = {}
+        self._counts: Dict[str, Dict[int, int]] = {}
+        for kind, stats in (report or {}).items():
+            if ranked is not None and kind in ranked:
+                self._ranked[kind] = ranked[kind]
+            else:
+                self._ranked[kind] = self._rank(stats["users"])
+            self._places[kind] = {u["uid"]: u["place"] for u in self._ranked[kind]}
+            self._counts[kind] = {u["uid"]: u["total"] for u in self._ranked[kind]}
+
+    @property
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        return self._report
+
+    @staticmethod
+    def _rank(users: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # стабильная сортировка: при равенстве — порядок первого появления
+        ranked = []
+        place, last = 0, None
+        for u in sorted(users, key=lambda u: u["total"], reverse=True):
+            if u["total"] != last:
+                place += 1
+                last = u["total"]
+            ranked.append({"place": place, **u})
+        return ranked
+
+    def top(self, kind: str, top_n: int) -> List[Dict[str, Any]]:
+        """Участники с местом не ниже top_n (все, кто делит эти места), со своим "place"."""
+        return [u for u in self._ranked.get(kind, []) if u["place"] <= top_n]
+
+    def place(self, kind: str, uid: int) -> Optional[int]:
+        return self._places.get(kind, {}).get(uid)
+
+    def count(self, kind: str, uid: int) -> int:
+        return self._counts.get(kind, {}).get(uid, 0)
+
+    def total_users(self, kind: str) -> int:
+        return len(self._ranked.get(kind, []))
+
+    def days(self, kind: str) -> int:
+        return section(self.report, kind)["days"]
+
+    def first_date(self, kind: str) -> Optional[date]:
+        return section(self.report, kind)["first_date"]
+
+
+# -----------------------------
+#     ИНКРЕМЕНТАЛЬНЫЕ СЧЁТЧИКИ
+# -----------------------------
+class _Poll:
+    """Вклад одного засчитанного опроса: время, день, тип и участники (pos, uid, name)."""
+    __slots__ = ("key", "ts", "day", "command", "members")
+
+    def __init__(self, key, ts, day, command, members):
+        self.key = key
+        self.ts = ts
+        self.day = day
+        self.command = command
+        self.members = members
+
+
+def _poll_key(entry: Dict[str, Any]) -> Optional[tuple]:
+    try:
+        return int(entry["chat_id"]), int(entry["message_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _contribution(entry: Dict[str, Any]) -> Optional[_Poll]:
+    """Закрытый засчитанный опрос -> _Poll; остальное — None."""
+    if entry.get("active", False):
+        return None
+    key = _poll_key(entry)
+    ts, day = stamp(entry)
+    if key is None or ts is None:
+        return None
+    participants = entry.get("participants", [])
+    if not entry.get("quorum", False) and len(participants) < 4:
+        return None
+    members = []
+    for pos, p in enumerate(participants):
+        if not p.uid:
+            continue
+        username = p.username or ""
+        members.append((pos, p.uid, f"@{username}" if username else (p.fullname or "")))
+    return _Poll(key, ts, day, entry.get("command", ""), tuple(members))
+
+
+def _summarize(events: List[tuple]) -> tuple:
+    """
+    Сводка по посещениям одного участника в окне (события по возрастанию времени):
+    -> ({kind: {"total", "name", "order"}}, {поле разбивки: число дней}).
+    """
+    kinds: Dict[str, Dict[str, Any]] = {}
+    day_command = {}
+    for ts, key, pos, day, command, name in events:
+        # по возрастанию: в конце остаётся тип последнего опроса дня
+        day_command[day] = command
+        for kind in _kinds(command):
+            s = kinds.get(kind)
+            if s is None:
+                s = kinds[kind] = {"days": set(), "name": "", "order": None}
+            s["days"].add(day)
+            if name and not s["name"]:
+                s["name"] = name
+            s["order"] = (-ts, -key[0], -key[1], pos)
+    breakdown = {field: 0 for field in BREAKDOWN.values()}
+    for command in day_command.values():
+        if command in BREAKDOWN:
+            breakdown[BREAKDOWN[command]] += 1
+    summary = {kind: {"total": len(s["days"]), "name": s["name"], "order": s["order"]} for kind, s in kinds.items()}
+    return summary, breakdown
+
+
+class AttendanceAggregator:
+    """
+    Счётчики посещаемости за скользящее окно в days дней.
+
+    Держит вклад каждого засчитанного опроса окна (и досрочно закрытых, чей expires_at
+    ещё впереди), сводку по каждому участнику и число опросов по дням.
+    refresh(entry) — после закрытия опроса или правки закрытого опроса админом;
+    report(now) — сдвигает окно (выбывшие опросы вычитаются, наступившие добавляются)
+    и отдаёт сводку за O(участников). Если окно сдвинулось назад (AS_OF_DATE, другой days),
+    счётчики собираются заново из source(since, until) — обычно history_store.closed_polls.
+    """
+
+    def __init__(self, source: Callable[[datetime, datetime], Iterable[Dict[str, Any]]], days: int):
+        self.source = source
+        self.days = days
+        # растёт при любом изменении счётчиков: по ней кэшируется итог (summary)
+        self.version = 0
+        self._state: Optional[AttendanceState] = None
+        self._cached: Optional[AttendanceSummary] = None
+        self.reset()
+
+    def reset(self):
+        """Забывает счётчики; следующий report() соберёт их заново (после перезагрузки истории)."""
+        self.version += 1
+        self._since: Optional[float] = None
+        self._until: Optional[float] = None
+        self._polls: Dict[tuple, _Poll] = {}
+        # (ts, key) всех известных опросов не старше начала окна, по времени
+        self._order: List[tuple] = []
+        self._in: set = set()
+        self._events: Dict[int, List[tuple]] = {}
+        self._summary: Dict[int, tuple] = {}
+        self._day_polls: Dict[str, Dict[date, int]] = {}
+        # места по каждому виду зачёта, обновляются вместе со сводкой участника
+        self._boards: Dict[str, Leaderboard] = {}
+        # структуры, на которые ссылается срез state(): перед правкой такая копируется (_own_*)
+        self._shared: set = set()
+
+    # -----------------------------
+    # ОБНОВЛЕНИЕ
+    # -----------------------------
+    def _apply(self, poll: _Poll, sign: int):
+        self.version += 1
+        if sign > 0:
+            self._in.add(poll.key)
+        else:
+            self._in.discard(poll.key)
+
+        for kind in _kinds(poll.command):
+            days = self._own_days(kind)
+            days[poll.day] = days.get(poll.day, 0) + sign
+            if days[poll.day] <= 0:
+                del days[poll.day]
+
+        self._own_summary()
+        for pos, uid, name in poll.members:
+            event = (poll.ts, poll.key, pos, poll.day, poll.command, name)
+            events = self._events.setdefault(uid, [])
+            if sign > 0:
+                bisect.insort(events, event)
+            else:
+                i = bisect.bisect_left(events, event)
+                if i < len(events) and events[i] == event:
+                    del events[i]
+            old = self._summary.get(uid)
+            if events:
+                self._summary[uid] = _summarize(events)
+            else:
+                del self._events[uid]
+                self._summary.pop(uid, None)
+            self._rerank(uid, old, self._summary.get(uid))
+
+    def _rerank(self, uid: int, old: Optional[tuple], new: Optional[tuple]):
+        kinds = set(old[0] if old else ()) | set(new[0] if new else ())
+        for kind in kinds:
+            s = new[0].get(kind) if new else None
+            self._own_board(kind).set(uid, s["total"] if s else 0)
+
+    # срез state() держит ссылки на живые структуры; после среза копируется только то, что правится
+    def _own_summary(self):
+        if "summary" in self._shared:
+            self._shared.discard("summary")
+            self._summary = dict(self._summary)
+
+    def _own_days(self, kind: str) -> Dict[date, int]:
+        days = self._day_polls.get(kind)
+        if days is None:
+            days = self._day_polls[kind] = {}
+        elif ("days", kind) in self._shared:
+            self._shared.discard(("days", kind))
+            days = self._day_polls[kind] = dict(days)
+        return days
+
+    def _own_board(self, kind: str) -> Leaderboard:
+        board = self._boards.get(kind)
+        if board is None:
+            board = self._boards[kind] = Leaderboard()
+        elif ("board", kind) in self._shared:
+            self._shared.discard(("board", kind))
+            board = self._boards[kind] = board.copy()
+        return board
+
+    def _add(self, poll: _Poll):
+        self._polls[poll.key] = poll
+        bisect.insort(self._order, (poll.ts, poll.key))
+        if poll.ts <= self._until:
+            self._apply(poll, +1)
+
+    def _drop(self, key: tuple):
+        poll = self._polls.pop(key, None)
+        if poll is None:
+            return
+        if key in self._in:
+            self._apply(poll, -1)
+        i = bisect.bisect_left(self._order, (poll.ts, key))
+        if i < len(self._order) and self._order[i] == (poll.ts, key):
+            del self._order[i]
+
+    def refresh(self, entry: Dict[str, Any]):
+        """Пересчитывает вклад одного опроса (закрытие, правка участников, смена quorum/даты)."""
+        if self._since is None:
+            # счётчики ещё не собраны — соберутся при первом report()
+            return
+        key = _poll_key(entry)
+        if key is None:
+            return
+        self._drop(key)
+        poll = _contribution(entry)
+        if poll is not None and poll.ts >= self._since:
+            self._add(poll)
+
+    def _rebuild(self, since: datetime, until: datetime):
+        self.reset()
+        self._since, self._until = since.timestamp(), until.timestamp()
+        count = 0
+        for entry in self.source(since, FAR_FUTURE):
+            poll = _contribution(entry)
+            # одна и та же запись в памяти и в архиве — берём первую (более свежую)
+            if poll is None or poll.key in self._polls or poll.ts < self._since:
+                continue
+            self._add(poll)
+            count += 1
+        logger.info("Built attendance counters for %d days: %d polls, %d users", self.days, count, len(self._summary))
+
+    def _advance(self, since: datetime, until: datetime):
+        since_ts, until_ts = since.timestamp(), until.timestamp()
+        # выбывшие из окна опросы больше не понадобятся: окно идёт только вперёд
+        cut = bisect.bisect_left(self._order, (since_ts,))
+        for _, key in self._order[:cut]:
+            poll = self._polls.pop(key)
+            if key in self._in:
+                self._apply(poll, -1)
+        del self._order[:cut]
+        # наступившие опросы (закрыты досрочно, expires_at попал в окно)
+        lo = bisect.bisect_right(self._order, (self._until, _MAX_KEY))
+        hi = bisect.bisect_right(self._order, (until_ts, _MAX_KEY))
+        for _, key in self._order[lo:hi]:
+            if key not in self._in:
+                self._apply(self._polls[key], +1)
+        self._since, self._until = since_ts, until_ts
+
+    # -----------------------------
+    # ЧТЕНИЕ
+    # -----------------------------
+    def window(self, until: datetime) -> Tuple[datetime, datetime]:
+        return until - timedelta(days=self.days), until
+
+    def _move(self, until: datetime):
+        since, until = self.window(until)
+        if self._since is None or since.timestamp() < self._since or until.timestamp() < self._until:
+            self._rebuild(since, until)
+        else:
+            self._advance(since, until)
+
+    def report(self, until: datetime) -> Dict[str, Dict[str, Any]]:
+        """Сводка за окно [until - days, until] в формате scan_attendance()."""
+        self._move(until)
+        return _collect(self._summary, self._day_polls)
+
+    def state(self, until: datetime) -> "AttendanceState":
+        """
+        Неизменяемый срез счётчиков за окно с их версией; пока версия та же, отдаётся прежний срез.
+        Срез ссылается на текущие структуры — O(видов зачёта); следующая правка копирует только
+        то, что меняет (сводки участников, таблицу и дни своих видов зачёта), и срез не трогает.
+        """
+        self._move(until)
+        if self._state is None or self._state.version != self.version:
+            self._state = AttendanceState(self.version, self._summary, dict(self._boards), dict(self._day_polls))
+            self._shared = {"summary"} | {("board", kind) for kind in self._boards} | {("days", kind) for kind in self._day_polls}
+        return self._state
+
+    def summary(self, until: datetime) -> "AttendanceSummary":
+        """Итог за окно по срезу state(); пока счётчики не менялись (та же версия), отдаётся прежний объект."""
+        state = self.state(until)
+        if self._cached is None or self._cached.version != state.version:
+            self._cached = _RankedSummary(state)
+        return self._cached
+
+
+class AttendanceState:
+    """
+    Срез AttendanceAggregator на одну версию: сводки участников {uid: (kinds, breakdown)},
+    места по видам зачёта (Leaderboard) и число опросов по дням. Только для чтения.
+    """
+    __slots__ = ("version", "summaries", "boards", "day_polls")
+
+    def __init__(self, version: int, summaries: Dict[int, tuple], boards: Dict[str, Leaderboard],
+                 day_polls: Dict[str, Dict[date, int]]):
+        self.version = version
+        self.summaries = summaries
+        self.boards = boards
+        self.day_polls = day_polls
+
+
+def _collect(summaries: Dict[int, tuple], day_polls: Dict[str, Dict[date, int]]) -> Dict[str, Dict[str, Any]]:
+    """Сводка в формате scan_attendance() по сводкам участников и дням."""
+    rows: Dict[str, List[tuple]] = {}
+    for uid, (kinds, breakdown) in summaries.items():
+        for kind, s in kinds.items():
+            row = {"uid": uid, "name": s["name"], "total": s["total"]}
+            if kind == "all":
+                row.update(breakdown)
+            rows.setdefault(kind, []).append((s["order"], row))
+
+    report = {}
+    for kind, days in day_polls.items():
+        if not days:
+            continue
+        items = sorted(rows.get(kind, []), key=lambda item: item[0])
+        report[kind] = {"users": [row for _, row in items], "days": len(days), "first_date": min(days)}
+    return report
+
+
+# -----------------------------
+#     СЧЁТЧИКИ ПО ДНЯМ (ЛЮБОЕ ОКНО ДАТ)
+# -----------------------------
+class _Track:
+    """
+    Посещения одного участника в одном виде зачёта, по дням (порядковые номера дат):
+    names — имя из самого старого опроса дня, next_named[i] — ближайший день >= i с непустым именем,
+    orders — порядок последнего посещения дня, prefix — накопленные суммы разбивки ("all").
+    """
+    __slots__ = ("days", "names", "next_named", "orders", "prefix")
+
+
+def _tracks(events: List[tuple]) -> Dict[str, _Track]:
+    """События участника (по возрастанию времени) -> _Track по каждому виду зачёта."""
+    per_kind: Dict[str, Dict[int, list]] = {}
+    day_command: Dict[int, str] = {}
+    for ts, key, pos, day, command, name in events:
+        ordinal = day.toordinal()
+        day_command[ordinal] = command
+        for kind in _kinds(command):
+            record = per_kind.setdefault(kind, {}).get(ordinal)
+            if record is None:
+                record = per_kind[kind][ordinal] = ["", None]
+            if name and not record[0]:
+                record[0] = name
+            record[1] = (-ts, -key[0], -key[1], pos)
+
+    tracks = {}
+    for kind, records in per_kind.items():
+        t = _Track()
+        t.days = list(records)
+        t.names = [r[0] for r in records.values()]
+        t.orders = [r[1] for r in records.values()]
+        t.next_named = [len(t.days)] * (len(t.days) + 1)
+        for i in range(len(t.days) - 1, -1, -1):
+            t.next_named[i] = i if t.names[i] else t.next_named[i + 1]
+        t.prefix = None
+        if kind == "all":
+            t.prefix = {}
+            for command, field in BREAKDOWN.items():
+                sums = [0]
+                for ordinal in t.days:
+                    sums.append(sums[-1] + (day_command[ordinal] == command))
+                t.prefix[field] = sums
+        tracks[kind] = t
+    return tracks
+
+
+class AttendanceDays:
+    """
+    Посещаемость за всю историю, разложенная по дням: итог за любое окно дат [first, last]
+    (локальные даты тренировок, включительно) за O(участников), сколько бы опросов в него ни попало.
+
+    Для каждого участника и вида зачёта — дни посещений по возрастанию и накопленные суммы
+    разбивки по типам: число тренировок в окне — разность позиций bisect, разбивка — разность сумм.
+    Правила те же, что у scan_attendance() за окно [first 00:00, last 24:00) местного времени.
+    refresh(entry) — после закрытия опроса или правки; пересчитываются только его участники.
+    Полная сборка — в пуле задач по снимку истории, как у AttendanceIndex: start() -> пустые счётчики,
+    их build(entries) в фоне, adopt() в цикле бота доигрывает опросы, изменённые за время сборки.
+    """
+
+    # сколько последних окон держать готовыми итогами
+    CACHE_SIZE = 16
+
+    def __init__(self, source: Callable[[], Iterable[Dict[str, Any]]]):
+        """source() — все закрытые опросы (history, затем архив; повтор ключа — берётся первый)."""
+        self.source = source
+        self.version = 0
+        self.reset()
+
+    def reset(self):
+        """Забывает счётчики; следующий summary() соберёт их заново (после перезагрузки истории)."""
+        self.version += 1
+        self._built = False
+        self._polls: Dict[tuple, _Poll] = {}
+        self._events: Dict[int, List[tuple]] = {}
+        self._tracks: Dict[int, Dict[str, _Track]] = {}
+        self._dirty: set = set()
+        self._day_polls: Dict[str, Dict[int, int]] = {}
+        self._days: Dict[str, List[int]] = {}
+        self._cached: Dict[Tuple[date, date], AttendanceSummary] = {}
+        # опросы, изменённые пока счётчики собираются в фоне (start ... adopt)
+        self._pending: Optional[Dict[tuple, Dict[str, Any]]] = None
+
+    @property
+    def built(self) -> bool:
+        return self._built
+
+    # -----------------------------
+    # ОБНОВЛЕНИЕ
+    # -----------------------------
+    def _apply(self, poll: _Poll, sign: int):
+        self.version += 1
+        ordinal = poll.day.toordinal()
+        for kind in _kinds(poll.command):
+            days = self._day_polls.setdefault(kind, {})
+            days[ordinal] = days.get(ordinal, 0) + sign
+            if days[ordinal] <= 0:
+                del days[ordinal]
+            self._days.pop(kind, None)
+        for pos, uid, name in poll.members:
+            event = (poll.ts, poll.key, pos, poll.day, poll.command, name)
+            events = self._events.setdefault(uid, [])
+            if sign > 0:
+                bisect.insort(events, event)
+            else:
+                i = bisect.bisect_left(events, event)
+                if i < len(events) and events[i] == event:
+                    del events[i]
+                if not events:
+                    del self._events[uid]
+            self._dirty.add(uid)
+
+    def refresh(self, entry: Dict[str, Any]):
+        """Пересчитывает вклад одного опроса (закрытие, правка участников, смена quorum/даты)."""
+        key = _poll_key(entry)
+        if key is None:
+            return
+        if not self._built:
+            if self._pending is not None:
+                self._pending[key] = entry
+            return
+        old = self._polls.pop(key, None)
+        if old is not None:
+            self._apply(old, -1)
+        poll = _contribution(entry)
+        if poll is not None:
+            self._polls[key] = poll
+            self._apply(poll, +1)
+
+    def start(self) -> "AttendanceDays":
+        """Начало сборки в фоновой задаче: -> пустые счётчики для build(); изменения до adopt() запоминаются."""
+        if self._pending is None:
+            self._pending = {}
+        return AttendanceDays(self.source)
+
+    def build(self, entries: Iterable[Dict[str, Any]]):
+        """Полная сборка по всем записям (повтор ключа — берётся первая) вместе с дорожками участников."""
+        self.reset()
+        for entry in entries:
+            poll = _contribution(entry)
+            if poll is None or poll.key in self._polls:
+                continue
+            self._polls[poll.key] = poll
+            self._apply(poll, +1)
+        self._built = True
+        self._ensure()
+        logger.info("Built attendance day counters: %d polls, %d users", len(self._polls), len(self._events))
+
+    def adopt(self, fresh: "AttendanceDays"):
+        """Берёт счётчики, собранные в фоне, и доигрывает опросы, изменённые за время сборки."""
+        if self._pending is None:
+            # счётчики сброшены (reset) после start() — сборка по старой истории не нужна
+            return
+        pending, self._pending = self._pending, None
+        self._polls, self._events, self._tracks = fresh._polls, fresh._events, fresh._tracks
+        self._day_polls, self._days = fresh._day_polls, fresh._days
+        self._dirty = set()
+        self._cached.clear()
+        self._built = True
+        self.version += 1
+        for entry in pending.values():
+            self.refresh(entry)
+
+    def _ensure(self):
+        if not self._built:
+            self.build(self.source())
+        for uid in self._dirty:
+            events = self._events.get(uid)
+            if events:
+                self._tracks[uid] = _tracks(events)
+            else:
+                self._tracks.pop(uid, None)
+        self._dirty.clear()
+        for kind, days in self._day_polls.items():
+            if kind not in self._days:
+                self._days[kind] = sorted(days)
+
+    # -----------------------------
+    # ЧТЕНИЕ
+    # -----------------------------
+    def report(self, first: date, last: date) -> Dict[str, Dict[str, Any]]:
+        """Сводка за даты [first, last] в формате scan_attendance()."""
+        self._ensure()
+        lo, hi = first.toordinal(), last.toordinal()
+        report = {}
+        for kind, days in self._days.items():
+            i, j = bisect.bisect_left(days, lo), bisect.bisect_right(days, hi)
+            if i < j:
+                report[kind] = {"users": [], "days": j - i, "first_date": date.fromordinal(days[i])}
+
+        rows: Dict[str, List[tuple]] = {kind: [] for kind in report}
+        for uid, tracks in self._tracks.items():
+            for kind, t in tracks.items():
+                a, b = bisect.bisect_left(t.days, lo), bisect.bisect_right(t.days, hi)
+                if a == b:
+                    continue
+                named = t.next_named[a]
+                row = {"uid": uid, "name": t.names[named] if named < b else "", "total": b - a}
+                if t.prefix is not None:
+                    for field, sums in t.prefix.items():
+                        row[field] = sums[b] - sums[a]
+                rows[kind].append((t.orders[b - 1], row))
+        for kind, items in rows.items():
+            items.sort(key=lambda item: item[0])
+            report[kind]["users"] = [row for _, row in items]
+        return report
+
+    def summary(self, first: date, last: date) -> AttendanceSummary:
+        """Итог за даты [first, last]; пока счётчики не менялись, окно отдаётся из кэша."""
+        self._ensure()
+        cached = self._cached.pop((first, last), None)
+        if cached is not None and cached.version == self.version:
+            self._cached[(first, last)] = cached
+            return cached
+        if len(self._cached) >= self.CACHE_SIZE:
+            self._cached.pop(next(iter(self._cached)))
+        summary = self._cached[(first, last)] = AttendanceSummary(self.report(first, last), self.version)
+        return summary
+
+
+class _RankedSummary(AttendanceSummary):
+    """
+    Итог окна AttendanceAggregator без сортировки всех участников: места и топ-N —
+    из Leaderboard среза за O(log), сводка (report) собирается только по запросу (STATS_VERIFY).
+    Срез неизменяем, поэтому итог можно читать и после await: он всё ещё соответствует своей версии.
+    """
+
+    def __init__(self, state: AttendanceState):
+        super().__init__(None, state.version)
+        self._state = state
+        self._tops: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+
+    @property
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        if self._report is None:
+            self._report = _collect(self._state.summaries, self._state.day_polls)
+        return self._report
+
+    def top(self, kind: str, top_n: int) -> List[Dict[str, Any]]:
+        cached = self._tops.get((kind, top_n))
+        if cached is not None:
+            return cached
+        board = self._state.boards.get(kind)
+        rows = []
+        if board is not None:
+            summaries = self._state.summaries
+            for place, total, uids in board.levels(top_n):
+                # при равенстве — порядок первого появления, как в сводке
+                for uid in sorted(uids, key=lambda uid: summaries[uid][0][kind]["order"]):
+                    kinds, breakdown = summaries[uid]
+                    row = {"place": place, "uid": uid, "name": kinds[kind]["name"], "total": total}
+                    if kind == "all":
+                        row.update(breakdown)
+                    rows.append(row)
+        self._tops[(kind, top_n)] = rows
+        return rows
+
+    def place(self, kind: str, uid: int) -> Optional[int]:
+        board = self._state.boards.get(kind)
+        return board.place(uid) if board is not None else None
+
+    def count(self, kind: str, uid: int) -> int:
+        board = self._state.boards.get(kind)
+        return board.total(uid) if board is not None else 0
+
+    def total_users(self, kind: str) -> int:
+        board = self._state.boards.get(kind)
+        return len(board) if board is not None else 0
+
+    def days(self, kind: str) -> int:
+        return len(self._state.day_polls.get(kind, ()))
+
+    def first_date(self, kind: str) -> Optional[date]:
+        return min(self._state.day_polls.get(kind, ()), default=None)
@@ -0,0 +1,106 @@
+# bench_history.py
+"""
+Замер стоимости надёжной записи истории: задержка записи и время восстановления.
+
+    python -m bot.bench_history
+    python -m bot.bench_history --sizes 1000 10000 --format binary
+
+Для каждого размера истории (по умолчанию 1k / 10k / 100k опросов) меряет:
+    vote      — дописать одну запись в журнал (write + fsync)
+    compact   — атомарная свёртка: временный файл, fsync, rename, ротация копий
+    load      — обычный старт: снимок + журнал
+    recover   — старт при повреждённом основном снимке: откат на .1 + журнал
+"""
+import argparse
+import logging
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .history_store import JournaledHistoryStore
+
+COMMANDS = ("saber", "rapier", "openfight")
+
+
+def synthetic_history(n: int, users: int = 80, seed: int = 1) -> List[Dict[str, Any]]:
+    """n закрытых опросов (новейшие в начале), по 0–14 участников из пула users."""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    entries = []
+    for i in range(n):
+        expires = now - timedelta(hours=8 * i)
+        entries.append({
+            "chat_id": "-1001570728084",
+            "message_id": str(10 ** 7 - i),
+            "command": rnd.choice(COMMANDS),
+            "participants": [
+                {"uid": 10 ** 8 + u, "username": None if u % 7 == 0 else f"user{u}", "fullname": f"Участник {u}"}
+                for u in rnd.sample(range(users), rnd.randint(0, 14))
+            ],
+            "created_at": (expires - timedelta(hours=9)).isoformat(),
+            "expires_at": expires.isoformat(),
+            "active": False,
+            "pinned": False,
+            "unpin": True,
+            "weather_sent_on_publish": False,
+            "weather_sent_on_expiry": False,
+        })
+    return entries
+
+
+def _timeit(fn, repeat: int = 1) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_size(n: int, fmt: str, workdir: Path) -> Dict[str, float]:
+    snapshot = workdir / ("polls_history.bin" if fmt == "binary" else "polls_history.json")
+    journal = workdir / "polls_history.journal"
+    entries = synthetic_history(n)
+    store = JournaledHistoryStore(snapshot, journal, maxlen=None)
+    store.load()
+
+    result = {}
+    result["compact"] = _timeit(lambda: store.compact(entries), repeat=3)
+
+    vote = {"op": "join", "chat_id": -1001570728084, "message_id": 10 ** 7, "p": {"uid": 1, "username": "u", "fullname": "U"}}
+    result["vote"] = _timeit(lambda: store.append(vote), repeat=20)
+
+    result["load"] = _timeit(lambda: JournaledHistoryStore(snapshot, journal, recent_days=10 ** 6).load(), repeat=3)
+
+    # основной снимок обрезан «падением посреди записи» — старт с резервной копии .1
+    data = snapshot.read_bytes()
+    snapshot.write_bytes(data[:len(data) // 2])
+    result["recover"] = _timeit(lambda: JournaledHistoryStore(snapshot, journal, recent_days=10 ** 6).load(), repeat=3)
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Бенчмарк записи и восстановления истории опросов")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--format", choices=["json", "binary"], default="json")
+    args = ap.parse_args(argv)
+    # сообщения о восстановлении из копии ожидаемы и только мешают таблице
+    logging.getLogger("bot").setLevel(logging.CRITICAL)
+
+    print(f"format={args.format}")
+    print(f"{'entries':>8} {'vote, ms':>10} {'compact, ms':>12} {'load, ms':>10} {'recover, ms':>12}")
+    for n in args.sizes:
+        workdir = Path(tempfile.mkdtemp(prefix="votebot-bench-"))
+        try:
+            r = bench_size(n, args.format, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{n:>8} {r['vote'] * 1000:>10.3f} {r['compact'] * 1000:>12.1f} {r['load'] * 1000:>10.1f} {r['recover'] * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
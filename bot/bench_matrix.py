@@ -0,0 +1,79 @@
+# bench_matrix.py
+"""
+Замер статистики посещаемости: проход по записям против матрицы на numpy.
+
+    python -m bot.bench_matrix
+    python -m bot.bench_matrix --rows 1000 100000 --days 60 365
+
+Для каждого числа участий (по умолчанию 1k, 100k, 1M; в среднем 7 участников на опрос)
+и каждого окна:
+    scan      — scan_attendance + AttendanceSummary по записям окна
+    build     — сборка колонок AttendanceMatrix (один раз после изменения истории)
+    query     — сводка окна по готовым колонкам
+и проверяет, что ответы совпадают.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+from .attendance_matrix import AttendanceMatrix
+from .attendance_stats import AttendanceSummary, compare_reports, scan_attendance
+from .bench_history import synthetic_history
+from .entry_times import stamp, stamp_all
+from .participant import decode_entry
+
+
+def _timeit(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _window(entries: List[Dict[str, Any]], since: datetime, until: datetime) -> list:
+    since_ts, until_ts = since.timestamp(), until.timestamp()
+    return [e for e in entries if since_ts <= stamp(e)[0] <= until_ts]
+
+
+def bench_rows(rows: int, windows: List[int]) -> List[Dict[str, Any]]:
+    polls = max(1, rows // 7)
+    entries = [decode_entry(e) for e in synthetic_history(polls, users=max(80, rows // 2000))]
+    stamp_all(entries)
+    real_rows = sum(len(e["participants"]) for e in entries)
+    repeat = 1 if real_rows > 200000 else 3
+
+    matrix = AttendanceMatrix(lambda: entries)
+    build = _timeit(lambda: (matrix.invalidate(), matrix.columns()), repeat=repeat)
+
+    until = datetime.now(timezone.utc)
+    result = []
+    for days in windows:
+        since = until - timedelta(days=days)
+        scan = _timeit(lambda: AttendanceSummary(scan_attendance(_window(entries, since, until), since, until)), repeat=repeat)
+        query = _timeit(lambda: matrix.summary(since, until), repeat=repeat)
+
+        a = matrix.summary(since, until)
+        b = AttendanceSummary(scan_attendance(_window(entries, since, until), since, until))
+        same = not compare_reports(a.report, b.report) and all(a.top(k, 10) == b.top(k, 10) for k in b.report)
+        result.append({"rows": real_rows, "days": days, "scan": scan, "build": build, "query": query, "same": same})
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Бенчмарк матрицы посещаемости (numpy) против прохода по записям")
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 100000, 1000000])
+    ap.add_argument("--days", type=int, nargs="+", default=[60, 36500], help="окна статистики, дней")
+    args = ap.parse_args(argv)
+
+    print(f"{'rows':>8} {'days':>6} {'scan, ms':>10} {'build, ms':>10} {'query, ms':>10} {'same':>5}")
+    for rows in args.rows:
+        for r in bench_rows(rows, args.days):
+            print(f"{r['rows']:>8} {r['days']:>6} {r['scan'] * 1000:>10.2f} {r['build'] * 1000:>10.2f} "
+                  f"{r['query'] * 1000:>10.2f} {str(r['same']):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# bench_participants.py
+"""
+Сравнение представлений участника: прежние кортежи (active_poll) + dict (история)
+и общий Participant.
+
+    python -m bot.bench_participants
+    python -m bot.bench_participants --sizes 20 1000 --polls 100
+
+Меряет:
+    memory    — участники в active_poll и в истории (tracemalloc, на polls опросов)
+    vote      — голос: добавить участника в active_poll и в запись истории
+                (прежде — проход по кортежам и пересборка всего списка истории в dict на каждый голос,
+                теперь — словарь по uid, дописывание в историю и JSON-вид одного участника для журнала)
+    edit      — колбэк редактирования: участники опроса -> строки текста (как format_participant_line)
+    encode    — участники опроса -> JSON-вид для журнала/снимка
+    decode    — JSON-вид -> участники (загрузка снимка, чтение архива)
+"""
+import argparse
+import html
+import json
+import time
+import tracemalloc
+from typing import Callable, List
+
+from .participant import Participant, decode_participants, json_default
+
+
+def _timeit(fn: Callable, number: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - t0) / number
+
+
+def _memory(build: Callable) -> int:
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def _line_old(idx: int, participant: tuple) -> str:
+    # прежний format_participant_line: распаковка кортежа
+    uid, username, fullname = participant
+    username_display = f"@{html.escape(username)}" if username else 'None'
+    return f"{idx:2d}. {username_display} - {html.escape(fullname)}"
+
+
+def _line_new(idx: int, participant: Participant) -> str:
+    uid, username, fullname = participant.uid, participant.username, participant.fullname
+    username_display = f"@{html.escape(username)}" if username else 'None'
+    return f"{idx:2d}. {username_display} - {html.escape(fullname)}"
+
+
+def _tuples(n: int) -> List[tuple]:
+    return [(10 ** 8 + i, f"user{i}", f"Участник {i}") for i in range(n)]
+
+
+def bench_size(n: int, polls: int) -> dict:
+    result = {}
+
+    # прежнее: кортежи в active_poll + копия в виде dict в записи истории
+    def build_old():
+        out = []
+        for _ in range(polls):
+            active = _tuples(n)
+            out.append((active, [{"uid": p[0], "username": p[1], "fullname": p[2]} for p in active]))
+        return out
+
+    # теперь: одни и те же объекты Participant в обоих списках
+    def build_new():
+        out = []
+        for _ in range(polls):
+            active = [Participant(*p) for p in _tuples(n)]
+            out.append((active, list(active)))
+        return out
+
+    result["memory_old"] = _memory(build_old)
+    result["memory_new"] = _memory(build_new)
+
+    tuples = _tuples(n)
+    dicts = [{"uid": p[0], "username": p[1], "fullname": p[2]} for p in tuples]
+    objects = [Participant(*p) for p in tuples]
+    by_uid = {p.uid: p for p in objects}
+    voter = (1, "voter", "Голосующий")
+    me = Participant(*voter)
+
+    def vote_old():
+        # прежний poll_button_handler: any() по кортежам, затем
+        # update_history_entry(participants=_serialize_participants(participants)) — весь список заново
+        active = list(tuples)
+        if not any(p[0] == voter[0] for p in active):
+            active.append(voter)
+        hist = [{"uid": p[0], "username": p[1], "fullname": p[2]} for p in active]
+        return hist
+
+    def vote_new():
+        # apply_vote: проверка по словарю active_poll, add_history_participant(checked=True), строка журнала
+        active, hist = dict(by_uid), list(objects)
+        if me.uid not in active:
+            active[me.uid] = me
+            hist.append(me)
+            return {"op": "join", "chat_id": -1, "message_id": 1, "p": me.to_json()}
+
+    number = max(10, 200000 // max(n, 1))
+    # копия исходного состояния опроса (каждый замер начинает с него) — вычитаем её
+    base_old = _timeit(lambda: list(tuples), number)
+    base_new = _timeit(lambda: (dict(by_uid), list(objects)), number)
+    result["vote_old"] = _timeit(vote_old, number) - base_old
+    result["vote_new"] = _timeit(vote_new, number) - base_new
+
+    # прежде колбэк разбирал dict из истории в кортежи (_deserialize_participants), теперь читает Participant как есть
+    result["edit_old"] = _timeit(lambda: [_line_old(i, p) for i, p in enumerate(
+        [(d["uid"], d.get("username"), d.get("fullname")) for d in dicts], start=1)], number)
+    result["edit_new"] = _timeit(lambda: [_line_new(i, p) for i, p in enumerate(objects, start=1)], number)
+
+    result["encode_old"] = _timeit(lambda: json.dumps(dicts, ensure_ascii=False), number)
+    result["encode_new"] = _timeit(lambda: json.dumps(objects, ensure_ascii=False, default=json_default), number)
+
+    raw = json.dumps(dicts, ensure_ascii=False)
+    result["decode_old"] = _timeit(lambda: json.loads(raw), number)
+    result["decode_new"] = _timeit(lambda: decode_participants(json.loads(raw)), number)
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Бенчмарк представления участников опроса")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 30, 300])
+    ap.add_argument("--polls", type=int, default=1000, help="опросов для замера памяти")
+    args = ap.parse_args(argv)
+
+    print(f"{'participants':>12} {'metric':>8} {'tuple+dict':>12} {'Participant':>12}")
+    for n in args.sizes:
+        r = bench_size(n, args.polls)
+        print(f"{n:>12} {'memory':>8} {r['memory_old'] / 1024:>10.0f}KB {r['memory_new'] / 1024:>10.0f}KB")
+        for metric in ("vote", "edit", "encode", "decode"):
+            print(f"{n:>12} {metric:>8} {r[metric + '_old'] * 1e6:>10.2f}us {r[metric + '_new'] * 1e6:>10.2f}us")
+
+
+if __name__ == "__main__":
+    main()
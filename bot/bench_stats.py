@@ -0,0 +1,133 @@
+# bench_stats.py
+"""
+Замер запросов статистики по истории в памяти.
+
+    python -m bot.bench_stats
+    python -m bot.bench_stats --sizes 1000 10000 --days 60
+
+Для каждого размера истории (по умолчанию 10k опросов) сравнивает разбор
+expires_at в каждом проходе (iso) с разобранным один раз временем (stamped):
+    window    — отбор закрытых опросов окна (closed_polls)
+    scan      — полный подсчёт посещаемости за окно (scan_attendance)
+    export    — даты для CSV-выгрузки /stat по всем участиям
+    stamp     — разовый разбор всех записей при загрузке
+и три команды подряд (/top_sum, /top_saber, /my_stat):
+    commands  — три полных прохода (как раньше) против общего итога AttendanceSummary
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+from .attendance_stats import AttendanceAggregator, AttendanceSummary, scan_attendance
+from .bench_history import synthetic_history
+from .entry_times import public_fields, stamp, stamp_all
+from .participant import decode_entry
+
+
+def _timeit(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _window_iso(entries: List[Dict[str, Any]], since: datetime, until: datetime) -> list:
+    out = []
+    for entry in entries:
+        if entry.get("active", False) or not entry.get("expires_at"):
+            continue
+        dt = datetime.fromisoformat(entry["expires_at"])
+        if since <= dt <= until:
+            out.append(entry)
+    return out
+
+
+def _window_stamped(entries: List[Dict[str, Any]], since: datetime, until: datetime) -> list:
+    since_ts, until_ts = since.timestamp(), until.timestamp()
+    out = []
+    for entry in entries:
+        if entry.get("active", False):
+            continue
+        ts = stamp(entry)[0]
+        if ts is not None and since_ts <= ts <= until_ts:
+            out.append(entry)
+    return out
+
+
+def _export_iso(entries: List[Dict[str, Any]]) -> list:
+    return [datetime.fromisoformat(e["expires_at"]).date() for e in entries for _ in e["participants"]]
+
+
+def _export_stamped(entries: List[Dict[str, Any]]) -> list:
+    return [stamp(e)[1] for e in entries for _ in e["participants"]]
+
+
+def bench_size(n: int, days: int) -> Dict[str, float]:
+    raw = [decode_entry(e) for e in synthetic_history(n)]
+    plain = [public_fields(e) for e in raw]     # как до разбора: только ISO-строки
+    stamped = [dict(e) for e in raw]
+    until = datetime.now(timezone.utc)
+    since = until - timedelta(days=days)
+
+    result = {}
+    result["stamp"] = _timeit(lambda: stamp_all([dict(e) for e in plain]), repeat=3)
+    stamp_all(stamped)
+
+    result["window_iso"] = _timeit(lambda: _window_iso(plain, since, until))
+    result["window_stamped"] = _timeit(lambda: _window_stamped(stamped, since, until))
+
+    # прежний подсчёт разбирал строку и при отборе окна, и в самом цикле статистики
+    def scan_iso():
+        polls = _window_iso(plain, since, until)
+        for e in polls:
+            datetime.fromisoformat(e["expires_at"]).date()
+        # scan_attendance на свежих копиях — каждая запись разбирается заново
+        scan_attendance([dict(e) for e in polls], since, until)
+
+    def scan_stamped():
+        polls = _window_stamped(stamped, since, until)
+        # те же копии, чтобы разница была только в разборе
+        scan_attendance([dict(e) for e in polls], since, until)
+
+    result["scan_iso"] = _timeit(scan_iso)
+    result["scan_stamped"] = _timeit(scan_stamped)
+
+    result["export_iso"] = _timeit(lambda: _export_iso(plain))
+    result["export_stamped"] = _timeit(lambda: _export_stamped(stamped))
+
+    def commands_scan():
+        for _ in range(3):
+            AttendanceSummary(scan_attendance(_window_stamped(stamped, since, until), since, until))
+
+    aggregator = AttendanceAggregator(lambda lo, hi: _window_stamped(stamped, lo, hi), days)
+    aggregator.summary(until)
+
+    def commands_summary():
+        for _ in range(3):
+            aggregator.summary(until)
+
+    result["commands_scan"] = _timeit(commands_scan)
+    result["commands_summary"] = _timeit(commands_summary)
+    return result
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Бенчмарк разбора времени в запросах статистики")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10000])
+    ap.add_argument("--days", type=int, default=60, help="окно статистики, дней")
+    args = ap.parse_args(argv)
+
+    print(f"{'polls':>8} {'metric':>8} {'iso, ms':>10} {'stamped, ms':>12}")
+    for n in args.sizes:
+        r = bench_size(n, args.days)
+        for metric in ("window", "scan", "export"):
+            print(f"{n:>8} {metric:>8} {r[metric + '_iso'] * 1000:>10.2f} {r[metric + '_stamped'] * 1000:>12.2f}")
+        print(f"{n:>8} {'stamp':>8} {'':>10} {r['stamp'] * 1000:>12.2f}")
+        print(f"{n:>8} {'commands':>8} {r['commands_scan'] * 1000:>10.2f} {r['commands_summary'] * 1000:>12.3f}  (3x scan / summary)")
+
+
+if __name__ == "__main__":
+    main()
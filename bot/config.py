@@ -28,6 +28,33 @@ LAT, LON = 55.759931, 37.643032
 DATA_DIR = Path(__file__).parent
 SETTINGS_PATH = DATA_DIR / "settings.json"
 HISTORY_PATH = DATA_DIR / "polls_history.json"
+HISTORY_BIN_PATH = DATA_DIR / "polls_history.bin"
+HISTORY_JOURNAL_PATH = DATA_DIR / "polls_history.journal"
+HISTORY_DB_PATH = DATA_DIR / "polls_history.sqlite3"
+# Помесячный архив опросов, не поместившихся в MAXLEN_HISTORY
+HISTORY_ARCHIVE_DIR = DATA_DIR / "history_archive"
+# Хранилище истории: "json" (снимок + журнал) или "sqlite"
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "json").lower()
+# Формат снимка для "json"-бэкенда: "json" (читаемый) или "binary" (компактный, с ленивой загрузкой)
+HISTORY_SNAPSHOT_FORMAT = os.getenv("HISTORY_SNAPSHOT_FORMAT", "json").lower()
+# Окно (сек), за которое изменения истории собираются в одну фоновую запись
+HISTORY_FLUSH_WINDOW = float(os.getenv("HISTORY_FLUSH_WINDOW", "0.5"))
+# Сверять счётчики статистики (/top_*, /my_stat) с полным проходом по истории и писать расхождения в лог
+STATS_VERIFY = os.getenv("STATS_VERIFY", "0").lower() in ("1", "true", "yes")
+# Движок статистики: "counters" (инкрементальные счётчики) или "numpy" (матрица посещаемости)
+STATS_BACKEND = os.getenv("STATS_BACKEND", "counters").lower()
+# Сжатие CSV-выгрузки /stat: "zip", "gzip" или "none"
+STAT_CSV_COMPRESSION = os.getenv("STAT_CSV_COMPRESSION", "zip").lower()
+# Пул потоков для тяжёлых команд (/stat, полный проход статистики): потоки и предел задач в очереди
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "8"))
+# Окно (сек), за которое голоса, таймер и правки админа в одном опросе сливаются в одну правку сообщения
+POLL_EDIT_DEBOUNCE = float(os.getenv("POLL_EDIT_DEBOUNCE", "0.5"))
+# Ограничения Telegram на исходящие запросы (в секунду): на бота, на группу, на личный чат; запас подряд на чат
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
 # Номер чата для ручной отправки погоды
 root_chat_id = os.getenv("root_chat_id")
 if not root_chat_id:
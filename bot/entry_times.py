@@ -0,0 +1,107 @@
+# entry_times.py
+"""
+Время окончания опроса в записи истории, разобранное один раз.
+
+На диске expires_at — ISO-строка. В памяти рядом с ней лежит
+    _expires = (строка, epoch, дата тренировки в локальном часовом поясе)
+Наивное время считаем местным (config.LOCAL_TZ), как main.load_history. Строка в кортеже — та, из которой он посчитан:
+правка expires_at сбрасывает разбор.
+Поля с "_" живут только в памяти; перед записью на диск их убирает public_fields().
+"""
+from datetime import date, datetime, time, timedelta, timezone, tzinfo
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+PRIVATE_PREFIX = "_"
+EXPIRES = "_expires"
+
+# часовой пояс даты тренировки; main ставит config.LOCAL_TZ
+_local_tz: tzinfo = timezone.utc
+
+
+def set_local_tz(tz: tzinfo):
+    global _local_tz
+    _local_tz = tz
+
+
+def aware(dt: datetime) -> datetime:
+    """Наивное время — местное: в истории оно записано по часам бота."""
+    return dt.replace(tzinfo=_local_tz) if dt.tzinfo is None else dt
+
+
+def local_date(ts: float) -> date:
+    return datetime.fromtimestamp(ts, _local_tz).date()
+
+
+def local_bounds(first: date, last: date) -> Tuple[datetime, datetime]:
+    """Даты [first, last] -> [first 00:00, last 24:00) местного времени (конец — последняя микросекунда)."""
+    since = datetime.combine(first, time.min, _local_tz)
+    until = datetime.combine(last + timedelta(days=1), time.min, _local_tz) - timedelta(microseconds=1)
+    return since, until
+
+
+def date_window(arg: str, today: date) -> Tuple[date, date]:
+    """
+    Аргумент окна статистики -> даты [first, last] включительно: "365" — 365 дней по today включительно,
+    "A..B" — с A по B, "A" — с A по today. ValueError — не разбирается или окно за пределами календаря.
+    """
+    try:
+        if arg.isdigit():
+            days = int(arg)
+            if days <= 0:
+                raise ValueError(arg)
+            first, last = today - timedelta(days=days - 1), today
+        else:
+            first_s, sep, last_s = arg.partition("..")
+            first = date.fromisoformat(first_s)
+            last = date.fromisoformat(last_s) if sep and last_s else today
+            if last < first:
+                raise ValueError(arg)
+        # по этим датам считаются границы окна (local_bounds) — проверим, что они есть в календаре
+        local_bounds(first, last)
+    except OverflowError:
+        raise ValueError(arg)
+    return first, last
+
+
+def parse(value) -> Tuple[Optional[float], Optional[date]]:
+    """ISO-строка -> (epoch, локальная дата); (None, None), если строки нет или она не разбирается."""
+    if not value or not isinstance(value, str):
+        return None, None
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return None, None
+    dt = aware(dt)
+    return dt.timestamp(), dt.astimezone(_local_tz).date()
+
+
+def stamp(entry: Dict[str, Any]) -> Tuple[Optional[float], Optional[date]]:
+    """(epoch, локальная дата) окончания опроса; строка разбирается один раз на значение expires_at."""
+    value = entry.get("expires_at")
+    cached = entry.get(EXPIRES)
+    if cached is None or cached[0] != value:
+        cached = entry[EXPIRES] = (value, *parse(value))
+    return cached[1], cached[2]
+
+
+def stamp_ts(entry: Dict[str, Any], ts: Optional[float]):
+    """Отметка по уже известному epoch (колонка expires_ts в SQLite, индекс бинарного снимка)."""
+    entry[EXPIRES] = (entry.get("expires_at"), ts, None if ts is None else local_date(ts))
+
+
+def stamp_all(entries: Iterable[Dict[str, Any]]):
+    for entry in entries:
+        stamp(entry)
+
+
+def expires_ts(entry: Dict[str, Any]) -> Optional[float]:
+    return stamp(entry)[0]
+
+
+def training_date(entry: Dict[str, Any]) -> Optional[date]:
+    return stamp(entry)[1]
+
+
+def public_fields(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Копия записи без полей, которые живут только в памяти."""
+    return {k: v for k, v in entry.items() if not k.startswith(PRIVATE_PREFIX)}
@@ -0,0 +1,55 @@
+# fsutil.py
+import os
+from pathlib import Path
+from typing import Callable, List
+
+
+def fsync_dir(directory: Path):
+    """fsync каталога, чтобы переименование файла пережило сбой питания (на Windows — нет такой операции)."""
+    if os.name == "nt":
+        return
+    fd = os.open(str(directory), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def backup_paths(path: Path, backups: int) -> List[Path]:
+    """path.1 ... path.N — от новой копии к старой."""
+    return [path.with_name(f"{path.name}.{i}") for i in range(1, backups + 1)]
+
+
+def rotate(path: Path, backups: int):
+    """
+    Откладывает path в path.1, прежние копии сдвигает до path.N (самая старая пропадает).
+    Номер копии всегда означает «столько поворотов назад»: вместо отсутствующего файла остаётся пропуск.
+    """
+    path = Path(path)
+    olds = [path] + backup_paths(path, backups)
+    for src, dst in zip(reversed(olds[:-1]), reversed(olds[1:])):
+        if src.exists():
+            os.replace(src, dst)
+        elif dst.exists():
+            os.remove(dst)
+    fsync_dir(path.parent)
+
+
+def atomic_write(path: Path, write: Callable, backups: int = 0):
+    """
+    Атомарная запись: write(f) пишет во временный файл рядом с path, затем fsync и rename.
+    Если backups > 0, предыдущие версии сдвигаются в path.1 ... path.N (последние удачные копии)
+    так же, как в rotate(): нет прежнего файла — на месте path.1 остаётся пропуск.
+    При сбое на любом шаге на диске остаётся либо старый файл, либо новый — но не обрезанный.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if backups > 0:
+        rotate(path, backups)
+    os.replace(tmp, path)
+    fsync_dir(path.parent)
@@ -0,0 +1,156 @@
+# history_archive.py
+import gzip
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from .entry_times import aware, public_fields, stamp_all
+from .fsutil import atomic_write
+from .participant import decode_entry, json_default
+
+logger = logging.getLogger(__name__)
+
+# сколько распакованных сегментов держать в памяти
+SEGMENT_CACHE_SIZE = 4
+UNDATED = "undated"
+
+
+def _ts(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return aware(dt).timestamp()
+
+
+def _segment_of(entry: Dict[str, Any]) -> str:
+    ts = _ts(entry.get("expires_at")) or _ts(entry.get("created_at"))
+    if ts is None:
+        return UNDATED
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+
+def _entry_key(entry: Dict[str, Any]) -> tuple:
+    return int(entry["chat_id"]), int(entry["message_id"])
+
+
+class HistoryArchive:
+    """
+    Архив старых опросов: помесячные сегменты polls_YYYY-MM.json.gz
+    и index.json с метаданными сегментов (min/max expires_at, число записей).
+    Запросы за период читают только сегменты, пересекающиеся с периодом.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.index_path = self.directory / "index.json"
+        self.segments: Dict[str, Dict[str, Any]] = {}
+        self._cache: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        if self.index_path.exists():
+            try:
+                self.segments = json.loads(self.index_path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.exception("Failed to read archive index %s: %s", self.index_path, e)
+
+    def __len__(self):
+        return sum(meta.get("count", 0) for meta in self.segments.values())
+
+    def _segment_path(self, name: str) -> Path:
+        return self.directory / f"polls_{name}.json.gz"
+
+    def _read_segment(self, name: str) -> List[Dict[str, Any]]:
+        cached = self._cache.get(name)
+        if cached is not None:
+            return cached
+        path = self._segment_path(name)
+        if not path.exists():
+            return []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            entries = [decode_entry(e) for e in json.load(f)]
+        # разбираем время сразу: записи кэша потом только читаются, в том числе из потока записи
+        stamp_all(entries)
+        if len(self._cache) >= SEGMENT_CACHE_SIZE:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[name] = entries
+        return entries
+
+    # -----------------------------
+    # ЗАПИСЬ
+    # -----------------------------
+    def add(self, entries: Iterable[Dict[str, Any]]):
+        """
+        Переносит записи в архив. Повторный перенос той же записи (по chat_id, message_id)
+        заменяет её, поэтому операция идемпотентна.
+        """
+        by_segment: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            by_segment.setdefault(_segment_of(entry), []).append(entry)
+        if not by_segment:
+            return
+
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for name, new_entries in by_segment.items():
+                merged = {_entry_key(e): e for e in self._read_segment(name)}
+                for e in new_entries:
+                    merged[_entry_key(e)] = e
+                # новейшие в начале, как в основной истории
+                seg = sorted(merged.values(), key=lambda e: _ts(e.get("expires_at")) or 0, reverse=True)
+
+                data = gzip.compress(json.dumps([public_fields(e) for e in seg], ensure_ascii=False, separators=(",", ":"), default=json_default).encode("utf-8"))
+                atomic_write(self._segment_path(name), lambda f, data=data: f.write(data))
+                self._cache.pop(name, None)
+
+                stamps = [t for t in (_ts(e.get("expires_at")) for e in seg) if t is not None]
+                self.segments[name] = {
+                    "min_ts": min(stamps, default=None),
+                    "max_ts": max(stamps, default=None),
+                    "count": len(seg),
+                }
+
+            index_data = json.dumps(self.segments, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8")
+            atomic_write(self.index_path, lambda f: f.write(index_data))
+        logger.info("Archived %d history entries into %d segment(s)", sum(map(len, by_segment.values())), len(by_segment))
+
+    # -----------------------------
+    # ЧТЕНИЕ
+    # -----------------------------
+    def _names(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[str]:
+        """Сегменты, чей диапазон дат пересекается с [since, until]; новейшие первыми."""
+        names = []
+        for name, meta in self.segments.items():
+            lo, hi = meta.get("min_ts"), meta.get("max_ts")
+            if since is not None or until is not None:
+                if lo is None or hi is None:
+                    continue
+                if since is not None and hi < since.timestamp():
+                    continue
+                if until is not None and lo > until.timestamp():
+                    continue
+            names.append(name)
+        return sorted(names, reverse=True)
+
+    def entries(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            names = self._names(since, until)
+        for name in names:
+            with self._lock:
+                seg = self._read_segment(name)
+            yield from seg
+
+    def find(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        key = (int(chat_id), int(message_id))
+        for entry in self.entries():
+            if _entry_key(entry) == key:
+                # копия: правка должна уйти в архив через add(), а не менять кэш
+                entry = dict(entry)
+                if "participants" in entry:
+                    entry["participants"] = list(entry["participants"])
+                return entry
+        return None
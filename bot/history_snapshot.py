@@ -0,0 +1,310 @@
+# history_snapshot.py
+"""
+Компактный бинарный снимок истории опросов.
+
+Формат (little-endian):
+    заголовок   magic "VBHS", версия, число строк, число записей
+    строки      таблица строк (имена, username, команды, extra) — каждая строка хранится один раз
+    индекс      на каждую запись: chat_id, message_id, expires_at (epoch), флаги, смещение и длина тела
+    тела        команда (id строки), created_at/expires_at (epoch), булевы поля, участники, extra
+
+Индекс и таблица строк читаются сразу, тела записей — по требованию,
+поэтому при старте можно разобрать только активные и свежие опросы.
+
+Конвертер для просмотра и правки руками:
+    python -m bot.history_snapshot to-json polls_history.bin polls_history.json
+    python -m bot.history_snapshot from-json polls_history.json polls_history.bin
+"""
+import argparse
+import json
+import os
+import struct
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from .entry_times import PRIVATE_PREFIX, public_fields, stamp_ts
+from .participant import Participant, decode_entry, decode_participants, json_default
+
+MAGIC = b"VBHS"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sHII")       # magic, version, n_strings, n_entries
+_STR_LEN = struct.Struct("<I")
+_INDEX = struct.Struct("<qqqBII")       # chat_id, message_id, expires_ts, active, offset, length
+_ENTRY = struct.Struct("<IqqHIH")       # command, created_ts, expires_ts, flags, extra, n_participants
+_PART = struct.Struct("<qII")           # uid, username, fullname
+
+NO_TS = -(2 ** 63)
+NO_STR = 0xFFFFFFFF
+
+# булевы поля записи: младший байт — значение, старший — поле присутствует
+_FLAGS = ("active", "pinned", "unpin", "weather_sent_on_publish", "weather_sent_on_expiry", "quorum")
+_PACKED = {"chat_id", "message_id", "command", "created_at", "expires_at", "participants", *_FLAGS}
+
+
+def _to_ts(value) -> Optional[int]:
+    """ISO-строка -> epoch, только если обратное преобразование даёт ту же строку."""
+    if not isinstance(value, str):
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if dt.tzinfo is None or dt.microsecond:
+        return None
+    ts = int(dt.timestamp())
+    return ts if _from_ts(ts) == value else None
+
+
+def _from_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _int_str(value) -> Optional[int]:
+    """'-100123' -> -100123, если строка восстанавливается без потерь."""
+    if isinstance(value, str):
+        try:
+            n = int(value)
+        except ValueError:
+            return None
+        return n if str(n) == value else None
+    return None
+
+
+class _Strings:
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.items: List[str] = []
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_STR
+        sid = self.ids.get(value)
+        if sid is None:
+            sid = self.ids[value] = len(self.items)
+            self.items.append(value)
+        return sid
+
+
+def _packable_participants(participants) -> Optional[List[Participant]]:
+    """Участники, которые ложатся в бинарные поля без потерь; иначе None."""
+    if not isinstance(participants, list):
+        return None
+    packed = []
+    for p in participants:
+        if isinstance(p, dict):
+            if set(p) != {"uid", "username", "fullname"}:
+                return None
+            p = Participant.from_json(p)
+        elif not isinstance(p, Participant):
+            return None
+        if type(p.uid) is not int:
+            return None
+        if not all(v is None or isinstance(v, str) for v in (p.username, p.fullname)):
+            return None
+        packed.append(p)
+    return packed
+
+
+def _encode_entry(entry: Dict[str, Any], strings: _Strings) -> tuple:
+    """-> (тело записи, строка индекса без смещения)."""
+    extra = {k: v for k, v in entry.items() if k not in _PACKED and not k.startswith(PRIVATE_PREFIX)}
+
+    chat_id = _int_str(entry.get("chat_id"))
+    message_id = _int_str(entry.get("message_id"))
+    if chat_id is None or message_id is None:
+        raise ValueError(f"Unsupported poll key in history entry: {entry.get('chat_id')!r}/{entry.get('message_id')!r}")
+
+    command = entry.get("command")
+    if "command" in entry and not isinstance(command, str):
+        extra["command"] = command
+        command = None
+
+    stamps = []
+    for key in ("created_at", "expires_at"):
+        ts = _to_ts(entry.get(key))
+        if ts is None and entry.get(key) is not None:
+            # не epoch-представимое значение храним как есть
+            extra[key] = entry[key]
+        stamps.append(NO_TS if ts is None else ts)
+
+    flags = 0
+    for bit, key in enumerate(_FLAGS):
+        if key not in entry:
+            continue
+        if isinstance(entry[key], bool):
+            flags |= 1 << (bit + 8)
+            if entry[key]:
+                flags |= 1 << bit
+        else:
+            extra[key] = entry[key]
+
+    participants = _packable_participants(entry.get("participants", []))
+    if participants is None:
+        extra["participants"] = entry["participants"]
+        participants = []
+    elif "participants" not in entry:
+        extra["participants"] = None  # маркер: поля не было
+
+    body = bytearray(_ENTRY.pack(
+        strings.add(command), stamps[0], stamps[1], flags,
+        strings.add(json.dumps(extra, ensure_ascii=False, sort_keys=True, default=json_default)), len(participants)
+    ))
+    for p in participants:
+        body += _PART.pack(p.uid, strings.add(p.username), strings.add(p.fullname))
+
+    index = (chat_id, message_id, stamps[1], int(bool(entry.get("active"))))
+    return bytes(body), index
+
+
+def dumps(entries: Sequence[Dict[str, Any]]) -> bytes:
+    """Список записей истории (новейшие в начале) -> байты снимка."""
+    strings = _Strings()
+    bodies = []
+    index_rows = []
+    offset = 0
+    for entry in entries:
+        body, idx = _encode_entry(entry, strings)
+        bodies.append(body)
+        index_rows.append(_INDEX.pack(*idx, offset, len(body)))
+        offset += len(body)
+
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, len(strings.items), len(entries)))
+    for s in strings.items:
+        raw = s.encode("utf-8")
+        out += _STR_LEN.pack(len(raw)) + raw
+    for row in index_rows:
+        out += row
+    for body in bodies:
+        out += body
+    return bytes(out)
+
+
+def write(path: Path, entries: Sequence[Dict[str, Any]]):
+    with open(path, "wb") as f:
+        f.write(dumps(entries))
+
+
+class SnapshotIndexRow:
+    __slots__ = ("chat_id", "message_id", "expires_ts", "active", "offset", "length")
+
+    def __init__(self, chat_id, message_id, expires_ts, active, offset, length):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.expires_ts = None if expires_ts == NO_TS else expires_ts
+        self.active = bool(active)
+        self.offset = offset
+        self.length = length
+
+
+class SnapshotReader:
+    """
+    Читает заголовок, таблицу строк и индекс снимка; тела записей — по требованию.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            head = f.read(_HEADER.size)
+            if len(head) != _HEADER.size:
+                raise ValueError(f"{self.path}: truncated header")
+            magic, version, n_strings, n_entries = _HEADER.unpack(head)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{self.path}: not a history snapshot (magic={magic!r}, version={version})")
+            self.strings: List[str] = []
+            for _ in range(n_strings):
+                raw = f.read(_STR_LEN.size)
+                if len(raw) != _STR_LEN.size:
+                    raise ValueError(f"{self.path}: truncated string table")
+                (n,) = _STR_LEN.unpack(raw)
+                self.strings.append(f.read(n).decode("utf-8"))
+            raw_index = f.read(_INDEX.size * n_entries)
+            if len(raw_index) != _INDEX.size * n_entries:
+                raise ValueError(f"{self.path}: truncated index")
+            self.index = [SnapshotIndexRow(*row) for row in _INDEX.iter_unpack(raw_index)]
+            self.body_start = f.tell()
+        body_size = max((row.offset + row.length for row in self.index), default=0)
+        if os.path.getsize(self.path) != self.body_start + body_size:
+            raise ValueError(f"{self.path}: size does not match index (truncated or damaged)")
+
+    def __len__(self):
+        return len(self.index)
+
+    def _str(self, sid: int) -> Optional[str]:
+        return None if sid == NO_STR else self.strings[sid]
+
+    def _decode(self, row: SnapshotIndexRow, body: bytes) -> Dict[str, Any]:
+        command, created_ts, expires_ts, flags, extra_sid, n_participants = _ENTRY.unpack_from(body, 0)
+        pos = _ENTRY.size
+        participants = []
+        for _ in range(n_participants):
+            uid, username, fullname = _PART.unpack_from(body, pos)
+            pos += _PART.size
+            participants.append(Participant(uid, self._str(username), self._str(fullname)))
+
+        entry: Dict[str, Any] = {"chat_id": str(row.chat_id), "message_id": str(row.message_id)}
+        if command != NO_STR:
+            entry["command"] = self.strings[command]
+        entry["participants"] = participants
+        if created_ts != NO_TS:
+            entry["created_at"] = _from_ts(created_ts)
+        if expires_ts != NO_TS:
+            entry["expires_at"] = _from_ts(expires_ts)
+            # epoch уже есть — строку потом разбирать не придётся
+            stamp_ts(entry, float(expires_ts))
+        for bit, key in enumerate(_FLAGS):
+            if flags & (1 << (bit + 8)):
+                entry[key] = bool(flags & (1 << bit))
+
+        extra = json.loads(self.strings[extra_sid])
+        if "participants" in extra:
+            if extra["participants"] is None:
+                del extra["participants"]
+                del entry["participants"]
+            elif isinstance(extra["participants"], list):
+                extra["participants"] = decode_participants(extra["participants"])
+        entry.update(extra)
+        return entry
+
+    def read(self, positions: Sequence[int]) -> List[Dict[str, Any]]:
+        """Разбирает записи с указанными номерами (в порядке индекса)."""
+        rows = [self.index[i] for i in positions]
+        if not rows:
+            return []
+        # тела лежат подряд: читаем нужный диапазон одним куском
+        lo = min(row.offset for row in rows)
+        hi = max(row.offset + row.length for row in rows)
+        with open(self.path, "rb") as f:
+            f.seek(self.body_start + lo)
+            chunk = f.read(hi - lo)
+        if len(chunk) != hi - lo:
+            raise ValueError(f"{self.path}: truncated entry bodies")
+        view = memoryview(chunk)
+        return [self._decode(row, view[row.offset - lo:row.offset - lo + row.length]) for row in rows]
+
+    def read_all(self) -> List[Dict[str, Any]]:
+        return self.read(range(len(self.index)))
+
+
+# -----------------------------
+#     КОНВЕРТЕР
+# -----------------------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Конвертер снимка истории опросов JSON <-> бинарный формат")
+    ap.add_argument("mode", choices=["to-json", "from-json"])
+    ap.add_argument("src", type=Path)
+    ap.add_argument("dst", type=Path)
+    args = ap.parse_args(argv)
+
+    if args.mode == "to-json":
+        entries = [public_fields(e) for e in SnapshotReader(args.src).read_all()]
+        args.dst.write_text(json.dumps(entries, ensure_ascii=False, indent=2, default=json_default), encoding="utf-8")
+    else:
+        entries = [decode_entry(e) for e in json.loads(args.src.read_text(encoding="utf-8"))]
+        write(args.dst, entries)
+    print(f"{args.src} -> {args.dst}: {len(entries)} entries, {os.path.getsize(args.dst)} bytes")
+
+
+if __name__ == "__main__":
+    main()
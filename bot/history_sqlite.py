@@ -0,0 +1,295 @@
+# history_sqlite.py
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from .entry_times import PRIVATE_PREFIX, local_date, stamp_ts
+from .history_store import HistoryStore, parse_expires
+from .history_view import HistorySnapshot
+from .participant import Participant
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS polls (
+    id          INTEGER PRIMARY KEY,
+    chat_id     INTEGER NOT NULL,
+    message_id  INTEGER NOT NULL,
+    command     TEXT,
+    created_at  TEXT,
+    expires_at  TEXT,
+    expires_ts  REAL,
+    active      INTEGER NOT NULL DEFAULT 0,
+    extra       TEXT NOT NULL DEFAULT '{}',
+    UNIQUE (chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS participants (
+    poll_id   INTEGER NOT NULL REFERENCES polls(id) ON DELETE CASCADE,
+    pos       INTEGER NOT NULL,
+    uid       INTEGER NOT NULL,
+    username  TEXT,
+    fullname  TEXT,
+    PRIMARY KEY (poll_id, uid)
+);
+CREATE INDEX IF NOT EXISTS idx_polls_expires ON polls (expires_ts);
+CREATE INDEX IF NOT EXISTS idx_polls_command ON polls (command, expires_ts);
+CREATE INDEX IF NOT EXISTS idx_participants_uid ON participants (uid);
+"""
+
+# поля записи истории, у которых есть свои колонки; остальное уходит в extra (JSON)
+_COLUMNS = ("chat_id", "message_id", "command", "created_at", "expires_at", "active")
+
+
+def _expires_ts(value: Optional[str]) -> Optional[float]:
+    try:
+        dt = parse_expires(value)
+    except ValueError:
+        return None
+    return dt.timestamp() if dt else None
+
+
+class SqliteHistoryStore(HistoryStore):
+    """
+    История опросов в SQLite (WAL): таблицы polls и participants с индексами
+    по (chat_id, message_id), expires_at, command и uid.
+    В памяти (self.history) держим только последние maxlen опросов — для восстановления
+    активного опроса; запросы статистики идут в базу и видят всю историю.
+    """
+
+    def __init__(self, db_path: Path, maxlen: Optional[int] = None, migrate_from: Optional[HistoryStore] = None):
+        self.db_path = Path(db_path)
+        self.maxlen = maxlen
+        self.migrate_from = migrate_from
+        self.history = []
+        self.index = {}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+    # -----------------------------
+    # ЗАГРУЗКА / МИГРАЦИЯ
+    # -----------------------------
+    def load(self) -> List[Dict[str, Any]]:
+        if self.migrate_from is not None and self._count() == 0:
+            self._migrate(self.migrate_from)
+
+        limit = self.maxlen if self.maxlen is not None else -1
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM polls ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            self.history = self._entries(rows)
+        self.reindex()
+        logger.info("Loaded history from %s: %d of %d entries", self.db_path, len(self.history), self._count())
+        return self.history
+
+    def _count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM polls").fetchone()[0]
+
+    def _migrate(self, source: HistoryStore):
+        """Переносит историю из JSON-снимка (и журнала) в пустую базу."""
+        try:
+            entries = source.load()
+            source.load_all()
+            entries = entries + list(source.archived())
+        except Exception as e:
+            logger.exception("Failed to read JSON history for migration: %s", e)
+            return
+        if not entries:
+            return
+        with self._lock, self.conn:
+            # в JSON новейшие в начале, вставляем от старых к новым, чтобы id рос со временем
+            for entry in reversed(entries):
+                self._insert(entry)
+        logger.info("Migrated %d history entries into %s", len(entries), self.db_path)
+
+    # -----------------------------
+    # ЗАПИСЬ
+    # -----------------------------
+    def append(self, record: Dict[str, Any]):
+        """Применяет запись журнала к базе одной транзакцией."""
+        self.append_many([record])
+
+    def append_many(self, records: List[Dict[str, Any]]):
+        """Применяет пачку записей журнала к базе одной транзакцией."""
+        with self._lock, self.conn:
+            for record in records:
+                self._apply(record)
+
+    def _apply(self, record: Dict[str, Any]):
+        op = record.get("op")
+        if op == "create":
+            self._insert(record["entry"])
+            return
+
+        row = self.conn.execute(
+            "SELECT id FROM polls WHERE chat_id = ? AND message_id = ?",
+            (int(record["chat_id"]), int(record["message_id"]))
+        ).fetchone()
+        if row is None:
+            logger.warning("SQLite history: poll not found for record %s", record)
+            return
+        poll_id = row["id"]
+
+        if op == "join":
+            p = Participant.from_json(record["p"])
+            self.conn.execute(
+                "INSERT OR IGNORE INTO participants (poll_id, pos, uid, username, fullname) "
+                "VALUES (?, (SELECT COALESCE(MAX(pos), 0) + 1 FROM participants WHERE poll_id = ?), ?, ?, ?)",
+                (poll_id, poll_id, p.uid, p.username, p.fullname)
+            )
+        elif op == "leave":
+            self.conn.execute("DELETE FROM participants WHERE poll_id = ? AND uid = ?", (poll_id, record["uid"]))
+        elif op == "update":
+            self._update(poll_id, record["set"])
+        else:
+            logger.warning("Unknown journal op: %s", op)
+
+    def _insert(self, entry: Dict[str, Any]):
+        extra = {k: v for k, v in entry.items()
+                 if k not in _COLUMNS and k != "participants" and not k.startswith(PRIVATE_PREFIX)}
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO polls (chat_id, message_id, command, created_at, expires_at, expires_ts, active, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(entry["chat_id"]), int(entry["message_id"]), entry.get("command"), entry.get("created_at"),
+             entry.get("expires_at"), _expires_ts(entry.get("expires_at")), int(bool(entry.get("active"))),
+             json.dumps(extra, ensure_ascii=False))
+        )
+        if cur.rowcount:
+            self._set_participants(cur.lastrowid, entry.get("participants", []))
+
+    def _set_participants(self, poll_id: int, participants: List[Any]):
+        """participants — Participant или их JSON-вид (записи журнала, перенос из снимка)."""
+        participants = [Participant.from_json(p) for p in participants]
+        self.conn.execute("DELETE FROM participants WHERE poll_id = ?", (poll_id,))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO participants (poll_id, pos, uid, username, fullname) VALUES (?, ?, ?, ?, ?)",
+            [(poll_id, pos, p.uid, p.username, p.fullname)
+             for pos, p in enumerate(participants, start=1) if p.uid]
+        )
+
+    def _update(self, poll_id: int, updates: Dict[str, Any]):
+        updates = dict(updates)
+        if "participants" in updates:
+            self._set_participants(poll_id, updates.pop("participants"))
+        if "expires_at" in updates:
+            updates["expires_ts"] = _expires_ts(updates["expires_at"])
+        if "active" in updates:
+            updates["active"] = int(bool(updates["active"]))
+
+        columns = {k: v for k, v in updates.items() if k in _COLUMNS or k == "expires_ts"}
+        extra = {k: v for k, v in updates.items() if k not in columns}
+        if columns:
+            assignments = ", ".join(f"{k} = ?" for k in columns)
+            self.conn.execute(f"UPDATE polls SET {assignments} WHERE id = ?", (*columns.values(), poll_id))
+        if extra:
+            row = self.conn.execute("SELECT extra FROM polls WHERE id = ?", (poll_id,)).fetchone()
+            merged = json.loads(row["extra"] or "{}")
+            merged.update(extra)
+            self.conn.execute("UPDATE polls SET extra = ? WHERE id = ?", (json.dumps(merged, ensure_ascii=False), poll_id))
+
+    def compact(self, history: List[Dict[str, Any]]):
+        # все изменения уже в базе; сбрасываем WAL в основной файл
+        with self._lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    # -----------------------------
+    # ЗАПРОСЫ
+    # -----------------------------
+    def _entries(self, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+        """Собирает записи истории в том же виде, что и JSON-хранилище (участники — Participant)."""
+        if not rows:
+            return []
+        ids = [row["id"] for row in rows]
+        participants: Dict[int, List[Participant]] = {i: [] for i in ids}
+        # ограничение SQLite на число параметров — читаем пачками
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            for p in self.conn.execute(
+                f"SELECT poll_id, uid, username, fullname FROM participants WHERE poll_id IN ({marks}) ORDER BY poll_id, pos",
+                chunk
+            ):
+                participants[p["poll_id"]].append(Participant(p["uid"], p["username"], p["fullname"]))
+
+        entries = []
+        for row in rows:
+            entry = {
+                "chat_id": str(row["chat_id"]),
+                "message_id": str(row["message_id"]),
+                "command": row["command"],
+                "participants": participants[row["id"]],
+                "created_at": row["created_at"],
+                "expires_at": row["expires_at"],
+                "active": bool(row["active"]),
+            }
+            entry.update(json.loads(row["extra"] or "{}"))
+            stamp_ts(entry, row["expires_ts"])
+            entries.append(entry)
+        return entries
+
+    def find(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        # сначала — в памяти, чтобы правки шли в тот же объект, что и у активного опроса
+        entry = super().find(chat_id, message_id)
+        if entry is not None:
+            return entry
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM polls WHERE chat_id = ? AND message_id = ?", (int(chat_id), int(message_id))
+            ).fetchone()
+            return self._entries([row])[0] if row else None
+
+    def closed_polls(self, since: datetime, until: datetime, command: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        sql = "SELECT * FROM polls WHERE active = 0 AND expires_ts BETWEEN ? AND ?"
+        params: list = [since.timestamp(), until.timestamp()]
+        if command is not None:
+            sql += " AND command = ?"
+            params.append(command)
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY id DESC", params).fetchall()
+            entries = self._entries(rows)
+        yield from entries
+
+    def snapshot(self) -> HistorySnapshot:
+        """
+        Снимок для фоновой задачи: опросы в памяти замораживаются сейчас (в базу их правки
+        уходят с задержкой окна HistoryWriter), остальное задача читает из базы сама.
+        """
+        return HistorySnapshot(self.history, self._stored)
+
+    def _stored(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Все опросы из базы, новейшие первыми; since/until — по expires_at."""
+        sql, params = "SELECT * FROM polls", []
+        if since is not None or until is not None:
+            sql += " WHERE expires_ts BETWEEN ? AND ?"
+            params = [since.timestamp() if since else float("-inf"), until.timestamp() if until else float("inf")]
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY id DESC", params).fetchall()
+            return self._entries(rows)
+
+    def participations(self, uid: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        sql = (
+            "SELECT p.uid, p.fullname, p.username, polls.expires_at, polls.expires_ts, polls.command "
+            "FROM participants p JOIN polls ON polls.id = p.poll_id WHERE polls.expires_at IS NOT NULL"
+        )
+        params: list = []
+        if uid is not None:
+            sql += " AND p.uid = ?"
+            params.append(uid)
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY polls.id DESC, p.pos", params).fetchall()
+        for row in rows:
+            yield {
+                "uid": row["uid"],
+                "fullname": row["fullname"],
+                "username": row["username"],
+                "expires_at": row["expires_at"],
+                "date": None if row["expires_ts"] is None else local_date(row["expires_ts"]),
+                "command": row["command"] or "",
+            }
@@ -0,0 +1,547 @@
+# history_store.py
+import json
+import logging
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from . import history_snapshot
+from .attendance_index import AttendanceIndex
+from .entry_times import aware, expires_ts
+from .fsutil import atomic_write, backup_paths, rotate
+from .history_archive import HistoryArchive
+from .history_view import HistorySnapshot, participation_rows
+from .participant import Participant, decode_entry, decode_participants, json_default
+
+logger = logging.getLogger(__name__)
+
+# === настройки журнала ===
+# после скольких записей в журнале сворачивать его в снимок
+JOURNAL_COMPACT_EVERY = 500
+# опросы не старше стольких дней разбираются из бинарного снимка сразу при старте
+HISTORY_RECENT_DAYS = 90
+# сколько предыдущих удачных снимков держать рядом (polls_history.json.1 ... .N);
+# столько же свёрнутых журналов (polls_history.journal.1 ... .N) — записи после каждой копии
+SNAPSHOT_BACKUPS = 3
+
+
+def _key(chat_id, message_id) -> tuple:
+    return int(chat_id), int(message_id)
+
+
+def parse_expires(value: Optional[str]) -> Optional[datetime]:
+    """ISO-строка expires_at -> aware datetime (наивное время считаем местным)."""
+    if not value:
+        return None
+    return aware(datetime.fromisoformat(value))
+
+
+def apply_record(history: List[Dict[str, Any]], index: Dict[tuple, Dict[str, Any]], record: Dict[str, Any]):
+    """
+    Применяет одну запись журнала к списку истории (новейшие в начале).
+    index — словарь (chat_id, message_id) -> entry, поддерживается здесь же.
+    """
+    op = record.get("op")
+    if op == "create":
+        entry = decode_entry(record["entry"])
+        key = _key(entry["chat_id"], entry["message_id"])
+        if key in index:
+            # журнал проигрывается поверх более нового снимка (сбой во время свёртки)
+            index[key].update(entry)
+            return
+        history.insert(0, entry)
+        index[key] = entry
+        return
+
+    entry = index.get(_key(record["chat_id"], record["message_id"]))
+    if entry is None:
+        logger.warning("Journal record for unknown poll: %s", record)
+        return
+
+    if op == "join":
+        p = Participant.from_json(record["p"])
+        participants = entry.setdefault("participants", [])
+        if not any(x.uid == p.uid for x in participants):
+            participants.append(p)
+    elif op == "leave":
+        uid = record["uid"]
+        entry["participants"] = [x for x in entry.get("participants", []) if x.uid != uid]
+    elif op == "update":
+        updates = record["set"]
+        if "participants" in updates:
+            updates["participants"] = decode_participants(updates["participants"])
+        entry.update(updates)
+    else:
+        logger.warning("Unknown journal op: %s", op)
+
+
+class HistoryStore(ABC):
+    """
+    Базовый интерфейс хранилища истории: бэкенд обязан уметь load() и append().
+    Запросы по умолчанию выполняются перебором загруженного списка self.history;
+    бэкенды с индексами (SQLite) переопределяют их.
+    """
+
+    history: List[Dict[str, Any]]
+    # первичный индекс self.history: (chat_id, message_id) -> та же запись, что в списке
+    index: Dict[tuple, Dict[str, Any]]
+    # число непросвёрнутых записей журнала (для бэкендов без журнала — всегда 0)
+    journal_len = 0
+    # индекс посещаемости по uid (None — бэкенд отвечает по пользователю сам); собирается в пуле задач
+    attendance: Optional[AttendanceIndex] = None
+
+    @abstractmethod
+    def load(self) -> List[Dict[str, Any]]:
+        """Читает историю (новейшие в начале) в self.history, строит индекс и возвращает список."""
+
+    @abstractmethod
+    def append(self, record: Dict[str, Any]):
+        """Сохраняет одну запись журнала (create/join/leave/update)."""
+
+    def append_many(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self.append(record)
+
+    def needs_compaction(self, pending: int = 0) -> bool:
+        return False
+
+    def compact(self, history: List[Dict[str, Any]]):
+        pass
+
+    def archive_entries(self, entries: List[Dict[str, Any]]):
+        """Записи, вытесненные из памяти (сверх maxlen); по умолчанию хранилище и так держит всё."""
+
+    def archived(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+        """Записи архива (за пределами self.history); since/until — фильтр по сегментам."""
+        return iter(())
+
+    def find_archived(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        """Копия записи из архива — правки нужно вернуть через archive_entries()."""
+        return None
+
+    def load_all(self):
+        """Догружает в self.history записи, отложенные при старте (если такие есть)."""
+
+    def load_since(self, since: datetime):
+        """Догружает отложенные записи, если среди них есть опросы новее since."""
+
+    # -----------------------------
+    # ИНДЕКС
+    # -----------------------------
+    def reindex(self):
+        """Перестраивает индекс по self.history (после загрузки или замены списка)."""
+        self.index = {}
+        # при дублях ключа в индексе остаётся новейшая запись, как при поиске перебором
+        for entry in reversed(self.history):
+            self.index_entry(entry)
+
+    def index_entry(self, entry: Dict[str, Any]):
+        """Добавляет в индекс запись, только что вставленную в начало self.history."""
+        try:
+            self.index[_key(entry["chat_id"], entry["message_id"])] = entry
+        except (KeyError, TypeError, ValueError):
+            logger.warning("History entry without valid poll key is not indexed: %s", entry)
+
+    def unindex(self, entries: List[Dict[str, Any]]):
+        """Убирает из индекса записи, удаляемые из self.history (обрезка до maxlen)."""
+        for entry in entries:
+            try:
+                key = _key(entry["chat_id"], entry["message_id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if self.index.get(key) is entry:
+                del self.index[key]
+
+    def check_index(self) -> List[str]:
+        """
+        Проверка согласованности индекса с self.history.
+        Возвращает список расхождений; пустой список — индекс верен.
+        """
+        expected: Dict[tuple, Dict[str, Any]] = {}
+        for entry in self.history:
+            try:
+                expected.setdefault(_key(entry["chat_id"], entry["message_id"]), entry)
+            except (KeyError, TypeError, ValueError):
+                continue
+        problems = []
+        for key, entry in expected.items():
+            if key not in self.index:
+                problems.append(f"{key}: missing from index")
+            elif self.index[key] is not entry:
+                problems.append(f"{key}: index points to a different entry object")
+        for key in self.index.keys() - expected.keys():
+            problems.append(f"{key}: indexed but not in history")
+        return problems
+
+    def refresh_attendance(self, entry: Dict[str, Any]):
+        """Обновляет индекс посещаемости после изменения опроса (голос, закрытие, правка админом)."""
+        if self.attendance is not None:
+            self.attendance.refresh(entry)
+
+    # -----------------------------
+    # ЗАПРОСЫ
+    # -----------------------------
+    def find(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        """Запись опроса по (chat_id, message_id) — O(1) по индексу."""
+        try:
+            return self.index.get(_key(chat_id, message_id))
+        except (TypeError, ValueError):
+            return None
+
+    def closed_polls(self, since: datetime, until: datetime, command: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Закрытые опросы с expires_at в [since, until], опционально одного типа."""
+        self.load_since(since)
+        since_ts, until_ts = since.timestamp(), until.timestamp()
+        for entries in (self.history, self.archived(since, until)):
+            for entry in entries:
+                if entry.get("active", False):
+                    continue
+                if command is not None and entry.get("command", "") != command:
+                    continue
+                ts = expires_ts(entry)
+                if ts is None or ts < since_ts or ts > until_ts:
+                    continue
+                yield entry
+
+    def participations(self, uid: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Строки участия {uid, fullname, username, expires_at, date, command} (date — локальная дата тренировки) —
+        по всем пользователям или по одному uid (через индекс посещаемости, если он уже собран).
+        """
+        if uid is not None and self.attendance is not None and self.attendance.built:
+            yield from self.attendance.participations(uid)
+            return
+        self.load_all()
+        yield from participation_rows(chain(self.history, self.archived()), uid)
+
+    def snapshot(self) -> HistorySnapshot:
+        """
+        Неизменяемый снимок всей истории для фоновой задачи (closed_polls, participations, unique_users).
+        Строится в цикле бота; копируются только записи, изменённые после прошлого снимка,
+        сегменты архива читаются и распаковываются уже в фоновой задаче.
+        """
+        self.load_all()
+        return HistorySnapshot(self.history, self.archived)
+
+
+class JournaledHistoryStore(HistoryStore):
+    """
+    Хранилище истории опросов: снимок + журнал изменений.
+    Каждое изменение дописывается в журнал одной компактной строкой,
+    поэтому стоимость записи голоса не зависит от длины истории.
+    Время от времени журнал сворачивается в снимок (compact).
+
+    Снимок — JSON-список или компактный бинарный файл (history_snapshot, если путь
+    оканчивается на .bin). Из бинарного снимка при старте разбираются только активные
+    и свежие (recent_days) опросы; более старые подгружаются при первом запросе к ним.
+
+    Записи сверх maxlen не теряются, а уходят в помесячный архив (HistoryArchive),
+    если он задан; запросы статистики читают из архива только нужные сегменты.
+    """
+
+    def __init__(self, snapshot_path: Path, journal_path: Path,
+                 maxlen: Optional[int] = None, compact_every: int = JOURNAL_COMPACT_EVERY,
+                 legacy_json_path: Optional[Path] = None, recent_days: int = HISTORY_RECENT_DAYS,
+                 archive: Optional[HistoryArchive] = None):
+        self.snapshot_path = Path(snapshot_path)
+        self.journal_path = Path(journal_path)
+        self.binary = self.snapshot_path.suffix == ".bin"
+        # JSON-снимок, из которого читаем, пока бинарного ещё нет (переход на .bin на месте)
+        self.legacy_json_path = Path(legacy_json_path) if legacy_json_path else None
+        self.maxlen = maxlen
+        self.compact_every = compact_every
+        self.recent_days = recent_days
+        self.archive = archive
+        self.journal_len = 0
+        # свёртка только после удачной загрузки: иначе пустая история ушла бы в снимок,
+        # а уцелевшие копии — за пределы .N
+        self.loaded = False
+        self.history = []
+        self.index = {}
+        self.attendance = AttendanceIndex()
+        # неразобранный хвост бинарного снимка: (reader, номер первой записи хвоста)
+        self._tail: Optional[tuple] = None
+        self._tail_lock = threading.Lock()
+
+    # -----------------------------
+    # ЗАГРУЗКА
+    # -----------------------------
+    def _read_journal(self, path: Optional[Path] = None) -> List[Dict[str, Any]]:
+        path = path or self.journal_path
+        records = []
+        if not path.exists():
+            return records
+        with open(path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # оборванная последняя строка после падения — пропускаем
+                    logger.warning("Skipping broken journal line %d in %s", lineno, path)
+        return records
+
+    def _read_snapshot(self, path: Path, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Читает и проверяет снимок; ValueError/OSError — снимок повреждён."""
+        self._tail = None
+        if not self.binary:
+            with open(path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            if not isinstance(history, list) or not all(
+                    isinstance(e, dict) and "chat_id" in e and "message_id" in e for e in history):
+                raise ValueError(f"{path}: not a list of history entries")
+            return [decode_entry(e) for e in history]
+
+        reader = history_snapshot.SnapshotReader(path)
+        cutoff = datetime.now(timezone.utc).timestamp() - self.recent_days * 86400
+        # список — новейшие в начале: разбираем префикс до последнего активного/свежего опроса
+        eager = 0
+        for i, row in enumerate(reader.index):
+            if row.active or row.expires_ts is None or row.expires_ts >= cutoff:
+                eager = i + 1
+        # журнал ссылается на старый опрос — нужен весь снимок
+        tail_keys = {(row.chat_id, row.message_id) for row in reader.index[eager:]}
+        if any(r.get("op") != "create" and _key(r["chat_id"], r["message_id"]) in tail_keys for r in records):
+            eager = len(reader)
+
+        if eager < len(reader):
+            self._tail = (reader, eager)
+        logger.info("History snapshot %s: %d of %d entries loaded eagerly", path, eager, len(reader))
+        return reader.read(range(eager))
+
+    def _recover_snapshot(self, records: List[Dict[str, Any]]) -> tuple:
+        """
+        Основной снимок, а если он повреждён или отсутствует — новейшая из резервных копий,
+        которая проходит проверку. -> (история или None — ни одного снимка нет, записи журнала к ней).
+        К резервной копии .n добавляются свёрнутые после неё журналы .n ... .1 (от старых к новым).
+        """
+        candidates = [self.snapshot_path] + backup_paths(self.snapshot_path, SNAPSHOT_BACKUPS)
+        journals = backup_paths(self.journal_path, SNAPSHOT_BACKUPS)
+        found = False
+        for n, path in enumerate(candidates):
+            if not path.exists():
+                continue
+            found = True
+            older, missing = [], []
+            for journal in reversed(journals[:n]):
+                if journal.exists():
+                    older.extend(self._read_journal(journal))
+                else:
+                    missing.append(str(journal))
+            try:
+                history = self._read_snapshot(path, older + records)
+            except (OSError, ValueError, struct.error) as e:
+                logger.error("History snapshot %s is damaged: %s", path, e)
+                continue
+            if missing:
+                logger.error("Recovered history from backup snapshot %s, but rotated journals %s are missing: "
+                             "changes made between those compactions are lost", path, missing)
+            elif path != self.snapshot_path:
+                logger.warning("Recovered history from backup snapshot %s, replaying %d records of rotated journals",
+                               path, len(older))
+            return history, older + records
+        if found:
+            raise ValueError(f"No valid history snapshot among {[str(p) for p in candidates]}")
+        return None, records
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Читает снимок (или последнюю удачную копию) и проигрывает поверх него журнал."""
+        self.loaded = False
+        records = self._read_journal()
+        history: List[Dict[str, Any]] = []
+        recovered, records = self._recover_snapshot(records)
+        if recovered is not None:
+            history = recovered
+        elif self.legacy_json_path is not None and self.legacy_json_path.exists():
+            with open(self.legacy_json_path, "r", encoding="utf-8") as f:
+                history = [decode_entry(e) for e in json.load(f)]
+            logger.info("Read legacy JSON history %s, next compaction writes %s", self.legacy_json_path, self.snapshot_path)
+
+        index = {}
+        for entry in history:
+            try:
+                index[_key(entry["chat_id"], entry["message_id"])] = entry
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        for record in records:
+            apply_record(history, index, record)
+        self.journal_len = len(records)
+
+        if self.maxlen is not None and len(history) > self.maxlen:
+            self.load_tail_into(history)
+            self.archive_entries(history[self.maxlen:])
+            del history[self.maxlen:]
+
+        logger.info("Loaded history: %d entries, replayed %d journal records", len(history), self.journal_len)
+        self.history = history
+        self.reindex()
+        self.attendance.reset()
+        self.loaded = True
+        return history
+
+    def load_tail_into(self, history: List[Dict[str, Any]]):
+        """Дописывает в history неразобранный хвост бинарного снимка."""
+        # хвост меняет и compact() в потоке записи — читаем его только под блокировкой
+        with self._tail_lock:
+            if self._tail is None:
+                return
+            reader, start = self._tail
+            tail = reader.read(range(start, len(reader)))
+            self._tail = None
+        history.extend(tail)
+        if history is self.history:
+            for entry in tail:
+                # хвост старше всего, что уже в индексе: новейшие записи не перекрываем
+                try:
+                    self.index.setdefault(_key(entry["chat_id"], entry["message_id"]), entry)
+                except (KeyError, TypeError, ValueError):
+                    continue
+        logger.info("Loaded %d older history entries on demand", len(tail))
+
+    def load_all(self):
+        """Подгружает неразобранный хвост бинарного снимка в self.history."""
+        self.load_tail_into(self.history)
+        if self.maxlen is not None and len(self.history) > self.maxlen:
+            self.archive_entries(self.history[self.maxlen:])
+            self.unindex(self.history[self.maxlen:])
+            del self.history[self.maxlen:]
+
+    def _in_tail(self, match) -> bool:
+        """Есть ли в неразобранном хвосте строка индекса, для которой match(row) истинно."""
+        with self._tail_lock:
+            if self._tail is None:
+                return False
+            reader, start = self._tail
+            return any(match(row) for row in reader.index[start:])
+
+    def load_since(self, since: datetime):
+        since_ts = since.timestamp()
+        if self._in_tail(lambda row: row.expires_ts is None or row.expires_ts >= since_ts):
+            self.load_all()
+
+    def find(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        entry = super().find(chat_id, message_id)
+        if entry is None:
+            try:
+                key = _key(chat_id, message_id)
+            except (TypeError, ValueError):
+                return None
+            if self._in_tail(lambda row: (row.chat_id, row.message_id) == key):
+                self.load_all()
+                entry = super().find(chat_id, message_id)
+        return entry
+
+    def archive_entries(self, entries: List[Dict[str, Any]]):
+        if not entries:
+            return
+        if self.archive is None:
+            logger.info("Dropping %d history entries beyond maxlen (no archive configured)", len(entries))
+            return
+        self.archive.add(entries)
+
+    def archived(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+        if self.archive is None:
+            return iter(())
+        return self.archive.entries(since, until)
+
+    def find_archived(self, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+        return self.archive.find(chat_id, message_id) if self.archive is not None else None
+
+    # -----------------------------
+    # ЗАПИСЬ
+    # -----------------------------
+    def append(self, record: Dict[str, Any]):
+        """Дописывает одну запись в конец журнала."""
+        self.append_many([record])
+
+    def append_many(self, records: List[Dict[str, Any]]):
+        """
+        Дописывает пачку записей в конец журнала одной операцией записи.
+        Пачка ложится целиком или никак: при ошибке (нет места на диске) журнал обрезается до прежней длины,
+        иначе оборванная строка склеилась бы со следующей пачкой.
+        """
+        data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":"), default=json_default) + "\n"
+                       for r in records).encode("utf-8")
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            start = os.fstat(fd).st_size
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+            except OSError:
+                os.ftruncate(fd, start)
+                raise
+        finally:
+            os.close(fd)
+        self.journal_len += len(records)
+
+    def needs_compaction(self, pending: int = 0) -> bool:
+        return self.loaded and self.journal_len + pending >= self.compact_every
+
+    def compact(self, history: List[Dict[str, Any]]):
+        """Записывает полный снимок истории и начинает новый журнал (прежний уходит в .1 рядом с копией снимка)."""
+        if not self.loaded:
+            logger.warning("Skipping history compaction: history failed to load, snapshots and journals are kept as is")
+            return
+        with self._tail_lock:
+            entries = list(history)
+            tail_start = None
+            if self._tail is not None:
+                # старые записи, которые так и не разбирались, переносим в новый снимок
+                reader, start = self._tail
+                tail_start = len(entries)
+                entries.extend(reader.read(range(start, len(reader))))
+            if self.maxlen is not None and len(entries) > self.maxlen:
+                # сначала архив, потом снимок: при сбое между ними запись окажется в обоих местах,
+                # а повторный перенос в архив идемпотентен
+                self.archive_entries(entries[self.maxlen:])
+                del entries[self.maxlen:]
+
+            if self.binary:
+                data = history_snapshot.dumps(entries)
+            else:
+                data = json.dumps(entries, ensure_ascii=False, indent=2, default=json_default).encode("utf-8")
+            # временный файл + fsync + rename, прежний снимок уходит в .1;
+            # при сбое до очистки журнала он проиграется повторно — записи журнала идемпотентны
+            atomic_write(self.snapshot_path, lambda f: f.write(data), backups=SNAPSHOT_BACKUPS)
+            # журнал откладываем только после успешной записи снимка: .1 — записи между снимком .1 и новым,
+            # с ними резервная копия восстанавливается без потерь
+            rotate(self.journal_path, SNAPSHOT_BACKUPS)
+            with open(self.journal_path, "w", encoding="utf-8"):
+                pass
+            self.journal_len = 0
+
+            if tail_start is not None and tail_start < len(entries):
+                self._tail = (history_snapshot.SnapshotReader(self.snapshot_path), tail_start)
+            else:
+                self._tail = None
+        logger.info("Compacted history: %d entries -> %s", len(entries), self.snapshot_path)
+
+
+def open_history_store(backend: str, snapshot_path: Path, journal_path: Path, db_path: Path,
+                       maxlen: Optional[int] = None, legacy_json_path: Optional[Path] = None,
+                       archive_dir: Optional[Path] = None) -> HistoryStore:
+    """
+    Создаёт хранилище истории по имени бэкенда: "json" (снимок + журнал + архив) или "sqlite".
+    SQLite при первом запуске сам переносит данные из снимка, журнала и архива.
+    """
+    archive = HistoryArchive(archive_dir) if archive_dir is not None else None
+    if backend == "sqlite":
+        from .history_sqlite import SqliteHistoryStore
+        # при переносе в базу берём всю историю, без обрезки до maxlen
+        source = JournaledHistoryStore(snapshot_path, journal_path, legacy_json_path=legacy_json_path, archive=archive)
+        return SqliteHistoryStore(db_path, maxlen=maxlen, migrate_from=source)
+    if backend != "json":
+        logger.warning("Unknown history backend %r, falling back to json", backend)
+    return JournaledHistoryStore(snapshot_path, journal_path, maxlen=maxlen, legacy_json_path=legacy_json_path,
+                                 archive=archive)
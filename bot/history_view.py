@@ -0,0 +1,121 @@
+# history_view.py
+"""
+Неизменяемый снимок истории для фоновых задач (пул потоков, jobs.py).
+
+Копировать всю историю на каждый снимок не нужно: у записи лежит её замороженный вид
+    _frozen = MappingProxyType(копия полей, participants — кортеж)
+Он строится при первом снимке и сбрасывается в _history_changed (thaw) — при следующем
+снимке пересобираются только изменённые записи. Снимок — кортеж таких видов:
+его можно читать из другого потока, пока цикл бота правит историю.
+Старые записи (архив, база SQLite) в снимок не копируются: фоновая задача читает их сама.
+"""
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional
+
+from .entry_times import expires_ts, stamp, training_date
+from .participant import Participant
+
+FROZEN = "_frozen"
+
+# older(since, until) -> записи старше тех, что в памяти (since/until — только чтобы не читать лишнего)
+Older = Callable[[Optional[datetime], Optional[datetime]], Iterable[Dict[str, Any]]]
+
+
+def poll_key(entry: Mapping[str, Any]) -> Optional[tuple]:
+    try:
+        return int(entry["chat_id"]), int(entry["message_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def freeze(entry: Dict[str, Any]) -> Mapping[str, Any]:
+    """Замороженный вид записи (с разобранным expires_at); один на запись до её изменения."""
+    view = entry.get(FROZEN)
+    if view is None:
+        stamp(entry)
+        fields = {k: v for k, v in entry.items() if k != FROZEN}
+        fields["participants"] = tuple(entry.get("participants", ()))
+        view = entry[FROZEN] = MappingProxyType(fields)
+    return view
+
+
+def thaw(entry: Dict[str, Any]):
+    entry.pop(FROZEN, None)
+
+
+# -----------------------------
+# ПРОХОДЫ ПО ЗАПИСЯМ
+# -----------------------------
+def participation_rows(entries: Iterable[Mapping[str, Any]], uid: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Строки участия {uid, fullname, username, expires_at, date, command} в порядке записей."""
+    for entry in entries:
+        expires_at = entry.get("expires_at")
+        if not expires_at:
+            continue
+        command = entry.get("command", "")
+        day = training_date(entry)
+        for p in entry.get("participants", []):
+            if uid is not None and p.uid != uid:
+                continue
+            yield {
+                "uid": p.uid,
+                "fullname": p.fullname,
+                "username": p.username,
+                "expires_at": expires_at,
+                "date": day,
+                "command": command,
+            }
+
+
+class HistorySnapshot:
+    """
+    Снимок истории (новейшие первыми) с теми же запросами, что у хранилища.
+    recent — записи в памяти бота: замораживаются при создании снимка, в цикле бота.
+    older(since, until) — более старые записи (архив, база): читаются при запросе, уже в фоновой задаче;
+    запись, которая есть и в recent (ушла в архив после снимка), берётся из recent.
+    """
+
+    def __init__(self, recent: Iterable[Dict[str, Any]], older: Optional[Older] = None):
+        self.recent = tuple(freeze(e) for e in recent)
+        self.older = older
+
+    def entries(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[Mapping[str, Any]]:
+        """Все записи снимка; since/until только сужают чтение старых записей, не фильтруют."""
+        yield from self.recent
+        if self.older is None:
+            return
+        keys = {poll_key(e) for e in self.recent}
+        for entry in self.older(since, until):
+            if poll_key(entry) not in keys:
+                # записи архива и базы уже разобраны и никем не правятся — копия не нужна
+                yield MappingProxyType(entry)
+
+    def closed_polls(self, since, until, command: Optional[str] = None) -> Iterator[Mapping[str, Any]]:
+        since_ts, until_ts = since.timestamp(), until.timestamp()
+        for entry in self.entries(since, until):
+            if entry.get("active", False):
+                continue
+            if command is not None and entry.get("command", "") != command:
+                continue
+            ts = expires_ts(entry)
+            if ts is None or ts < since_ts or ts > until_ts:
+                continue
+            yield entry
+
+    def participations(self, uid: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        return participation_rows(self.entries(), uid)
+
+    def unique_users(self) -> List[Participant]:
+        """
+        Уникальные участники, новейшие данные в приоритете;
+        если в новейшей записи нет username, а в более старой есть — берём её.
+        """
+        users: Dict[int, Participant] = {}
+        for entry in self.entries():
+            for p in entry.get("participants", []):
+                if not p.uid:
+                    continue
+                if p.uid not in users or (p.username and not users[p.uid].username):
+                    users[p.uid] = p
+        return list(users.values())
@@ -0,0 +1,126 @@
+# history_writer.py
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from .entry_times import PRIVATE_PREFIX
+from .history_store import HistoryStore
+from .participant import Participant
+
+logger = logging.getLogger(__name__)
+
+
+def _detach(value):
+    """
+    Копия записи в JSON-виде (Participant -> dict, без полей только для памяти):
+    её сериализует другой поток, пока обработчики меняют исходные объекты.
+    """
+    if isinstance(value, dict):
+        return {k: _detach(v) for k, v in value.items() if not k.startswith(PRIVATE_PREFIX)}
+    if isinstance(value, list):
+        return [_detach(v) for v in value]
+    if isinstance(value, Participant):
+        return value.to_json()
+    return value
+
+
+class HistoryWriter:
+    """
+    Фоновая запись истории опросов.
+    Обработчики только кладут изменения в очередь (submit) и сразу возвращаются;
+    фоновая задача собирает всё, что пришло за окно window секунд, и пишет одной
+    пачкой в отдельном потоке. Сериализация и файловый ввод-вывод не блокируют event loop.
+    """
+
+    def __init__(self, store: HistoryStore, snapshot: Callable[[], List[Dict[str, Any]]], window: float = 0.5):
+        self.store = store
+        # snapshot() вызывается в event loop и возвращает копию истории для свёртки
+        self.snapshot = snapshot
+        self.window = window
+        self._pending: List[Dict[str, Any]] = []
+        self._archive: List[Dict[str, Any]] = []
+        self._compact = False
+        self._dirty = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, record: Dict[str, Any]):
+        """Ставит запись журнала в очередь на запись."""
+        self._pending.append(_detach(record))
+        self._dirty.set()
+
+    def archive(self, entries: List[Dict[str, Any]]):
+        """Ставит в очередь записи, вытесненные из памяти, для переноса в архив."""
+        self._archive.extend(_detach(e) for e in entries)
+        self._dirty.set()
+
+    def request_compaction(self):
+        """Просит при ближайшей записи свернуть журнал в полный снимок."""
+        self._compact = True
+        self._dirty.set()
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        logger.info("History writer started (window=%.2fs)", self.window)
+        while True:
+            await self._dirty.wait()
+            # даём накопиться пачке голосов
+            await asyncio.sleep(self.window)
+            # shield: остановка задачи не должна обрывать уже начатую запись
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        """Записывает всё накопленное; безопасно вызывать в любой момент."""
+        async with self._flush_lock:
+            self._dirty.clear()
+            batch, self._pending = self._pending, []
+            archived, self._archive = self._archive, []
+            compact = self._compact or self.store.needs_compaction(pending=len(batch))
+            self._compact = False
+            if not batch and not archived and not compact:
+                return
+
+            entries = self.snapshot() if compact else None
+            done: Set[str] = set()
+            try:
+                await asyncio.to_thread(self._write, archived, batch, entries, done)
+            except Exception as e:
+                logger.exception("Failed to write history (written: %s; %d records pending), will retry: %s",
+                                 sorted(done) or "nothing", 0 if "journal" in done else len(batch), e)
+                # возвращаем в начало очереди только то, что не записано: порядок записей важен,
+                # а записанная пачка при повторе попала бы в журнал дважды
+                if "journal" not in done:
+                    self._pending[:0] = batch
+                if "archive" not in done:
+                    self._archive[:0] = archived
+                self._compact = self._compact or compact
+                self._dirty.set()
+
+    def _write(self, archived: List[Dict[str, Any]], batch: List[Dict[str, Any]],
+               entries: Optional[List[Dict[str, Any]]], done: Set[str]):
+        """Шаги записи по порядку; каждый целиком или никак, удавшиеся отмечаются в done."""
+        # архив — первым: вытесненные записи должны попасть туда до того, как их не станет в снимке
+        if archived:
+            self.store.archive_entries(archived)
+        done.add("archive")
+        if batch:
+            self.store.append_many(batch)
+        done.add("journal")
+        if entries is not None:
+            self.store.compact(entries)
+        done.add("compact")
+
+    async def close(self):
+        """Останавливает фоновую задачу и дописывает хвост очереди (при завершении бота)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        logger.info("History writer stopped")
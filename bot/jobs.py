@@ -0,0 +1,86 @@
+# jobs.py
+"""
+Пул потоков для тяжёлой работы команд (/stat, полный проход статистики),
+чтобы цикл бота успевал обрабатывать голоса, пока считается отчёт.
+
+Задача получает только неизменяемые данные (снимок истории, history_view) и ничего
+не меняет в состоянии бота. Очередь ограничена: сверх queue_limit задач сразу JobQueueFull.
+По каждому виду задачи — число запусков, ошибки, ожидание в очереди и время работы.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobStats:
+    __slots__ = ("count", "errors", "wait_total", "run_total", "run_max")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        n = self.count or 1
+        return {"count": self.count, "errors": self.errors,
+                "wait_avg_ms": round(self.wait_total / n * 1000, 1),
+                "run_avg_ms": round(self.run_total / n * 1000, 1),
+                "run_max_ms": round(self.run_max * 1000, 1)}
+
+
+class JobRunner:
+    def __init__(self, workers: int = 2, queue_limit: int = 8):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        # задачи в работе и в очереди
+        self.pending = 0
+        self.metrics: Dict[str, JobStats] = {}
+
+    async def run(self, name: str, fn: Callable[..., Any], *args) -> Any:
+        """Выполняет fn(*args) в пуле; JobQueueFull, если очередь уже полна."""
+        if self.pending >= self.queue_limit:
+            logger.warning("Job %s rejected: %d jobs pending", name, self.pending)
+            raise JobQueueFull(name)
+        stats = self.metrics.setdefault(name, JobStats())
+        queued = time.perf_counter()
+        timing = {}
+
+        def timed():
+            started = time.perf_counter()
+            timing["wait"] = started - queued
+            try:
+                return fn(*args)
+            finally:
+                timing["run"] = time.perf_counter() - started
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            self.pending -= 1
+            stats.count += 1
+            wait, run = timing.get("wait", 0.0), timing.get("run", 0.0)
+            stats.wait_total += wait
+            stats.run_total += run
+            stats.run_max = max(stats.run_max, run)
+            logger.info("Job %s: waited %.1f ms, ran %.1f ms (%d pending)", name, wait * 1000, run * 1000, self.pending)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: s.as_dict() for name, s in self.metrics.items()}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
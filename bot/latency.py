@@ -0,0 +1,56 @@
+# latency.py
+"""
+Гистограммы задержек пути голоса (от получения callback до ответа и до правки сообщения).
+
+Корзины фиксированные (BUCKETS_MS, верхние границы), последняя — всё, что дольше.
+Перцентили считаются по корзинам: значение — верхняя граница корзины, куда он попал (не больше максимума).
+"""
+import bisect
+import logging
+from typing import Any, Dict, Sequence
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# как часто писать в лог гистограмму (число замеров)
+LOG_EVERY = 500
+
+
+class LatencyHistogram:
+    def __init__(self, name: str, buckets_ms: Sequence[float] = BUCKETS_MS):
+        self.name = name
+        self.buckets_ms = tuple(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if self.count % LOG_EVERY == 0:
+            logger.info("Latency %s: %s", self.name, self.stats())
+
+    def percentile(self, p: float) -> float:
+        """Верхняя граница корзины p-го перцентиля, мс (не больше максимума)."""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                bound = self.buckets_ms[i] if i < len(self.buckets_ms) else self.max_ms
+                return round(min(bound, self.max_ms), 1)
+        return round(self.max_ms, 1)
+
+    def stats(self) -> Dict[str, Any]:
+        labels = [f"<={b}" for b in self.buckets_ms] + [f">{self.buckets_ms[-1]}"]
+        return {"count": self.count,
+                "avg_ms": round(self.total_ms / (self.count or 1), 1),
+                "p50_ms": self.percentile(50), "p95_ms": self.percentile(95), "p99_ms": self.percentile(99),
+                "max_ms": round(self.max_ms, 1),
+                "buckets": {label: n for label, n in zip(labels, self.counts) if n}}
@@ -0,0 +1,123 @@
+# leaderboard.py
+"""
+Таблица мест по числу тренировок с плотной нумерацией (dense ranking): 5, 5, 3 -> места 1, 1, 2.
+
+Дерево Фенвика по значениям total хранит, какие значения сейчас заняты:
+место участника — число занятых значений больше его total плюс один,
+граница топ-N — N-е по убыванию занятое значение. Оба запроса и обновление — O(log max_total);
+участники с одинаковым total лежат в одной корзине.
+"""
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+
+class Leaderboard:
+    def __init__(self, capacity: int = 64):
+        self._totals: Dict[int, int] = {}
+        self._buckets: Dict[int, Set[int]] = {}
+        self._size = 1
+        while self._size < capacity:
+            self._size *= 2
+        self._tree = [0] * (self._size + 1)
+        self._distinct = 0
+
+    # -----------------------------
+    # ДЕРЕВО ФЕНВИКА
+    # -----------------------------
+    def _add(self, total: int, delta: int):
+        i = total
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, total: int) -> int:
+        """Сколько занятых значений <= total."""
+        s, i = 0, min(total, self._size)
+        while i > 0:
+            s += self._tree[i]
+            i -= i & -i
+        return s
+
+    def _kth(self, k: int) -> int:
+        """k-е по возрастанию занятое значение (1 <= k <= distinct)."""
+        pos, step = 0, self._size
+        while step:
+            nxt = pos + step
+            if nxt <= self._size and self._tree[nxt] < k:
+                pos = nxt
+                k -= self._tree[nxt]
+            step //= 2
+        return pos + 1
+
+    def _grow(self, total: int):
+        size = self._size
+        while size < total:
+            size *= 2
+        values = [t for t in self._buckets]
+        self._size = size
+        self._tree = [0] * (size + 1)
+        for t in values:
+            self._add(t, 1)
+
+    # -----------------------------
+    # ОБНОВЛЕНИЕ И ЗАПРОСЫ
+    # -----------------------------
+    def set(self, uid: int, total: int):
+        """Новое число тренировок участника; 0 — убрать из таблицы."""
+        old = self._totals.get(uid, 0)
+        if old == total:
+            return
+        if old:
+            bucket = self._buckets[old]
+            bucket.discard(uid)
+            if not bucket:
+                del self._buckets[old]
+                self._add(old, -1)
+                self._distinct -= 1
+            del self._totals[uid]
+        if total > 0:
+            if total > self._size:
+                self._grow(total)
+            self._totals[uid] = total
+            bucket = self._buckets.get(total)
+            if bucket is None:
+                bucket = self._buckets[total] = set()
+                self._add(total, 1)
+                self._distinct += 1
+            bucket.add(uid)
+
+    def total(self, uid: int) -> int:
+        return self._totals.get(uid, 0)
+
+    def place(self, uid: int) -> Optional[int]:
+        total = self._totals.get(uid)
+        if total is None:
+            return None
+        return self._distinct - self._prefix(total) + 1
+
+    def levels(self, top_n: int) -> Iterator[Tuple[int, int, Set[int]]]:
+        """(место, total, участники) для мест 1..top_n, от первого места вниз."""
+        for place in range(1, min(top_n, self._distinct) + 1):
+            total = self._kth(self._distinct - place + 1)
+            yield place, total, self._buckets[total]
+
+    def copy(self) -> "Leaderboard":
+        """Независимая копия таблицы — O(участников), без сортировки."""
+        other = Leaderboard.__new__(Leaderboard)
+        other._totals = dict(self._totals)
+        other._buckets = {total: set(uids) for total, uids in self._buckets.items()}
+        other._size = self._size
+        other._tree = list(self._tree)
+        other._distinct = self._distinct
+        return other
+
+    def clear(self):
+        self._totals.clear()
+        self._buckets.clear()
+        self._tree = [0] * (self._size + 1)
+        self._distinct = 0
+
+    def __len__(self) -> int:
+        return len(self._totals)
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._totals
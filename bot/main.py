@@ -5,7 +5,7 @@ import logging
 from datetime import datetime, timedelta, time, date, timezone
 from dateutil import parser
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Collection, Iterable
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -13,11 +13,21 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, C
 from aiogram.exceptions import TelegramBadRequest
 from .weatherapi_async import WeatherAPI
 import os
-from .config import BOT_TOKEN, ADMIN_IDS, WEATHERAPI_KEY, LOCAL_TZ, LAT, LON, DATA_DIR, SETTINGS_PATH, HISTORY_PATH
+from .config import BOT_TOKEN, ADMIN_IDS, WEATHERAPI_KEY, LOCAL_TZ, LAT, LON, DATA_DIR, SETTINGS_PATH, HISTORY_PATH, HISTORY_BIN_PATH, HISTORY_JOURNAL_PATH, HISTORY_DB_PATH, HISTORY_ARCHIVE_DIR, HISTORY_BACKEND, HISTORY_SNAPSHOT_FORMAT, HISTORY_FLUSH_WINDOW, STATS_VERIFY, STATS_BACKEND, STAT_CSV_COMPRESSION, JOB_WORKERS, JOB_QUEUE_LIMIT, POLL_EDIT_DEBOUNCE, TG_GLOBAL_RATE, TG_GROUP_RATE, TG_PRIVATE_RATE, TG_CHAT_BURST
 from .weather_auto import load_weather_messages, send_weather, weather_updater
+from .history_store import open_history_store
+from .history_writer import HistoryWriter
+from .participant import Participant
+from .entry_times import date_window, expires_ts, local_bounds, public_fields, set_local_tz, stamp, stamp_all
+from .attendance_stats import FAR_FUTURE, AttendanceAggregator, AttendanceDays, AttendanceSummary, compare_reports, scan_attendance
+from .stat_export import EXTENSIONS, SpooledInputFile, export_csv
+from .history_view import thaw
+from .jobs import JobQueueFull, JobRunner
+from .render_cache import RenderCache
+from .poll_render import PollRenderQueue
+from .latency import LatencyHistogram
+from .tg_scheduler import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, SchedulerClosed, Superseded, TelegramScheduler
 
-import csv
-import io
 from datetime import datetime
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
@@ -29,27 +39,101 @@ from urllib.parse import urlparse
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# дата тренировки в записях истории — по местному времени
+set_local_tz(LOCAL_TZ)
+
 edit_sessions = {}  # {admin_id: session_data}
 edit_waiting_for_link = {}  # {admin_id: True/False}
 
 weather_client = WeatherAPI(api_key=WEATHERAPI_KEY, lat=LAT, lon=LON, cache_ttl=300)
 
-with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
-    SETTINGS = json.load(f)
+# растёт при каждой загрузке настроек: по ней кэшируются ответы /schedule и /help
+settings_version = 0
+
+
+def load_settings():
+    global SETTINGS, settings_version
+    with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+        SETTINGS = json.load(f)
+    settings_version += 1
+
+
+load_settings()
+
+# Готовые ответы команд только для чтения (/top_*, /schedule, /help)
+render_cache = RenderCache()
+
+# Тяжёлая работа команд (/stat, полный проход статистики) — в пуле потоков над снимком истории
+jobs = JobRunner(JOB_WORKERS, JOB_QUEUE_LIMIT)
+JOBS_BUSY_TEXT = "Бот занят подготовкой других отчётов, попробуйте через минуту."
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# Все исходящие правки, отправки и закрепления из опросов, таймеров и погоды — через очередь с лимитами Telegram
+telegram = TelegramScheduler(TG_GLOBAL_RATE, TG_GROUP_RATE, TG_PRIVATE_RATE, TG_CHAT_BURST)
+# сколько (сек) при остановке ждать перерисовку опросов и затем очередь Telegram
+SHUTDOWN_TIMEOUT = 10
+
 # В памяти — активный опрос на каждом чате (поддерживается не больше одного активного опроса глобально)
-# active_poll: { chat_id: { "command": str, "message_id": int, "expires_at": datetime, "pinned": bool, "unpin": bool, "participants": [ (uid, username, fullname), ... ] } }
+# active_poll: { chat_id: { "command": str, "message_id": int, "expires_at": datetime, "pinned": bool, "unpin": bool, "participants": { uid: Participant, ... } } }
+# participants — словарь в порядке записи: проверка, запись и выход за O(1), порядок для отображения сохраняется
 active_poll: Dict[int, Dict[str, Any]] = {}
 
+# Замок опроса на чат: голоса, правки админа и закрытие меняют участников строго по очереди
+# (asyncio.Lock будит ждущих в порядке прихода). Обработчики aiogram идут параллельно задачами —
+# разные чаты друг друга не ждут. Восстановление из истории (load_history) идёт до запуска обработчиков.
+poll_locks: Dict[int, asyncio.Lock] = {}
+
+
+def poll_lock(chat_id: int) -> asyncio.Lock:
+    lock = poll_locks.get(chat_id)
+    if lock is None:
+        lock = poll_locks[chat_id] = asyncio.Lock()
+    return lock
+
 # Для предотвращения повторного автозапуска одного и того же расписания в один день
 last_autocreate: Dict[tuple, date] = {}
 last_autodeactivate = {}
 # История — список последних опросов (новейшие в начале)
 history: List[Dict[str, Any]] = []
 
+MAXLEN_HISTORY = 1000
+# Хранилище истории: JSON-снимок + журнал изменений (каждый голос — одна строка) или SQLite.
+# В обоих случаях history — это последние MAXLEN_HISTORY опросов в памяти; более старые
+# лежат в помесячном архиве (или в базе), а запросы по истории (поиск, статистика, выгрузка)
+# идут через history_store и видят всю историю.
+HISTORY_SNAPSHOT_PATH = HISTORY_BIN_PATH if HISTORY_SNAPSHOT_FORMAT == "binary" else HISTORY_PATH
+history_store = open_history_store(HISTORY_BACKEND, HISTORY_SNAPSHOT_PATH, HISTORY_JOURNAL_PATH, HISTORY_DB_PATH,
+                                   maxlen=MAXLEN_HISTORY, legacy_json_path=HISTORY_PATH,
+                                   archive_dir=HISTORY_ARCHIVE_DIR)
+
+# Сборки индексов по всей истории — в пуле задач по снимку; одна сборка на индекс, повторные запросы ждут её
+index_builds: Dict[str, asyncio.Task] = {}
+
+
+async def _build_index(name: str, engine):
+    fresh = engine.start()
+    snapshot = history_store.snapshot()
+    await jobs.run(name, lambda: fresh.build(snapshot.entries()))
+    engine.adopt(fresh)
+    return engine if engine.built else fresh
+
+
+async def built_index(name: str, engine):
+    """
+    Собранный индекс: engine, а если он ещё не собран — сборка по снимку истории в пуле задач
+    (start/build/adopt: изменения за время сборки доигрываются в цикле бота). Если engine сбросили,
+    пока шла сборка, отдаётся собранная копия. JobQueueFull — пул задач занят.
+    """
+    if engine.built:
+        return engine
+    task = index_builds.get(name)
+    if task is None:
+        task = index_builds[name] = asyncio.create_task(_build_index(name, engine))
+        task.add_done_callback(lambda _: index_builds.pop(name, None))
+    return await asyncio.shield(task)
+
 
 def build_poll_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру для опроса"""
@@ -74,20 +158,26 @@ def user_display_name(user: types.User) -> str:
     return f"{user.full_name}"
 
 
-def _serialize_participants(participants: List[tuple]) -> List[Dict[str, Any]]:
-    return [{"uid": p[0], "username": p[1], "fullname": p[2]} for p in participants]
-
-
-def _deserialize_participants(data: List[Dict[str, Any]]) -> List[tuple]:
-    return [(d["uid"], d.get("username"), d.get("fullname")) for d in data]
+def _participants_map(participants: Iterable[Participant]) -> Dict[int, Participant]:
+    """Участники активного опроса: uid -> Participant в порядке записи."""
+    return {p.uid: p for p in participants}
 
 
 def load_history():
     global history, active_poll
-    if HISTORY_PATH.exists():
+    # счётчики статистики соберутся заново по загруженной истории при первом запросе
+    attendance_stats.reset()
+    attendance_days.reset()
+    if attendance_matrix is not None:
+        attendance_matrix.invalidate()
+    if any(p.exists() for p in (HISTORY_PATH, HISTORY_BIN_PATH, HISTORY_JOURNAL_PATH, HISTORY_DB_PATH)):
+        loaded = False
         try:
-            with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-                history = json.load(f)
+            history = history_store.load()
+            loaded = True
+            # Сворачиваем проигранный журнал в свежий снимок
+            if history_store.journal_len:
+                save_history()
 
             # Найдём активные записи и восстановим последнюю активную
             active_entries = [h for h in history if h.get("active")]
@@ -118,7 +208,7 @@ def load_history():
                     "expires_at": expires_at,
                     "pinned": bool(entry.get("pinned", False)),
                     "unpin": bool(entry.get("unpin", False)),
-                    "participants": _deserialize_participants(entry.get("participants", [])),
+                    "participants": _participants_map(entry.get("participants", [])),
                     "weather_sent_on_publish": bool(entry.get("weather_sent_on_publish", False)),
                     "weather_sent_on_expiry": bool(entry.get("weather_sent_on_expiry", False)) 
                 }
@@ -132,31 +222,77 @@ def load_history():
 
         except Exception as e:
             logger.exception("Failed to load history: %s", e)
-            history = []
             active_poll.clear()
+            if not loaded:
+                # работаем с пустой историей; хранилище не свернёт её поверх уцелевших снимков и журналов
+                history = []
+                history_store.history = history
+                history_store.reindex()
     else:
-        history = []
+        history = history_store.load()
         active_poll.clear()
+    # expires_at разбираем один раз при загрузке, дальше — только при изменении записи
+    stamp_all(history)
+
+def _history_snapshot() -> List[Dict[str, Any]]:
+    # копируем записи и списки участников: снимок сериализуется в другом потоке
+    # поля только для памяти (разобранное время) на диск не пишем
+    return [{**public_fields(h), "participants": list(h.get("participants", []))} for h in history[:MAXLEN_HISTORY]]
+
+
+# Запись истории идёт в фоне: изменения за окно HISTORY_FLUSH_WINDOW пишутся одной пачкой в потоке
+history_writer = HistoryWriter(history_store, _history_snapshot, window=HISTORY_FLUSH_WINDOW)
+
 
-MAXLEN_HISTORY = 1000
 def save_history():
-    try:
-        with open(HISTORY_PATH, "w", encoding="utf-8") as f:
-            json.dump(history[:MAXLEN_HISTORY], f, ensure_ascii=False, indent=2)
-        logger.info("Saved history: %d entries -> %s", len(history[:MAXLEN_HISTORY]), HISTORY_PATH)
-    except Exception as e:
-        logger.exception("Failed to save history: %s", e)
+    """
+    Свёртка журнала: полностью переписывает снимок истории и очищает журнал (в фоне).
+    """
+    history_writer.request_compaction()
+
+
+def _journal_history(record: Dict[str, Any]):
+    """
+    Ставит изменение истории в очередь фоновой записи; обработчик не ждёт диска.
+    """
+    history_writer.submit(record)
+
+
+# растёт при изменении закрытых опросов (закрытие, правка админом): входит в ключ кэша ответов
+history_version = 0
+
+
+def _history_changed(entry: Dict[str, Any]):
+    """
+    Запись истории изменилась (новый опрос, голос, закрытие, правка админом) — обновляем индексы статистики.
+    """
+    global history_version
+    thaw(entry)
+    stamp(entry)
+    # голоса в активном опросе на статистику не влияют — версию двигают только закрытые опросы
+    if not entry.get("active", False):
+        history_version += 1
+    history_store.refresh_attendance(entry)
+    attendance_stats.refresh(entry)
+    attendance_days.refresh(entry)
+    if attendance_matrix is not None:
+        attendance_matrix.refresh(entry)
 
 
 def add_history_entry(entry: Dict[str, Any]):
     """
-    Добавляет новую запись в историю (в начало списка), держит максимум  MAXLEN_HISTORY  элементов.
+    Добавляет новую запись в историю (в начало списка), держит в памяти максимум MAXLEN_HISTORY элементов;
+    вытесненные записи уходят в архив.
     """
     history.insert(0, entry)
+    history_store.index_entry(entry)
+    _history_changed(entry)
     # Обрезаем до   MAXLEN_HISTORY элементов
     if len(history) > MAXLEN_HISTORY:
+        history_writer.archive(history[MAXLEN_HISTORY:])
+        history_store.unindex(history[MAXLEN_HISTORY:])
         del history[MAXLEN_HISTORY:]
-    save_history()
+    _journal_history({"op": "create", "entry": entry})
 
 
 def update_history_entry(chat_id: int, message_id: int, **updates):
@@ -164,29 +300,65 @@ def update_history_entry(chat_id: int, message_id: int, **updates):
     Находит запись по chat_id и message_id и обновляет её полями updates.
     Если не найдено — логируем предупреждение.
     """
-    found = False
-    for h in history:
-        try:
-            if int(h.get("chat_id")) == int(chat_id) and int(h.get("message_id")) == int(message_id):
-                h.update(updates)
-                found = True
-                break
-        except Exception:
-            # если в данных что-то необычное — пропускаем запись
-            continue
-
-    if found:
-        save_history()
+    h = history_store.find(chat_id, message_id)
+    if h is not None:
+        h.update(updates)
+        _history_changed(h)
+        _journal_history({"op": "update", "chat_id": int(chat_id), "message_id": int(message_id), "set": updates})
         logger.info("Updated history entry: chat=%s message=%s updates=%s", chat_id, message_id, list(updates.keys()))
     else:
-        logger.warning("History entry not found for update: chat=%s message=%s updates=%s", chat_id, message_id, updates)
+        h = history_store.find_archived(chat_id, message_id)
+        if h is not None:
+            # правка старого опроса из архива — переписываем его сегмент
+            h.update(updates)
+            _history_changed(h)
+            history_writer.archive([h])
+            logger.info("Updated archived history entry: chat=%s message=%s updates=%s", chat_id, message_id, list(updates.keys()))
+        else:
+            logger.warning("History entry not found for update: chat=%s message=%s updates=%s", chat_id, message_id, updates)
+
+
+def add_history_participant(chat_id: int, message_id: int, participant: Participant, checked: bool = False):
+    """
+    Голос "Участвую": добавляет участника в запись истории и пишет в журнал одну строку.
+    checked — повтор уже исключён по словарю участников открытого опроса (apply_vote): список не просматриваем.
+    """
+    h = history_store.find(chat_id, message_id)
+    if h is None:
+        logger.warning("History entry not found for join: chat=%s message=%s", chat_id, message_id)
+        return
+    participants = h.setdefault("participants", [])
+    if checked or not any(x.uid == participant.uid for x in participants):
+        participants.append(participant)
+    _history_changed(h)
+    _journal_history({"op": "join", "chat_id": int(chat_id), "message_id": int(message_id), "p": participant})
+
+
+def remove_history_participant(chat_id: int, message_id: int, uid: int, participant: Optional[Participant] = None):
+    """
+    Голос "Пас": убирает участника из записи истории и пишет в журнал одну строку.
+    participant — тот же объект, что в словаре открытого опроса: удаляется из списка на месте, без пересборки.
+    """
+    h = history_store.find(chat_id, message_id)
+    if h is None:
+        logger.warning("History entry not found for leave: chat=%s message=%s", chat_id, message_id)
+        return
+    participants = h.setdefault("participants", [])
+    try:
+        if participant is None:
+            raise ValueError(uid)
+        participants.remove(participant)
+    except ValueError:
+        h["participants"] = [x for x in participants if x.uid != uid]
+    _history_changed(h)
+    _journal_history({"op": "leave", "chat_id": int(chat_id), "message_id": int(message_id), "uid": uid})
 
 
-def format_participant_line(idx: int, participant: tuple) -> str:
+def format_participant_line(idx: int, participant: Participant) -> str:
     """
     Форматирует строку участника для отображения в опросе
     """
-    uid, username, fullname = participant
+    uid, username, fullname = participant.uid, participant.username, participant.fullname
     fullname_escaped = html.escape(fullname)
     
     # Специальная обработка для определенного пользователя
@@ -198,7 +370,7 @@ def format_participant_line(idx: int, participant: tuple) -> str:
     return f"{idx:2d}. {username_display} - {fullname_escaped}"
 
 
-def build_participants_section(participants: List[tuple], empty_message: str) -> List[str]:
+def build_participants_section(participants: Collection[Participant], empty_message: str) -> List[str]:
     """
     Формирует секцию с участниками для опроса
     """
@@ -215,7 +387,7 @@ def build_participants_section(participants: List[tuple], empty_message: str) ->
 
 
 
-def build_poll_text_with_timer(question: str, participants: List[tuple], expires_at: datetime) -> str:
+def build_poll_text_with_timer(question: str, participants: Collection[Participant], expires_at: datetime) -> str:
     """
     Формирует текст опроса с правильным форматированием
     """
@@ -254,42 +426,7 @@ async def active_poll_updater():
         try:
             for chat_id, info in list(active_poll.items()):
                 message_id = info["message_id"]
-                expires_at = info["expires_at"]
-                participants = info.get("participants", [])
-
-                cmd_settings = find_command_settings(chat_id, info["command"])
-                question = cmd_settings.get("question", info["command"]) if cmd_settings else info["command"]
-
-                text = build_poll_text_with_timer(question, participants, expires_at)
-
-                last_text = info.get("last_text")
-                if text != last_text:
-                    try:
-                        await bot.edit_message_text(
-                            chat_id=chat_id, 
-                            message_id=message_id, 
-                            text=text,
-                            reply_markup=build_poll_keyboard(),
-                            parse_mode="HTML"
-                        )
-                        info["last_text"] = text
-                    except TelegramBadRequest as e:
-                        if "message is not modified" in str(e):
-                            pass
-                        elif "message to edit not found" in str(e):
-                            logger.warning(f"Message not found in updater: chat_id={chat_id}, message_id={message_id}")
-                            if chat_id in active_poll:
-                                del active_poll[chat_id]
-                        elif "query is too old" in str(e):
-                            logger.warning(f"Old callback query during updater: {e}")
-                        else:
-                            logger.warning(
-                                "Failed to update poll message with timer chat=%s message=%s: %s",
-                                chat_id, message_id, e
-                            )
-                LAG=90 #  запас до закрытия 
-                now_utc = datetime.now(timezone.utc)
-                remaining = expires_at - timedelta(minutes=LAG) - now_utc
+                poll_renders.submit(chat_id, message_id, active_poll_render(chat_id, message_id), PRIORITY_LOW)
         except Exception as e:
             logger.exception("Error in active_poll_updater: %s", e)
 
@@ -298,37 +435,75 @@ async def active_poll_updater():
 
 
 
-async def edit_poll_message(chat_id, message_id, question, participants, expires_at):
-    if chat_id not in active_poll:
-        return
-        
-    text = build_poll_text_with_timer(question, participants, expires_at)
-    last_text = active_poll[chat_id].get("last_text")
-    if text == last_text:
-        return
-        
+async def send_poll_edit(chat_id: int, message_id: int, text: str, reply_markup, priority: int) -> Optional[bool]:
+    """
+    Правка сообщения опроса; вызывается только из poll_renders — не больше одной правки на сообщение.
+    None — правку сняли в очереди telegram ради более важной.
+    """
     try:
-        await bot.edit_message_text(
-            chat_id=chat_id, 
-            message_id=message_id, 
+        await telegram.call(
+            chat_id,
+            bot.edit_message_text,
+            chat_id=chat_id,
+            message_id=message_id,
             text=text,
-            reply_markup=build_poll_keyboard(),
-            parse_mode="HTML"
+            reply_markup=reply_markup,
+            parse_mode="HTML",
+            priority=priority,
+            key=("edit", chat_id, message_id)
         )
-        active_poll[chat_id]["last_text"] = text
+        return True
+    except Superseded:
+        return None
+    except SchedulerClosed:
+        # бот останавливается — повторять правку некому
+        return False
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
-            pass
+            return True
         elif "message to edit not found" in str(e):
-            logger.warning(f"Message not found in edit_poll_message: chat_id={chat_id}, message_id={message_id}")
-            if chat_id in active_poll:
+            logger.warning(f"Message not found: chat_id={chat_id}, message_id={message_id}")
+            info = active_poll.get(chat_id)
+            if info and info["message_id"] == message_id:
                 del active_poll[chat_id]
-        elif "query is too old" in str(e):
-            logger.warning(f"Old callback query during message edit: {e}")
         else:
             logger.warning(
                 "Failed to edit poll message chat=%s message=%s: %s", chat_id, message_id, e
             )
+        return False
+
+
+# Перерисовка опросов: голоса, таймер и правки админа за окно POLL_EDIT_DEBOUNCE — одной правкой
+poll_renders = PollRenderQueue(
+    send_poll_edit, delay=POLL_EDIT_DEBOUNCE,
+    supersede=lambda key, priority: telegram.supersede(("edit",) + key, priority)
+)
+
+
+def active_poll_render(chat_id: int, message_id: int):
+    """
+    render() для poll_renders: текст активного опроса по его состоянию на момент правки.
+    """
+    def render():
+        info = active_poll.get(chat_id)
+        if not info or info["message_id"] != message_id:
+            return None
+        cmd_settings = find_command_settings(chat_id, info["command"])
+        question = cmd_settings.get("question", info["command"]) if cmd_settings else info["command"]
+        text = build_poll_text_with_timer(question, info.get("participants", {}).values(), info["expires_at"])
+        return text, build_poll_keyboard()
+    return render
+
+
+async def edit_poll_message(chat_id, message_id, question, participants, expires_at):
+    if chat_id not in active_poll:
+        return False
+    participants = list(participants)
+    return await poll_renders.submit(
+        chat_id, message_id,
+        lambda: (build_poll_text_with_timer(question, participants, expires_at), build_poll_keyboard()),
+        PRIORITY_HIGH
+    )
 
 
 
@@ -422,17 +597,21 @@ async def create_poll(chat_id: int, command_name: str, *, by_auto=False, schedul
     )
     
     # Отправляем сообщение с инлайн-клавиатурой
-    sent = await bot.send_message(
+    sent = await telegram.call(
+        chat_id,
+        bot.send_message,
         chat_id, 
         text, 
         reply_markup=build_poll_keyboard(),
-        parse_mode="HTML"  # Добавляем parse_mode
+        parse_mode="HTML",  # Добавляем parse_mode
+        priority=PRIORITY_HIGH
     )
     message_id = sent.message_id
 
     if pin:
         try:
-            await bot.pin_chat_message(chat_id, message_id, disable_notification=True)
+            await telegram.call(chat_id, bot.pin_chat_message, chat_id, message_id, disable_notification=True,
+                                priority=PRIORITY_HIGH)
             pinned = True
         except Exception as e:
             logger.warning("Pin failed: %s", e)
@@ -444,7 +623,7 @@ async def create_poll(chat_id: int, command_name: str, *, by_auto=False, schedul
         "message_id": message_id,
         "expires_at": expires_at,
         "pinned": pinned,
-        "participants": [],
+        "participants": {},
         "unpin": unpin,
         "created_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
         "weather_sent_on_publish": False,
@@ -457,7 +636,7 @@ async def create_poll(chat_id: int, command_name: str, *, by_auto=False, schedul
         "chat_id": str(chat_id),
         "message_id": str(message_id),
         "command": command_name,
-        "participants": _serialize_participants([]),
+        "participants": [],
         "created_at": active_poll[chat_id]["created_at"],
         "expires_at": expires_at.isoformat() if expires_at else None,
         "active": True,
@@ -474,27 +653,36 @@ async def create_poll(chat_id: int, command_name: str, *, by_auto=False, schedul
 
 
 async def deactivate_poll(chat_id: int, reason="manual"):
-    info = active_poll.get(chat_id)
-    if not info:
-        logger.info("No active poll in chat %s to deactivate", chat_id)
-        return False
+    # Под замком — только снимок участников, снятие опроса из памяти и запись в историю:
+    # голоса за замком не ждут сети, а пришедшие после него видят опрос закрытым
+    async with poll_lock(chat_id):
+        info = active_poll.pop(chat_id, None)
+        if not info:
+            logger.info("No active poll in chat %s to deactivate", chat_id)
+            return False
+        message_id = info["message_id"]
+        participants = list(info.get("participants", {}).values())
+        update_history_entry(chat_id, message_id,
+                             active=False,
+                             pinned=bool(info.get("pinned", False)),
+                             participants=list(participants))
 
-    message_id = info["message_id"]
     pinned = info.get("pinned", False)
     unpin = info.get("unpin", False)
     unpin_success = False
 
     if pinned and unpin:
         try:
-            await bot.unpin_chat_message(chat_id=str(chat_id), message_id=message_id)
+            await telegram.call(chat_id, bot.unpin_chat_message, chat_id=str(chat_id), message_id=message_id,
+                                priority=PRIORITY_HIGH)
             unpin_success = True
             info["pinned"] = False
+            update_history_entry(chat_id, message_id, pinned=False)
             logger.info("Successfully unpinned message %s in chat %s", message_id, chat_id)
         except Exception as e:
             logger.warning("Unpin failed: %s", e)
 
     question = find_command_settings(chat_id, info["command"]).get("question", "Опрос завершён")
-    participants = info.get("participants", [])
     total = len(participants)
     
     # Экранируем для HTML
@@ -508,7 +696,7 @@ async def deactivate_poll(chat_id: int, reason="manual"):
     
     if participants:
         for idx, p in enumerate(participants, start=1):
-            uid, username, fullname = p
+            uid, username, fullname = p.uid, p.username, p.fullname
             fullname_escaped = html.escape(fullname)
             
             if username:
@@ -522,52 +710,15 @@ async def deactivate_poll(chat_id: int, reason="manual"):
 
     new_text = "\n".join(lines)
     
-    last_text = info.get("last_text")
-    if new_text != last_text:
-        try:
-            await bot.edit_message_text(
-                chat_id=str(chat_id), 
-                message_id=message_id, 
-                text=new_text,
-                reply_markup=None,
-                parse_mode="HTML"
-            )
-            info["last_text"] = new_text
-            edit_ok = True
-            logger.info(f"✅ Successfully edited poll message: chat={chat_id}, message={message_id}")
-        except TelegramBadRequest as e:
-            logger.error(f"❌ Failed to edit poll message: {e}")  # ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ
-            if "message is not modified" in str(e):
-                edit_ok = True
-            elif "message to edit not found" in str(e):
-                logger.warning(f"Message not found when closing poll: chat_id={chat_id}, message_id={message_id}")
-                edit_ok = False
-            elif "query is too old" in str(e):
-                logger.warning(f"Old callback query during deactivation: {e}")
-                edit_ok = False
-            else:
-                edit_ok = False
-                logger.warning(
-                    "Failed to edit message when closing poll chat=%s message=%s: %s", chat_id, message_id, e
-                )
-    else:
-        edit_ok = True
-
-    pinned_value = False if unpin_success else bool(info.get("pinned", False))
-    update_history_entry(chat_id, message_id,
-                         active=False,
-                         pinned=pinned_value,
-                         participants=_serialize_participants(participants))
-
-    logger.info("History updated for chat=%s message=%s active=False pinned=%s edit_ok=%s",
-                chat_id, message_id, pinned_value, edit_ok)
-
-    try:
-        del active_poll[chat_id]
-    except KeyError:
-        pass
-
-    logger.info("Deactivated poll in %s (%s). unpin_success=%s pinned_value=%s", chat_id, reason, unpin_success, pinned_value)
+    # закрытие перекрывает ещё не отправленные перерисовки и ждёт уже идущую правку
+    edit_ok = await poll_renders.flush(chat_id, message_id, lambda: (new_text, None), PRIORITY_HIGH)
+    poll_renders.forget(chat_id, message_id)
+    if edit_ok:
+        logger.info(f"✅ Successfully edited poll message: chat={chat_id}, message={message_id}")
+
+    pinned_value = bool(info.get("pinned", False))
+    logger.info("Deactivated poll in %s (%s). message=%s unpin_success=%s pinned_value=%s edit_ok=%s",
+                chat_id, reason, message_id, unpin_success, pinned_value, edit_ok)
     return True
 
 
@@ -609,32 +760,14 @@ def extract_ids_from_link(link: str) -> tuple[Optional[int], Optional[int]]:
 
 # Функция для поиска опроса в истории
 def find_poll_in_history(chat_id: int, message_id: int) -> Optional[dict]:
-    logger.debug(f"🔍 Searching in history: {len(history)} entries")
-    for idx, entry in enumerate(history):
-        entry_chat_id = int(entry.get("chat_id"))
-        entry_message_id = int(entry.get("message_id"))
-        logger.debug(f"  Entry {idx}: chat_id={entry_chat_id}, message_id={entry_message_id}")
-        
-        if entry_chat_id == chat_id and entry_message_id == message_id:
-            logger.debug(f"✅ Found match at index {idx}")
-            return entry
-    
-    logger.debug(f"❌ No match found for chat_id={chat_id}, message_id={message_id}")
-    return None
+    entry = history_store.find(chat_id, message_id) or history_store.find_archived(chat_id, message_id)
+    if entry is None:
+        logger.debug(f"❌ No match found for chat_id={chat_id}, message_id={message_id}")
+    return entry
 
-# Функция для получения уникальных пользователей из истории
-def get_unique_users_from_history() -> List[tuple]:
-    unique_users = {}
-    for entry in history:
-        for participant in entry.get("participants", []):
-            uid = participant.get("uid")
-            if uid and uid not in unique_users:
-                unique_users[uid] = (
-                    uid,
-                    participant.get("username"),
-                    participant.get("fullname", "")
-                )
-    return list(unique_users.values())
+# Функция для получения уникальных пользователей из истории (проход по снимку — в пуле задач; JobQueueFull — пул занят)
+async def get_unique_users_from_history() -> List[Participant]:
+    return await jobs.run("unique_users", history_store.snapshot().unique_users)
 
 # Функция для построения клавиатуры редактирования
 def build_edit_keyboard() -> InlineKeyboardMarkup:
@@ -650,9 +783,10 @@ def build_edit_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 # Функция для построения клавиатуры с пользователями для удаления
-def build_remove_user_keyboard(participants: List[tuple]) -> InlineKeyboardMarkup:
+def build_remove_user_keyboard(participants: List[Participant]) -> InlineKeyboardMarkup:
     keyboard = []
-    for uid, username, fullname in participants:
+    for p in participants:
+        uid, username, fullname = p.uid, p.username, p.fullname
         # Формируем текст кнопки: username + fullname, или только fullname если username нет
         if username and fullname:
             display_name = f"@{username} ({fullname})"
@@ -678,9 +812,10 @@ def build_remove_user_keyboard(participants: List[tuple]) -> InlineKeyboardMarku
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 # Функция для построения клавиатуры с пользователями для добавления
-def build_add_user_keyboard(available_users: List[tuple]) -> InlineKeyboardMarkup:
+def build_add_user_keyboard(available_users: List[Participant]) -> InlineKeyboardMarkup:
     keyboard = []
-    for uid, username, fullname in available_users:
+    for p in available_users:
+        uid, username, fullname = p.uid, p.username, p.fullname
         # Формируем текст кнопки: username + fullname, или только fullname если username нет
         if username and fullname:
             display_name = f"@{username} ({fullname})"
@@ -715,11 +850,14 @@ async def edit_session_timer(admin_id: int):
         
         if time_since_last_action.total_seconds() >= 60:
             try:
-                await bot.edit_message_text(
+                await telegram.call(
+                    admin_id,
+                    bot.edit_message_text,
                     chat_id=admin_id,
                     message_id=session["private_message_id"],
                     text="Сессия редактирования завершена по таймауту.",
-                    reply_markup=None
+                    reply_markup=None,
+                    priority=PRIORITY_NORMAL
                 )
             except TelegramBadRequest as e:
                 if "query is too old" in str(e) or "message to edit not found" in str(e):
@@ -736,55 +874,66 @@ def update_session_time(admin_id: int):
 
 
 
+def current_poll_participants(chat_id: int, message_id: int, poll_entry: dict) -> List[Participant]:
+    """
+    Текущий список участников опроса: у активного — из памяти, у закрытого — из записи истории.
+    Вызывать под poll_lock(chat_id).
+    """
+    info = active_poll.get(chat_id)
+    if info and info["message_id"] == message_id:
+        return list(info.get("participants", {}).values())
+    return list(poll_entry.get("participants", []))
+
+
+def apply_admin_participants(chat_id: int, message_id: int, poll_entry: dict, new_participants: List[Participant]):
+    """
+    Правка админа: новый список участников — в активный опрос (если он активен) и в историю, без await между ними.
+    Вызывать под poll_lock(chat_id).
+    """
+    poll_entry["participants"] = new_participants
+    info = active_poll.get(chat_id)
+    if info and info["message_id"] == message_id:
+        info["participants"] = _participants_map(new_participants)
+        logger.info(f"✅ Updated active poll in memory for chat {chat_id}")
+    update_history_entry(chat_id, message_id, participants=list(new_participants))
+
+
 # Функция для обновления сообщения опроса
-async def update_poll_message(chat_id: int, message_id: int, poll_entry: dict, participants: List[tuple]) -> bool:
-    try:
-        # Определяем, активен ли опрос
-        is_active = poll_entry.get("active", False)
-        command = poll_entry.get("command", "")
-        question = find_command_settings(chat_id, command).get("question", command) if find_command_settings(chat_id, command) else command
-        
-        if is_active:
-            # Активный опрос - используем формат с таймером
-            expires_at_str = poll_entry.get("expires_at")
-            if expires_at_str:
-                expires_at = datetime.fromisoformat(expires_at_str)
-            else:
-                expires_at = datetime.now(timezone.utc) + timedelta(hours=1)  # fallback
-            
-            text = build_poll_text_with_timer(question, participants, expires_at)
-            
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=text,
-                reply_markup=build_poll_keyboard(),
-                parse_mode="HTML"
-            )
+async def update_poll_message(chat_id: int, message_id: int, poll_entry: dict, participants: List[Participant]) -> bool:
+    # Определяем, активен ли опрос
+    is_active = poll_entry.get("active", False)
+    command = poll_entry.get("command", "")
+    question = find_command_settings(chat_id, command).get("question", command) if find_command_settings(chat_id, command) else command
+    participants = list(participants)
+
+    if is_active:
+        # Активный опрос - используем формат с таймером
+        ts = expires_ts(poll_entry)
+        if ts is not None:
+            expires_at = datetime.fromtimestamp(ts, timezone.utc)
         else:
-            # Закрытый опрос
-            text = build_closed_poll_text(question, participants)
-            
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=text,
-                parse_mode="HTML"
-            )
-        
-        return True
-        
-    except TelegramBadRequest as e:
-        if "message to edit not found" in str(e) or "message is not modified" in str(e):
-            return False
-        elif "query is too old" in str(e):
-            return False
+            expires_at = datetime.now(timezone.utc) + timedelta(hours=1)  # fallback
+
+        info = active_poll.get(chat_id)
+        if info and info["message_id"] == message_id:
+            # опрос в памяти — рисуем его последнее состояние (голоса после правки тоже попадут)
+            render = active_poll_render(chat_id, message_id)
         else:
-            logger.warning(f"Failed to update poll message during edit: {e}")
-            return False
+            def render():
+                return build_poll_text_with_timer(question, participants, expires_at), build_poll_keyboard()
+    else:
+        # Закрытый опрос
+        def render():
+            return build_closed_poll_text(question, participants), None
+
+    # через ту же очередь, что голоса и таймер: правка админа не пересекается с ними
+    success = await poll_renders.flush(chat_id, message_id, render, PRIORITY_HIGH)
+    if not is_active:
+        poll_renders.forget(chat_id, message_id)
+    return success
 
 # Функция для построения текста закрытого опроса
-def build_closed_poll_text(question: str, participants: List[tuple]) -> str:
+def build_closed_poll_text(question: str, participants: List[Participant]) -> str:
     total = len(participants)
     question_escaped = html.escape(question)
     
@@ -797,7 +946,7 @@ def build_closed_poll_text(question: str, participants: List[tuple]) -> str:
     return "\n".join(lines)
 
 
-def build_edit_poll_text(question: str, participants: List[tuple]) -> str:
+def build_edit_poll_text(question: str, participants: List[Participant]) -> str:
     """
     Формирует текст для интерфейса редактирования опроса
     """
@@ -821,6 +970,9 @@ def build_edit_poll_text(question: str, participants: List[tuple]) -> str:
 stat_waiting_username = {}
 # Добавим словарь для отслеживания последнего callback от пользователя
 user_last_callback = {}
+# Задержки голосов: от получения callback до ответа и до правки сообщения с этим голосом
+vote_answered = LatencyHistogram("vote answered")
+vote_updated = LatencyHistogram("vote message updated")
 
 
 
@@ -844,7 +996,7 @@ async def edit_callback_handler(callback: CallbackQuery):
     data = callback.data
     session = edit_sessions[admin_id]
     poll_entry = session["poll_entry"]
-    participants = _deserialize_participants(poll_entry.get("participants", []))
+    participants = poll_entry.get("participants", [])
 
     if data == "edit_finish":
         # Завершаем сессию
@@ -865,7 +1017,6 @@ async def edit_callback_handler(callback: CallbackQuery):
 
     elif data == "edit_back":
         # Возвращаемся к основному меню
-        participants = _deserialize_participants(poll_entry.get("participants", []))
         question = poll_entry.get("command", "Опрос")
         text = build_edit_poll_text(question, participants)
         
@@ -911,9 +1062,13 @@ async def edit_callback_handler(callback: CallbackQuery):
 
     elif data == "edit_add":
         # Показываем список пользователей для добавления
-        all_users = get_unique_users_from_history()
-        current_uids = [p[0] for p in participants]
-        available_users = [user for user in all_users if user[0] not in current_uids]
+        try:
+            all_users = await get_unique_users_from_history()
+        except JobQueueFull:
+            await callback.answer(JOBS_BUSY_TEXT, show_alert=True)
+            return
+        current_uids = {p.uid for p in participants}
+        available_users = [user for user in all_users if user.uid not in current_uids]
         
         if not available_users:
             try:
@@ -942,13 +1097,17 @@ async def edit_callback_handler(callback: CallbackQuery):
         # Удаляем пользователя
         uid = int(data.split("_")[2])
         
-        # Находим пользователя
-        user_to_remove = None
-        for user in participants:
-            if user[0] == uid:
-                user_to_remove = user
-                break
-        
+        chat_id = session["chat_id"]
+        message_id = session["message_id"]
+        async with poll_lock(chat_id):
+            # Находим пользователя (в текущем списке: голоса могли прийти после открытия сессии)
+            by_uid = _participants_map(current_poll_participants(chat_id, message_id, poll_entry))
+            user_to_remove = by_uid.pop(uid, None)
+            if user_to_remove:
+                # Удаляем пользователя из опроса: в памяти и в истории — вместе
+                new_participants = list(by_uid.values())
+                apply_admin_participants(chat_id, message_id, poll_entry, new_participants)
+
         if not user_to_remove:
             try:
                 await callback.answer("Пользователь не найден в опросе.", show_alert=True)
@@ -959,20 +1118,6 @@ async def edit_callback_handler(callback: CallbackQuery):
                     raise
             return
 
-        # Удаляем пользователя из опроса
-        new_participants = [p for p in participants if p[0] != uid]
-        poll_entry["participants"] = _serialize_participants(new_participants)
-        
-        # ОБНОВЛЯЕМ АКТИВНЫЙ ОПРОС В ПАМЯТИ (если он активен)
-        chat_id = session["chat_id"]
-        message_id = session["message_id"]
-        if chat_id in active_poll and active_poll[chat_id]["message_id"] == message_id:
-            active_poll[chat_id]["participants"] = new_participants
-            # Сбрасываем last_text, чтобы принудительно обновить сообщение
-            if "last_text" in active_poll[chat_id]:
-                del active_poll[chat_id]["last_text"]
-            logger.info(f"✅ Updated active poll in memory for chat {chat_id}")
-        
         # Обновляем сообщение в чате (если возможно)
         success = await update_poll_message(
             session["chat_id"], 
@@ -980,13 +1125,6 @@ async def edit_callback_handler(callback: CallbackQuery):
             poll_entry, 
             new_participants
         )
-        
-        # Обновляем историю
-        update_history_entry(
-            session["chat_id"], 
-            session["message_id"],
-            participants=_serialize_participants(new_participants)
-        )
     
             
         # Возвращаемся к основному меню
@@ -1024,9 +1162,13 @@ async def edit_callback_handler(callback: CallbackQuery):
         
         # Находим пользователя в истории
         user_to_add = None
-        all_users = get_unique_users_from_history()
+        try:
+            all_users = await get_unique_users_from_history()
+        except JobQueueFull:
+            await callback.answer(JOBS_BUSY_TEXT, show_alert=True)
+            return
         for user in all_users:
-            if user[0] == uid:
+            if user.uid == uid:
                 user_to_add = user
                 break
         
@@ -1040,20 +1182,27 @@ async def edit_callback_handler(callback: CallbackQuery):
                     raise
             return
 
-        # Добавляем пользователя в опрос
-        new_participants = participants + [user_to_add]
-        poll_entry["participants"] = _serialize_participants(new_participants)
-        
-        # ОБНОВЛЯЕМ АКТИВНЫЙ ОПРОС В ПАМЯТИ (если он активен)
+        # Добавляем пользователя в опрос: в памяти и в истории — вместе, по текущему списку
         chat_id = session["chat_id"]
         message_id = session["message_id"]
-        if chat_id in active_poll and active_poll[chat_id]["message_id"] == message_id:
-            active_poll[chat_id]["participants"] = new_participants
-            # Сбрасываем last_text, чтобы принудительно обновить сообщение
-            if "last_text" in active_poll[chat_id]:
-                del active_poll[chat_id]["last_text"]
-            logger.info(f"✅ Updated active poll in memory for chat {chat_id}")
-        
+        async with poll_lock(chat_id):
+            current = current_poll_participants(chat_id, message_id, poll_entry)
+            # пока админ выбирал, пользователь мог проголосовать сам — второй раз не добавляем
+            already = any(p.uid == user_to_add.uid for p in current)
+            if not already:
+                new_participants = current + [user_to_add]
+                apply_admin_participants(chat_id, message_id, poll_entry, new_participants)
+
+        if already:
+            try:
+                await callback.answer("Пользователь уже в опросе.", show_alert=True)
+            except TelegramBadRequest as e:
+                if "query is too old" in str(e):
+                    return
+                else:
+                    raise
+            return
+
         # Обновляем сообщение в чате (если возможно)
         success = await update_poll_message(
             session["chat_id"], 
@@ -1062,13 +1211,6 @@ async def edit_callback_handler(callback: CallbackQuery):
             new_participants
         )
         
-        # Обновляем историю
-        update_history_entry(
-            session["chat_id"], 
-            session["message_id"],
-            participants=_serialize_participants(new_participants)
-        )
-        
         # ... остальной код ...
         
         # Возвращаемся к основному меню
@@ -1140,9 +1282,50 @@ async def edit_cmd(message: Message):
         logger.error(f"❌ Failed to send link request to user {user_id}: {e}")
 
 
+def apply_vote(chat_id: int, info: Dict[str, Any], me: Participant, action: str) -> tuple[str, Optional[Participant]]:
+    """
+    Голос в активном опросе: участники в памяти и строка журнала (history_writer пишет её в фоне).
+    Вызывать под poll_lock(chat_id). -> (ответ пользователю, добавленный/убранный участник или None)
+    """
+    participants = info.setdefault("participants", {})
+    message_id = info["message_id"]
+    if action == "poll_join":
+        if me.uid in participants:
+            return "Вы уже в списке участников", None
+        participants[me.uid] = me
+        add_history_participant(chat_id, message_id, me, checked=True)
+        return "Вы добавлены в список участников", me
+    if me.uid not in participants:
+        return "Вас нет в списке участников", None
+    removed = participants.pop(me.uid)
+    remove_history_participant(chat_id, message_id, me.uid, removed)
+    return "Вы удалены из списка участников", removed
+
+
+def revert_vote(chat_id: int, info: Dict[str, Any], changed: Participant, action: str) -> bool:
+    """
+    Откат голоса, ответ на который не дошёл: только если после него список не меняли. Под poll_lock(chat_id).
+    """
+    participants = info.get("participants", {})
+    message_id = info["message_id"]
+    if action == "poll_join":
+        if participants.get(changed.uid) is not changed:
+            return False
+        participants.pop(changed.uid)
+        remove_history_participant(chat_id, message_id, changed.uid, changed)
+    else:
+        if changed.uid in participants:
+            return False
+        participants[changed.uid] = changed
+        add_history_participant(chat_id, message_id, changed, checked=True)
+    return True
+
+
 # Улучшенный обработчик инлайн-кнопок опроса
 @dp.callback_query(F.data.startswith("poll_"))
 async def poll_button_handler(callback: CallbackQuery):
+    loop = asyncio.get_running_loop()
+    received = loop.time()
     chat_id = callback.message.chat.id
     user = callback.from_user
     uid = user.id
@@ -1164,116 +1347,48 @@ async def poll_button_handler(callback: CallbackQuery):
     
     user_last_callback[uid] = current_time
     
-    # Проверяем, есть ли активный опрос
-    info = active_poll.get(chat_id)
-    if not info:
-        try:
-            await callback.answer("Опрос не активен", show_alert=True)
-        except TelegramBadRequest as e:
-            if "query is too old" in str(e):
-                return  # Игнорируем устаревшие запросы
-            else:
-                raise
+    if callback.data not in ("poll_join", "poll_leave"):
         return
-        
-    # Проверяем, не истек ли опрос
-    expires_at = info.get("expires_at")
-    if expires_at and datetime.now(timezone.utc) >= expires_at:
-        try:
-            await callback.answer("Опрос уже завершен", show_alert=True)
-        except TelegramBadRequest as e:
-            if "query is too old" in str(e):
-                return  # Игнорируем устаревшие запросы
-            else:
-                raise
-        return
-    
-    participants = info.get("participants", [])
-    user_in_list = any(p[0] == uid for p in participants)
-    changed = False
-    action_performed = False
-    
-    if callback.data == "poll_join":
-        if not user_in_list:
-            participants.append((uid, username, fullname))
-            changed = True
-            action_performed = True
-            try:
-                await callback.answer("Вы добавлены в список участников")
-            except TelegramBadRequest as e:
-                if "query is too old" in str(e):
-                    # Откатываем изменения, если запрос устарел
-                    participants.remove((uid, username, fullname))
-                    return
-                else:
-                    raise
+
+    # 1. Меняем состояние опроса и журнал — под замком опроса, без await внутри
+    me = Participant(uid, username, fullname)
+    changed = None
+    async with poll_lock(chat_id):
+        info = active_poll.get(chat_id)
+        expires_at = info.get("expires_at") if info else None
+        if not info:
+            reply, alert = "Опрос не активен", True
+        elif expires_at and datetime.now(timezone.utc) >= expires_at:
+            reply, alert = "Опрос уже завершен", True
         else:
-            try:
-                await callback.answer("Вы уже в списке участников")
-            except TelegramBadRequest as e:
-                if "query is too old" in str(e):
-                    return
-                else:
-                    raise
-            
-    elif callback.data == "poll_leave":
-        if user_in_list:
-            # Сохраняем участника для возможного отката
-            participant_to_remove = next(p for p in participants if p[0] == uid)
-            participants[:] = [p for p in participants if p[0] != uid]
-            changed = True
-            action_performed = True
-            try:
-                await callback.answer("Вы удалены из списка участников")
-            except TelegramBadRequest as e:
-                if "query is too old" in str(e):
-                    # Откатываем изменения, если запрос устарел
-                    participants.append(participant_to_remove)
-                    return
-                else:
-                    raise
+            alert = False
+            reply, changed = apply_vote(chat_id, info, me, callback.data)
+
+    # 2. Отвечаем на callback — больше пользователь ничего не ждёт
+    try:
+        await callback.answer(reply, show_alert=alert)
+    except TelegramBadRequest as e:
+        if "query is too old" in str(e):
+            # Пользователь не увидел ответа — откатываем голос, если опрос и голос ещё те же
+            if not alert and changed:
+                async with poll_lock(chat_id):
+                    if active_poll.get(chat_id) is info and revert_vote(chat_id, info, changed, callback.data):
+                        poll_renders.submit(chat_id, info["message_id"], active_poll_render(chat_id, info["message_id"]), PRIORITY_HIGH)
+            return
         else:
-            try:
-                await callback.answer("Вас нет в списке участников")
-            except TelegramBadRequest as e:
-                if "query is too old" in str(e):
-                    return
-                else:
-                    raise
-    
-    # Обновляем сообщение только если произошли реальные изменения
-    if changed and action_performed:
-        # Обновляем сообщение опроса
-        cmd_settings = find_command_settings(chat_id, info["command"])
-        question = cmd_settings.get("question", info["command"]) if cmd_settings else info["command"]
-        
-        # Формируем новый текст
-        new_text = build_poll_text_with_timer(question, participants, expires_at)
-        
-        try:
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=info["message_id"],
-                text=new_text,
-                reply_markup=build_poll_keyboard(),
-                parse_mode="HTML"
-            )
-            # Сохраняем новый текст
-            if "last_text" not in info or info["last_text"] != new_text:
-                info["last_text"] = new_text
-                
-        except TelegramBadRequest as e:
-            if "message is not modified" in str(e):
-                pass
-            elif "message to edit not found" in str(e):
-                logger.warning(f"Message not found: chat_id={chat_id}, message_id={info['message_id']}")
-            elif "query is too old" in str(e):
-                logger.warning(f"Old callback query during message edit: {e}")
-            else:
-                logger.warning(f"Failed to update poll message: {e}")
-        
-        # Обновляем историю
-        update_history_entry(chat_id, info["message_id"], participants=_serialize_participants(participants))
+            raise
+    if alert:
+        return
+    vote_answered.observe(loop.time() - received)
+    if not changed:
+        return
+
+    # 3. Перерисовка — в фоне: голоса за окно POLL_EDIT_DEBOUNCE уходят одной правкой
+    message_id = info["message_id"]
+    updated = poll_renders.submit(chat_id, message_id, active_poll_render(chat_id, message_id), PRIORITY_HIGH)
+    updated.add_done_callback(
+        lambda f: not f.cancelled() and f.result() and vote_updated.observe(loop.time() - received)
+    )
 
 
 @dp.message(Command(commands=["stat"]))
@@ -1302,24 +1417,16 @@ async def stat_cmd(message: Message):
         return
 
     # Собираем уникальные uid и соответствующие данные из истории
-    user_data = {}
-    for entry in history:
-        for participant in entry.get("participants", []):
-            uid = participant.get("uid")
-            username = participant.get("username")
-            fullname = participant.get("fullname", "")
-            
-            if uid:  # используем uid вместо username
-                # Если uid уже есть, сохраняем самые актуальные данные (из последней записи)
-                if uid not in user_data:
-                    user_data[uid] = {
-                        "username": username,
-                        "fullname": fullname
-                    }
-                # Если в текущей записи есть username, а в сохраненных данных нет - обновляем
-                elif username and not user_data[uid]["username"]:
-                    user_data[uid]["username"] = username
-                    user_data[uid]["fullname"] = fullname
+    # (самые актуальные данные; username — из последней записи, где он был)
+    try:
+        users = await get_unique_users_from_history()
+    except JobQueueFull:
+        await message.reply(JOBS_BUSY_TEXT)
+        return
+    user_data = {
+        u.uid: {"username": u.username, "fullname": u.fullname}
+        for u in users
+    }
 
     if not user_data:
         try:
@@ -1364,8 +1471,9 @@ async def stat_cmd(message: Message):
 
     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-    # Сохраняем состояние ожидания выбора
-    stat_waiting_username[message.from_user.id] = True
+    # Сохраняем состояние ожидания выбора и формат выгрузки: /stat — CSV, /stat xlsx — отчёт со сводными листами
+    args = (message.text or "").split()[1:]
+    stat_waiting_username[message.from_user.id] = "xlsx" if args and args[0].lower() == "xlsx" else "csv"
 
     try:
         await message.reply("Выберите пользователя для фильтрации статистики:", reply_markup=reply_markup)
@@ -1410,101 +1518,106 @@ async def stat_callback_handler(callback: CallbackQuery):
         return
 
     # Удаляем состояние ожидания
-    del stat_waiting_username[user_id]
-
-    # Собираем данные из истории
-    data = []
-    for entry in history:
-        expires_at_str = entry.get("expires_at")
-        if not expires_at_str:
-            continue
-            
-        try:
-            # Парсим дату и извлекаем только дату
-            expires_dt = datetime.fromisoformat(expires_at_str)
-            expires_date = expires_dt.date()
-        except ValueError:
-            continue
+    export_format = stat_waiting_username.pop(user_id)
 
-        command = entry.get("command", "")
-        
-        for participant in entry.get("participants", []):
-            uid = participant.get("uid")
-            fullname = participant.get("fullname", "")
-            username = participant.get("username", "")
-            
-            # Фильтруем по выбранному uid, если не выбрано "ВСЕ"
-            if selected_uid != "ALL" and str(uid) != selected_uid:
-                continue
-                
-            data.append({
-                "uid": uid,
-                "fullname": fullname,
-                "username": username,
-                "expires_at": expires_date,
-                "command": command
-            })
-
-    if not data:
-        try:
-            await callback.message.edit_text("Нет данных для выбранного фильтра.")
-            await callback.answer()
-        except TelegramBadRequest as e:
-            if "query is too old" in str(e):
-                return  # Игнорируем устаревшие запросы
-            else:
-                raise
+    # Собираем данные из истории (для одного uid — выборка по индексу)
+    uid_filter = None if selected_uid == "ALL" else int(selected_uid)
+    if export_format == "xlsx":
+        await send_stat_xlsx(callback, selected_uid, uid_filter)
         return
 
-    # Сортируем данные по expires_at, затем по command
-    data.sort(key=lambda x: (x["expires_at"], x["command"]))
+    # Строки одного пользователя — из индекса посещаемости, всех — из снимка истории;
+    # сортировка кусками, слияние и сжатие — в пуле задач
+    compression = STAT_CSV_COMPRESSION if STAT_CSV_COMPRESSION in EXTENSIONS else "zip"
+    try:
+        participations, rows = await stat_source(uid_filter)
+        display_name, filename = stat_display_name(selected_uid, uid_filter, rows)
+        spool, count = await jobs.run("stat_csv", lambda: export_csv(participations(), compression, f"{filename}.csv"))
+    except JobQueueFull:
+        await stat_notice(callback, JOBS_BUSY_TEXT)
+        return
 
-    # Создаем CSV файл в памяти
-    output = io.StringIO()
-    fieldnames = ["uid", "fullname", "username", "expires_at", "command"]
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    
-    for row in data:
-        writer.writerow(row)
+    if not count:
+        await stat_notice(callback, "Нет данных для выбранного фильтра.")
+        return
+
+    try:
+        await send_stat_file(callback, display_name,
+                             SpooledInputFile(spool, filename=f"{filename}.{EXTENSIONS[compression]}"))
+    finally:
+        spool.close()
 
-    # Подготавливаем файл для отправки
-    csv_data = output.getvalue().encode('utf-8')
-    output.close()
 
-    # Определяем имя файла в зависимости от выбора
+async def stat_notice(callback: CallbackQuery, text: str):
+    """Текст вместо клавиатуры выбора /stat."""
+    try:
+        await callback.message.edit_text(text)
+        await callback.answer()
+    except TelegramBadRequest as e:
+        if "query is too old" in str(e):
+            return  # Игнорируем устаревшие запросы
+        else:
+            raise
+
+
+async def user_participations(uid: int) -> List[Dict[str, Any]]:
+    """Строки участия одного пользователя, новейшие первыми — за O(его посещений)."""
+    if history_store.attendance is None:
+        # бэкенд отвечает по uid сам (SQLite — по индексу таблицы участников)
+        return list(history_store.participations(uid))
+    index = await built_index("attendance_index", history_store.attendance)
+    return list(index.participations(uid))
+
+
+def known_participant(uid: int) -> Optional[Participant]:
+    """Данные пользователя без прохода по истории: из активных опросов или из уже собранного индекса посещаемости."""
+    for info in active_poll.values():
+        p = info["participants"].get(uid)
+        if p is not None:
+            return p
+    index = history_store.attendance
+    if index is not None and index.built:
+        return index.participant(uid)
+    return None
+
+
+async def stat_source(uid_filter: Optional[int]):
+    """
+    -> (participations() для пула задач, строки пользователя или None). Строки одного пользователя выбираются
+    сейчас из индекса посещаемости; для всех — снимок истории, проход по нему (и по архиву) идёт уже в пуле задач.
+    """
+    if uid_filter is None:
+        return history_store.snapshot().participations, None
+    rows = await user_participations(uid_filter)
+    return lambda: iter(rows), rows
+
+
+def stat_display_name(selected_uid: str, uid_filter: Optional[int], rows=None):
+    """-> (подпись выборки, имя файла без расширения); rows — уже выбранные строки пользователя, новейшие первыми."""
     if selected_uid == "ALL":
-        filename = "poll_statistics_all.csv"
-        display_name = "всех пользователей"
-    else:
-        # Находим данные выбранного пользователя для красивого имени файла
-        user_info = None
-        for entry in history:
-            for participant in entry.get("participants", []):
-                if str(participant.get("uid")) == selected_uid:
-                    user_info = participant
-                    break
-            if user_info:
-                break
-        
-        if user_info:
-            username = user_info.get("username")
-            fullname = user_info.get("fullname", "")
-            if username:
-                display_name = f"@{username}"
-            else:
-                display_name = fullname
-            filename = f"poll_statistics_{display_name.replace(' ', '_')}.csv"
+        return "всех пользователей", "poll_statistics_all"
+    # Находим данные выбранного пользователя для красивого имени файла
+    user_info = known_participant(uid_filter)
+    if user_info is None and rows:
+        user_info = Participant(uid_filter, rows[0].get("username"), rows[0].get("fullname"))
+    if user_info:
+        username = user_info.username
+        fullname = user_info.fullname or ""
+        if username:
+            display_name = f"@{username}"
         else:
-            display_name = f"uid_{selected_uid}"
-            filename = f"poll_statistics_{selected_uid}.csv"
-    
+            display_name = fullname
+        return display_name, f"poll_statistics_{display_name.replace(' ', '_')}"
+    return f"uid_{selected_uid}", f"poll_statistics_{selected_uid}"
+
+
+async def send_stat_file(callback: CallbackQuery, display_name: str, document: types.InputFile):
     # Редактируем сообщение с клавиатурой и отправляем файл
     try:
         await callback.message.edit_text(f"Статистика для: {display_name}")
         
         await callback.message.answer_document(
-            types.BufferedInputFile(csv_data, filename=filename),
+            document,
             caption=f"Статистика опросов - {display_name}"
         )
         
@@ -1516,6 +1629,37 @@ async def stat_callback_handler(callback: CallbackQuery):
             raise
 
 
+async def send_stat_xlsx(callback: CallbackQuery, selected_uid: str, uid_filter: Optional[int]):
+    """/stat xlsx: колонки по строкам участия и сводные листы pandas — в пуле задач."""
+    try:
+        from .stat_report import build_xlsx, extract_columns
+    except ImportError as e:
+        logger.warning("XLSX export is unavailable (%s)", e)
+        await stat_notice(callback, "Выгрузка XLSX недоступна, используйте /stat.")
+        return
+
+    def report():
+        columns = extract_columns(participations())
+        return build_xlsx(columns) if columns["uid"] else None
+
+    try:
+        await callback.message.edit_text("Готовлю отчёт…")
+    except TelegramBadRequest as e:
+        if "query is too old" not in str(e):
+            raise
+    try:
+        participations, rows = await stat_source(uid_filter)
+        payload = await jobs.run("stat_xlsx", report)
+    except JobQueueFull:
+        await stat_notice(callback, JOBS_BUSY_TEXT)
+        return
+    if payload is None:
+        await stat_notice(callback, "Нет данных для выбранного фильтра.")
+        return
+    display_name, filename = stat_display_name(selected_uid, uid_filter, rows)
+    await send_stat_file(callback, display_name, types.BufferedInputFile(payload, filename=f"{filename}.xlsx"))
+
+
 @dp.message(Command(commands=["deactivate"]))
 async def deactivate_cmd(message: Message):
     # Проверяем права админа
@@ -1623,7 +1767,7 @@ async def autopoll_scheduler():
                             logger.info(f"[autopoll] Triggering scheduled autopoll for {cmd_name} (chat {chat_id})")
                             await create_poll(chat_id, cmd_name, by_auto=True, schedule_entry=sched)
                                                        
-                            await send_weather(bot, chat_id, weather_client)
+                            await send_weather(bot, chat_id, weather_client, telegram)
                             
                             last_autocreate[key] = date.today()
 
@@ -1646,20 +1790,21 @@ def build_help_text_compact():
         " /top\_rapier — топ участников по посещению рапиры",
         " /top\_open — топ участников по посещению самоподготовке",
         " /my\_stat — ваша персональная статистика по посещениям",
+        "- Другое окно — аргументом: /top\_sum 365 (дней) или /my\_stat 2025-01-01..2025-06-30",
         "\n*Команды для администраторов:*",
         " /saber — создать опрос сабли вручную",
         " /rapier — создать опрос рапиры вручную",
         " /openfight — создать опрос самоподготовки вручную",
         " /deactivate — закрыть активный опрос",
-        " /stat — получить общую статистику по опросам",
-        f"\n*Примечание:* бот хранит последние {MAXLEN_HISTORY} опросов для статистики.",
+        " /stat — получить общую статистику по опросам (/stat xlsx — отчёт со сводными листами)",
+        "\n*Примечание:* статистика учитывает всю историю опросов, старые опросы хранятся в архиве.",
     ]
     return "\n".join(lines)
 
 
 @dp.message(Command(commands=["help"]))
 async def help_cmd(message: types.Message):
-    text = build_help_text_compact()
+    text = render_cache.get_or_render(("help", settings_version), build_help_text_compact)
     try:
         sent = await message.answer(text, parse_mode="Markdown")
         await asyncio.sleep(600)
@@ -1689,161 +1834,146 @@ TOP_N = 5
 AS_OF_DATE: datetime | None = None  # <-- сюда можно поставить любую дату
 # AS_OF_DATE = datetime(2025, 10, 13, tzinfo=timezone.utc)
 
-# --- Dense ranking ---
-def dense_ranking(users: list, count_key: str = "total", top_n: int = TOP_N):
-    users_sorted = sorted(users, key=lambda x: x[count_key], reverse=True)
-    ranked = []
-    last_count = None
-    current_place = 0
-    for u in users_sorted:
-        if u[count_key] != last_count:
-            current_place += 1
-            last_count = u[count_key]
-        ranked.append({"place": current_place, **u})
-    max_place = max([r["place"] for r in ranked if r["place"] <= top_n], default=0)
-    return [r for r in ranked if r["place"] <= max_place]
+# --- Счётчики посещаемости ---
+# Обновляются по одному опросу при его закрытии и правке (_history_changed),
+# поэтому /top_* и /my_stat не проходят историю заново
+attendance_stats = AttendanceAggregator(lambda since, until: history_store.closed_polls(since, until), DAYS_LIMIT)
 
-# --- Общая функция для топов по типу тренировок ---
-async def compute_top_by_type(training_type: str, days_limit: int = DAYS_LIMIT):
-    now = AS_OF_DATE or datetime.now(timezone.utc)
-    since_dt = now - timedelta(days=days_limit)
 
-    stats = {}
-    day_attendance = {}
-    first_date = None
+def all_closed_polls():
+    return history_store.closed_polls(datetime.min.replace(tzinfo=timezone.utc), FAR_FUTURE)
 
-    for entry in history:
-        try:
-            if entry.get("active", False):
-                continue
-            expires_str = entry.get("expires_at")
-            if not expires_str:
-                continue
-            expires_dt = datetime.fromisoformat(expires_str)
-            if expires_dt < since_dt or expires_dt > now:
-                continue
-            cmd = entry.get("command", "")
-            if training_type != "all" and cmd != training_type:
-                continue
-            participants = entry.get("participants", [])
-            training_date = expires_dt.date()
-            quorum = entry.get("quorum", False)
-            if not quorum and len(participants) < 4:
-                continue
-            if first_date is None or training_date < first_date:
-                first_date = training_date
-            if training_date not in day_attendance:
-                day_attendance[training_date] = set()
-            for p in participants:
-                uid = p.get("uid")
-                if not uid:
-                    continue
-                username = p.get("username") or ""
-                fullname = p.get("fullname") or ""
-                name = f"@{username}" if username else fullname
-                if uid not in stats:
-                    stats[uid] = {"name": name, "count": 0}
-                if name:
-                    stats[uid]["name"] = name
-                if uid not in day_attendance[training_date]:
-                    day_attendance[training_date].add(uid)
-                    stats[uid]["count"] += 1
-        except Exception as e:
-            logger.warning(f"Error in compute_top_by_type({training_type}): {e}")
 
-    users = [{"uid": uid, "name": data["name"], "total": data["count"]} for uid, data in stats.items()]
-    top_list = dense_ranking([u for u in users if u["total"] > 0], count_key="total", top_n=TOP_N)
-    days_count = len(day_attendance)
-    total_unique = len(stats)
-    return top_list, days_count, total_unique, first_date
+# Окно дат из аргумента команды (/top_sum 365, /my_stat 2025-01-01..2025-06-30) — счётчики по дням за всю историю
+attendance_days = AttendanceDays(all_closed_polls)
 
-# --- /top_sum (общий топ) ---
-@dp.message(Command(commands=["top_sum"]))
-async def top_sum_cmd(message: Message):
+# STATS_BACKEND=numpy — те же ответы по колонкам numpy (пересобираются после изменения закрытых опросов)
+attendance_matrix = None
+if STATS_BACKEND == "numpy":
+    try:
+        from .attendance_matrix import AttendanceMatrix
+        attendance_matrix = AttendanceMatrix(all_closed_polls)
+    except ImportError as e:
+        logger.warning("numpy stats backend is unavailable (%s), using attendance counters", e)
+
+STATS_WINDOW_HELP = (
+    "Окно статистики: число дней (/top_sum 365), даты включительно (/my_stat 2025-01-01..2025-06-30) "
+    "или дата начала (/top_saber 2025-01-01)."
+)
+
+
+def parse_stats_window(message: Message):
+    """
+    Аргумент команд статистики -> (first, last, подпись для заголовка) или None без аргумента.
+    "365" — 365 дней по сегодня включительно, "A..B" — даты включительно, "A" — с даты по сегодня; иначе ValueError
+    (в том числе для окна за пределами календаря: /top_sum 99999999, ..9999-12-31).
+    """
+    args = (message.text or "").split()[1:]
+    if not args:
+        return None
+    arg = args[0]
+    today = (AS_OF_DATE or datetime.now(timezone.utc)).astimezone(LOCAL_TZ).date()
+    first, last = date_window(arg, today)
+    if arg.isdigit():
+        label = f"за последние {int(arg)} дней"
+    else:
+        label = f"с {first.strftime('%d.%m.%Y')} по {last.strftime('%d.%m.%Y')}"
+    return first, last, label
+
+
+def stats_period(window) -> str:
+    return window[2] if window else f"за последние {DAYS_LIMIT} дней"
+
+
+def scan_summary(snapshot, since: datetime, until: datetime) -> AttendanceSummary:
+    """Полный проход по снимку истории — в пуле задач."""
+    return AttendanceSummary(scan_attendance(snapshot.closed_polls(since, until), since, until))
+
+
+async def attendance_summary(window=None) -> AttendanceSummary:
+    """
+    Итог статистики за последние DAYS_LIMIT дней (или за окно дат window) — общий для всех команд статистики.
+    Окно DAYS_LIMIT берётся из счётчиков (и кэшируется до их изменения), окно дат — из счётчиков по дням;
+    с STATS_BACKEND=numpy любое окно считается по матрице посещаемости.
+    Полная сборка счётчиков по дням и колонок матрицы, запросы по матрице и сверка (STATS_VERIFY) —
+    по снимку истории в пуле задач; JobQueueFull — пул занят.
+    """
     now = AS_OF_DATE or datetime.now(timezone.utc)
     since_dt = now - timedelta(days=DAYS_LIMIT)
+    if window is not None:
+        since_dt, now = local_bounds(window[0], window[1])
+    if attendance_matrix is not None:
+        matrix = await built_index("attendance_matrix", attendance_matrix)
+        summary = await jobs.run("stats_matrix", matrix.summary, since_dt, now, matrix.columns())
+    elif window is not None:
+        days = await built_index("attendance_days", attendance_days)
+        summary = days.summary(window[0], window[1])
+    else:
+        summary = attendance_stats.summary(now)
+    if STATS_VERIFY and not summary.verified:
+        report, snapshot = summary.report, history_store.snapshot()
+        try:
+            expected = await jobs.run("stats_verify", scan_summary, snapshot, since_dt, now)
+        except JobQueueFull:
+            # сверим при следующем запросе
+            return summary
+        problems = compare_reports(report, expected.report)
+        for problem in problems:
+            logger.warning("Attendance counters mismatch: %s", problem)
+        if not problems:
+            logger.debug("Attendance counters verified: %d users", summary.total_users("all"))
+        summary.verified = True
+    return summary
 
-    stats = {}
-    day_attendance = {}
-    first_date = None
+# --- Общая функция для топов по типу тренировок ---
+def compute_top_by_type(training_type: str, summary: AttendanceSummary):
+    top_list = summary.top(training_type, TOP_N)
+    return top_list, summary.days(training_type), summary.total_users(training_type), summary.first_date(training_type)
 
-    for entry in history:
-        try:
-            if entry.get("active", False):
-                continue
-            expires_str = entry.get("expires_at")
-            if not expires_str:
-                continue
-            expires_dt = datetime.fromisoformat(expires_str)
-            if expires_dt < since_dt or expires_dt > now:
-                continue
-            participants = entry.get("participants", [])
-            command = entry.get("command", "")
-            training_date = expires_dt.date()
-            quorum = entry.get("quorum", False)
-            if not quorum and len(participants) < 4:
-                continue
-            if first_date is None or training_date < first_date:
-                first_date = training_date
-            if training_date not in day_attendance:
-                day_attendance[training_date] = set()
-            for p in participants:
-                uid = p.get("uid")
-                if not uid:
-                    continue
-                username = p.get("username") or ""
-                fullname = p.get("fullname") or ""
-                name = f"@{username}" if username else fullname
-                if uid not in stats:
-                    stats[uid] = {"name": name, "total": 0, "saber": 0, "rapier": 0, "open": 0}
-                if name:
-                    stats[uid]["name"] = name
-                if uid not in day_attendance[training_date]:
-                    day_attendance[training_date].add(uid)
-                    stats[uid]["total"] += 1
-                    if command == "saber":
-                        stats[uid]["saber"] += 1
-                    elif command == "rapier":
-                        stats[uid]["rapier"] += 1
-                    elif command == "openfight":
-                        stats[uid]["open"] += 1
-        except Exception as e:
-            logger.warning(f"Error in top_sum: {e}")
-            continue
 
-    users = [
-        {"uid": uid, "name": data["name"], "total": data["total"],
-         "saber": data["saber"], "rapier": data["rapier"], "open": data["open"]}
-        for uid, data in stats.items()
-    ]
-    if not users:
-        await message.answer(f"Нет учтённых тренировок за последние {DAYS_LIMIT} дней.")
-        return
+def cached_top(command: str, window, summary: AttendanceSummary, render) -> str:
+    """
+    Текст топа из кэша ответов: ключ — команда, окно и версии истории и итога статистики.
+    Итог без версии (numpy-матрица считает окно заново) не кэшируется.
+    """
+    if summary.version is None:
+        return render()
+    key = (command, window[:2] if window else None, history_version, summary.version)
+    return render_cache.get_or_render(key, render)
+
 
-    top_list = dense_ranking([u for u in users if u["total"] > 0], count_key="total", top_n=TOP_N)
+def render_top_sum(summary: AttendanceSummary, window) -> str:
+    top_list, days, total_participants, first_date = compute_top_by_type("all", summary)
+    if not total_participants:
+        return f"Нет учтённых тренировок {stats_period(window)}."
 
-    lines = [f"🏆 <b>ТОП участников (за последние {DAYS_LIMIT} дней):</b>\n"]
+    lines = [f"🏆 <b>ТОП участников ({stats_period(window)}):</b>\n"]
     for u in top_list:
         place = u["place"]
         medal = "🥇" if place == 1 else "🥈" if place == 2 else "🥉" if place == 3 else f"{place} место"
         lines.append(f"{medal} — {u['name']} ({u['total']} трен.)")
 
-    total_participants = len(stats)
-    lines.append(f"\n📌 Учтено тренировок: {len(day_attendance)}")
+    lines.append(f"\n📌 Учтено тренировок: {days}")
     lines.append(f"👥 Всего участников: {total_participants}")
     if first_date:
         lines.append(f"🗓 Учет ведется с {first_date.strftime('%d.%m.%Y')}")
+    return "\n".join(lines)
 
-    await message.answer("\n".join(lines), parse_mode="HTML")
 
-# --- /top_saber ---
-@dp.message(Command(commands=["top_saber"]))
-async def top_saber_cmd(message: Message):
-    top_list, days, total_unique, first_date = await compute_top_by_type("saber")
+# заголовок и текст «нет тренировок» для топов по типу
+TOP_TITLES = {
+    "saber": ("⚔️ <b>ТОП саблистов по посещениям ({period})</b>:\n", "Нет сабельных тренировок {period}."),
+    "rapier": ("🤺 <b>ТОП рапиристов по посещениям ({period})</b>:\n", "Нет рапирных тренировок {period}."),
+    "openfight": ("🥊 <b>ТОП по самоподготовке ({period})</b>:\n", "Нет тренировок самоподготовки {period}."),
+}
+
+
+def render_top_type(training_type: str, summary: AttendanceSummary, window) -> str:
+    title, empty = TOP_TITLES[training_type]
+    top_list, days, total_unique, first_date = compute_top_by_type(training_type, summary)
     if not top_list:
-        await message.answer(f"Нет сабельных тренировок за последние {DAYS_LIMIT} дней.")
-        return
-    lines = [f"⚔️ <b>ТОП саблистов по посещениям (за последние {DAYS_LIMIT} дней)</b>:\n"]
+        return empty.format(period=stats_period(window))
+    lines = [title.format(period=stats_period(window))]
     for u in top_list:
         medal = "🥇" if u["place"] == 1 else "🥈" if u["place"] == 2 else "🥉" if u["place"] == 3 else f"{u['place']} место"
         lines.append(f"{medal} — {u['name']} ({u['total']})")
@@ -1851,152 +1981,77 @@ async def top_saber_cmd(message: Message):
     lines.append(f"👥 Всего участников: {total_unique}")
     if first_date:
         lines.append(f"🗓 Учет ведется с {first_date.strftime('%d.%m.%Y')}")
-    await message.answer("\n".join(lines), parse_mode="HTML")
+    return "\n".join(lines)
+
+
+async def answer_top(message: Message, command: str, training_type: str):
+    try:
+        window = parse_stats_window(message)
+    except ValueError:
+        await message.answer(STATS_WINDOW_HELP)
+        return
+    try:
+        summary = await attendance_summary(window=window)
+    except JobQueueFull:
+        await message.answer(JOBS_BUSY_TEXT)
+        return
+    if training_type == "all":
+        text = cached_top(command, window, summary, lambda: render_top_sum(summary, window))
+    else:
+        text = cached_top(command, window, summary, lambda: render_top_type(training_type, summary, window))
+    await message.answer(text, parse_mode="HTML")
+
+# --- /top_sum (общий топ) ---
+@dp.message(Command(commands=["top_sum"]))
+async def top_sum_cmd(message: Message):
+    await answer_top(message, "top_sum", "all")
+
+# --- /top_saber ---
+@dp.message(Command(commands=["top_saber"]))
+async def top_saber_cmd(message: Message):
+    await answer_top(message, "top_saber", "saber")
 
 # --- /top_rapier ---
 @dp.message(Command(commands=["top_rapier"]))
 async def top_rapier_cmd(message: Message):
-    top_list, days, total_unique, first_date = await compute_top_by_type("rapier")
-    if not top_list:
-        await message.answer(f"Нет рапирных тренировок за последние {DAYS_LIMIT} дней.")
-        return
-    lines = [f"🤺 <b>ТОП рапиристов по посещениям (за последние {DAYS_LIMIT} дней)</b>:\n"]
-    for u in top_list:
-        medal = "🥇" if u["place"] == 1 else "🥈" if u["place"] == 2 else "🥉" if u["place"] == 3 else f"{u['place']} место"
-        lines.append(f"{medal} — {u['name']} ({u['total']})")
-    lines.append(f"\n📌 Учтено тренировок: {days}")
-    lines.append(f"👥 Всего участников: {total_unique}")
-    if first_date:
-        lines.append(f"🗓 Учет ведется с {first_date.strftime('%d.%m.%Y')}")
-    await message.answer("\n".join(lines), parse_mode="HTML")
+    await answer_top(message, "top_rapier", "rapier")
 
 # --- /top_open ---
 @dp.message(Command(commands=["top_open"]))
 async def top_open_cmd(message: Message):
-    top_list, days, total_unique, first_date = await compute_top_by_type("openfight")
-    if not top_list:
-        await message.answer(f"Нет тренировок самоподготовки за последние {DAYS_LIMIT} дней.")
-        return
-    lines = [f"🥊 <b>ТОП по самоподготовке (за последние {DAYS_LIMIT} дней)</b>:\n"]
-    for u in top_list:
-        medal = "🥇" if u["place"] == 1 else "🥈" if u["place"] == 2 else "🥉" if u["place"] == 3 else f"{u['place']} место"
-        lines.append(f"{medal} — {u['name']} ({u['total']})")
-    lines.append(f"\n📌 Учтено тренировок: {days}")
-    lines.append(f"👥 Всего участников: {total_unique}")
-    if first_date:
-        lines.append(f"🗓 Учет ведется с {first_date.strftime('%d.%m.%Y')}")
-    await message.answer("\n".join(lines), parse_mode="HTML")
+    await answer_top(message, "top_open", "openfight")
 
 # --- /my_stat ---
 @dp.message(Command(commands=["my_stat"]))
 async def my_stat_cmd(message: Message):
     user_id = message.from_user.id
-    now = AS_OF_DATE or datetime.now(timezone.utc)
-    since_dt = now - timedelta(days=DAYS_LIMIT)
-
-    full_stats = {}
-    day_attendance = {}
-    first_date = None
-    stats_saber = {}
-    stats_rapier = {}
-    stats_open = {}
-
-    for entry in history:
-        try:
-            if entry.get("active", False):
-                continue
-            expires_str = entry.get("expires_at")
-            if not expires_str:
-                continue
-            expires_dt = datetime.fromisoformat(expires_str)
-            if expires_dt < since_dt or expires_dt > now:
-                continue
-            participants = entry.get("participants", [])
-            command = entry.get("command", "")
-            training_date = expires_dt.date()
-            quorum = entry.get("quorum", False)
-            if not quorum and len(participants) < 4:
-                continue
-            if first_date is None or training_date < first_date:
-                first_date = training_date
-            if training_date not in day_attendance:
-                day_attendance[training_date] = set()
-            for p in participants:
-                uid = p.get("uid")
-                if not uid:
-                    continue
-                if uid not in full_stats:
-                    full_stats[uid] = 0
-                if uid not in day_attendance[training_date]:
-                    day_attendance[training_date].add(uid)
-                    full_stats[uid] += 1
-                if command == "saber":
-                    if training_date not in stats_saber:
-                        stats_saber[training_date] = set()
-                    stats_saber[training_date].add(uid)
-                elif command == "rapier":
-                    if training_date not in stats_rapier:
-                        stats_rapier[training_date] = set()
-                    stats_rapier[training_date].add(uid)
-                elif command == "openfight":
-                    if training_date not in stats_open:
-                        stats_open[training_date] = set()
-                    stats_open[training_date].add(uid)
-        except Exception as e:
-            logger.warning(f"Error in my_stat: {e}")
-            continue
+    try:
+        window = parse_stats_window(message)
+    except ValueError:
+        await message.answer(STATS_WINDOW_HELP)
+        return
+    try:
+        summary = await attendance_summary(window=window)
+    except JobQueueFull:
+        await message.answer(JOBS_BUSY_TEXT)
+        return
 
-    total_users = len(full_stats)
-    if user_id not in full_stats or full_stats.get(user_id, 0) == 0:
-        await message.answer(f"У вас пока нет учтённых тренировок за последние {DAYS_LIMIT} дней.")
+    my_total = summary.count("all", user_id)
+    if not my_total:
+        await message.answer(f"У вас пока нет учтённых тренировок {stats_period(window)}.")
         return
 
-    rating = sorted(full_stats.items(), key=lambda x: x[1], reverse=True)
-    last_count = None
-    place_counter = 0
-    my_place = None
-    for uid, count in rating:
-        if count != last_count:
-            place_counter += 1
-            last_count = count
-        if uid == user_id:
-            my_place = place_counter
-            break
-
-    def per_user_counts(stats_dict):
-        result = {}
-        for date, s in stats_dict.items():
-            for uid in s:
-                result[uid] = result.get(uid, 0) + 1
-        return result
-
-    per_user_saber = per_user_counts(stats_saber)
-    per_user_rapier = per_user_counts(stats_rapier)
-    per_user_open = per_user_counts(stats_open)
-
-    def compute_dense_place(per_user_counts: dict, target_uid: int, all_uids: list):
-        if not per_user_counts:
-            return len(all_uids)
-        items = sorted(per_user_counts.items(), key=lambda x: x[1], reverse=True)
-        last_count_local = None
-        place_local = 0
-        for uid, cnt in items:
-            if cnt != last_count_local:
-                place_local += 1
-                last_count_local = cnt
-            if uid == target_uid:
-                return place_local
-        return len(all_uids)
-
-    all_uids_list = list(full_stats.keys())
-    place_saber = compute_dense_place(per_user_saber, user_id, all_uids_list)
-    place_rapier = compute_dense_place(per_user_rapier, user_id, all_uids_list)
-    place_open = compute_dense_place(per_user_open, user_id, all_uids_list)
-
-    my_saber = per_user_saber.get(user_id, 0)
-    my_rapier = per_user_rapier.get(user_id, 0)
-    my_open = per_user_open.get(user_id, 0)
-    my_total = full_stats.get(user_id, 0)
+    total_users = summary.total_users("all")
+    first_date = summary.first_date("all")
+    my_place = summary.place("all", user_id)
+    # не ходил на тренировки этого типа — последнее место из всех участников
+    place_saber = summary.place("saber", user_id) or total_users
+    place_rapier = summary.place("rapier", user_id) or total_users
+    place_open = summary.place("openfight", user_id) or total_users
+
+    my_saber = summary.count("saber", user_id)
+    my_rapier = summary.count("rapier", user_id)
+    my_open = summary.count("openfight", user_id)
 
     def place_to_medal(place):
         if place == 1: return "🥇"
@@ -2010,14 +2065,14 @@ async def my_stat_cmd(message: Message):
     medal_open = place_to_medal(place_open)
 
     lines = [
-        f"📊 <b>Ваша статистика за последние {DAYS_LIMIT} дней:</b>\n",
+        f"📊 <b>Ваша статистика {stats_period(window)}:</b>\n",
         f"👤 <b>{message.from_user.full_name}</b>",
         f"🏆 <b>{medal_general}</b> место в общем рейтинге по посещениям из <b>{total_users}</b>\n",
         f"📅 Всего тренировок: <b>{my_total}</b>",
         f"   • Сабля: {my_saber} ({medal_saber})",
         f"   • Рапира: {my_rapier} ({medal_rapier})",
         f"   • Самоподготовка: {my_open} ({medal_open})",
-        f"\n📌 Учтено тренировок: {len(day_attendance)}",
+        f"\n📌 Учтено тренировок: {summary.days('all')}",
         f"👥 Всего участников: {total_users}"
     ]
     if first_date:
@@ -2051,12 +2106,9 @@ def format_schedule_table(rows: list[tuple[str, str, str]]) -> str:
     lines = [f"{d.ljust(w_day)}  {t.ljust(w_tr)}  {tm}" for d, t, tm in data]
     return "<pre>" + "\n".join(lines) + "</pre>"
 
-@dp.message(Command("schedule"))
-async def schedule_cmd(message: Message):
-    chat_conf = _get_target_chat_conf(message)
+def render_schedule(chat_conf: dict | None) -> str:
     if not chat_conf:
-        await message.answer("Расписание не настроено.")
-        return
+        return "Расписание не настроено."
 
     commands = chat_conf.get("topics", {}).get("root", {}).get("commands", {})
 
@@ -2074,8 +2126,7 @@ async def schedule_cmd(message: Message):
             rows.append((day, training_key, hhmm))
 
     if not rows:
-        await message.answer("Тренировок нет.")
-        return
+        return "Тренировок нет."
 
     rows.sort(key=lambda x: (DAY_ORDER.index(x[0]) if x[0] in DAY_ORDER else 999, x[2], x[1]))
 
@@ -2085,7 +2136,16 @@ async def schedule_cmd(message: Message):
     # ]
     # await message.answer("\n".join(lines))
     
-    text = format_schedule_table(rows)
+    return format_schedule_table(rows)
+
+@dp.message(Command("schedule"))
+async def schedule_cmd(message: Message):
+    # в личке — расписание первого чата, иначе — своего
+    chat_key = "private" if message.chat.type == "private" else message.chat.id
+    text = render_cache.get_or_render(
+        ("schedule", chat_key, settings_version),
+        lambda: render_schedule(_get_target_chat_conf(message)),
+    )
     await message.answer(text, parse_mode="HTML")
 
 # --- Статистика ---
@@ -2219,7 +2279,7 @@ async def handle_edit_link(message: Message):
     logger.info(f"📝 Created edit session for user {user_id}")
 
     # Формируем текст с списком участников
-    participants = _deserialize_participants(poll_entry.get("participants", []))
+    participants = poll_entry.get("participants", [])
     question = poll_entry.get("command", "Опрос")
     
     text = build_edit_poll_text(question, participants)
@@ -2245,8 +2305,24 @@ async def main():
 
     # Запуск автопланировщика для автопросов
     asyncio.create_task(autopoll_scheduler())
-    asyncio.create_task(weather_updater(bot, weather_client))
-    await dp.start_polling(bot)
+    asyncio.create_task(weather_updater(bot, weather_client, telegram))
+    # Фоновая запись истории
+    history_writer.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # последние правки опросов уходят в очередь Telegram, очередь — в чаты; остаток снимается
+        if not await poll_renders.close(SHUTDOWN_TIMEOUT):
+            logger.warning("Poll renders not finished in %ss", SHUTDOWN_TIMEOUT)
+        if not await telegram.drain(SHUTDOWN_TIMEOUT):
+            logger.warning("Telegram queue not drained in %ss: %d left", SHUTDOWN_TIMEOUT, telegram.depth())
+        telegram.close()
+        # дописываем всё, что не успело уйти на диск
+        await history_writer.close()
+        jobs.shutdown()
+        logger.info("Jobs: %s", jobs.stats())
+        logger.info("Telegram queue: %s, poll renders: %s", telegram.stats(), poll_renders.stats())
+        logger.info("Votes answered: %s, message updated: %s", vote_answered.stats(), vote_updated.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+# participant.py
+"""
+Участник опроса — общий тип для active_poll и записей истории в памяти.
+
+В JSON (снимок, журнал, архив) участник хранится как
+    {"uid": int, "username": str | null, "fullname": str | null}
+и превращается в Participant при чтении; обратно — через to_json() / json_default.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+
+@dataclass(frozen=True, slots=True)
+class Participant:
+    uid: int
+    username: Optional[str] = None
+    fullname: Optional[str] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"uid": self.uid, "username": self.username, "fullname": self.fullname}
+
+    @classmethod
+    def from_json(cls, data) -> "Participant":
+        """dict из JSON (или уже Participant) -> Participant."""
+        if isinstance(data, cls):
+            return data
+        return cls(data.get("uid"), data.get("username"), data.get("fullname"))
+
+
+def decode_participants(data: Optional[Iterable]) -> List[Participant]:
+    return [Participant.from_json(p) for p in data or []]
+
+
+def decode_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись истории из JSON: участники -> Participant (на месте)."""
+    if isinstance(entry.get("participants"), list):
+        entry["participants"] = decode_participants(entry["participants"])
+    return entry
+
+
+def json_default(obj):
+    """default= для json.dumps: Participant -> dict."""
+    if isinstance(obj, Participant):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
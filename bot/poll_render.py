@@ -0,0 +1,204 @@
+# poll_render.py
+"""
+Очередь перерисовки сообщений опросов.
+
+На каждое сообщение (chat_id, message_id) — одна задача правки:
+    submit()  — изменение попадает в окно delay; все изменения за окно дают одну правку
+    flush()   — правка без ожидания окна (закрытие опроса, правка админом), с результатом
+Приоритет правки (tg_scheduler) — наивысший из изменений, вошедших в неё; если правка ещё ждёт
+в очереди Telegram (лимиты, пауза после 429), а изменение не менее важно, она снимается
+и текст перерисовывается по последнему состоянию.
+render() вызывается прямо перед правкой и возвращает (text, reply_markup) по текущему
+состоянию опроса (None — править нечего), поэтому в чат уходит последний вариант.
+Одновременно по сообщению идёт не больше одной правки; одинаковый текст повторно не отправляется.
+Если send упал (сеть, ошибка сервера), правка повторяется через RETRY_DELAYS по последнему состоянию —
+каждое изменение доходит до чата хотя бы раз, пока опрос не закрыт.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Render = Callable[[], Optional[Tuple[str, Any]]]
+# send(chat_id, message_id, text, reply_markup, priority) -> получилось ли; None — правка снята в очереди
+Send = Callable[[int, int, str, Any, int], Awaitable[Optional[bool]]]
+# supersede((chat_id, message_id), priority) — снять ждущую правку менее важного приоритета
+Supersede = Callable[[Tuple[int, int], int], Any]
+
+# как часто писать в лог счётчики (число изменений)
+LOG_EVERY = 200
+# паузы (сек) перед повтором упавшей правки; после последней ждущие получают False
+RETRY_DELAYS = (1, 2, 5, 10, 30)
+
+
+class _Slot:
+    __slots__ = ("render", "after", "priority", "after_priority", "sending", "waiters", "task", "wake", "last_text",
+                 "forget", "failures")
+
+    def __init__(self):
+        self.render: Optional[Render] = None
+        # приоритет ждущих изменений и правки, отправленной сейчас (None — не отправляется)
+        self.priority: Optional[int] = None
+        self.after_priority: Optional[int] = None
+        self.sending: Optional[int] = None
+        # обычная перерисовка, пришедшая, пока ждёт срочная: идёт следом, а не вместо
+        self.after: Optional[Render] = None
+        self.waiters: List[asyncio.Future] = []
+        self.task: Optional[asyncio.Task] = None
+        self.wake = asyncio.Event()
+        self.last_text: Optional[str] = None
+        self.forget = False
+        # упавших подряд правок
+        self.failures = 0
+
+    def requeue(self, render: Render, waiters: List[asyncio.Future], priority: Optional[int]):
+        """Возвращает неудавшуюся правку: её ждущие получат результат следующей."""
+        self.waiters[:0] = waiters
+        if self.render is None:
+            self.render = render
+        if priority is not None:
+            self.priority = priority if self.priority is None else min(self.priority, priority)
+
+
+class PollRenderQueue:
+    def __init__(self, send: Send, delay: float = 0.5, supersede: Optional[Supersede] = None):
+        self.send = send
+        self.delay = delay
+        self.supersede = supersede
+        self._slots: Dict[Tuple[int, int], _Slot] = {}
+        # изменений, правок в Telegram, пропущено (текст не изменился), ошибок
+        self.requests = 0
+        self.edits = 0
+        self.skipped = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def submit(self, chat_id: int, message_id: int, render: Render, priority: int = 0, urgent: bool = False) -> asyncio.Future:
+        """Ставит перерисовку; future -> True, если в чате последний вариант текста."""
+        key = (chat_id, message_id)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+        if urgent or not slot.wake.is_set():
+            slot.render = render
+            slot.priority = priority if slot.priority is None else min(slot.priority, priority)
+        else:
+            slot.after = render
+            slot.after_priority = priority if slot.after_priority is None else min(slot.after_priority, priority)
+        if slot.sending is not None and priority <= slot.sending and self.supersede is not None:
+            self.supersede(key, priority)
+        waiter = asyncio.get_running_loop().create_future()
+        slot.waiters.append(waiter)
+        if urgent:
+            slot.wake.set()
+        if slot.task is None:
+            slot.task = asyncio.create_task(self._drain(key, slot))
+        self.requests += 1
+        if self.requests % LOG_EVERY == 0:
+            logger.info("Poll renders: %s", self.stats())
+        return waiter
+
+    async def flush(self, chat_id: int, message_id: int, render: Render, priority: int = 0) -> bool:
+        """Перерисовка без окна; ждёт правку (и ту, что уже идёт по этому сообщению)."""
+        return await self.submit(chat_id, message_id, render, priority, urgent=True)
+
+    def forget(self, chat_id: int, message_id: int):
+        """
+        Сообщение больше не правится (опрос закрыт) — убираем его состояние.
+        Если правка ещё идёт, слот удаляется после последней: поздние submit (таймер, голос) его не оживляют.
+        """
+        slot = self._slots.get((chat_id, message_id))
+        if slot is None:
+            return
+        if slot.task is None:
+            del self._slots[(chat_id, message_id)]
+        else:
+            slot.forget = True
+
+    async def close(self, timeout: float) -> bool:
+        """
+        Остановка бота: ждущие окна правки уходят сразу, ждём все правки не дольше timeout.
+        -> False, если что-то не успело (повтор после ошибки, долгая очередь Telegram).
+        """
+        for slot in self._slots.values():
+            slot.wake.set()
+        tasks = [slot.task for slot in self._slots.values() if slot.task is not None]
+        if not tasks:
+            return True
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+    async def _drain(self, key: Tuple[int, int], slot: _Slot):
+        try:
+            while slot.render is not None:
+                if not slot.wake.is_set():
+                    try:
+                        await asyncio.wait_for(slot.wake.wait(), self.delay)
+                    except asyncio.TimeoutError:
+                        pass
+                render, waiters, priority = slot.render, slot.waiters, slot.priority
+                slot.render, slot.after, slot.waiters = slot.after, None, []
+                slot.priority, slot.after_priority = slot.after_priority, None
+                slot.wake.clear()
+                slot.sending = priority
+                try:
+                    ok = await self._edit(key, slot, render, priority)
+                except Exception as e:
+                    self.errors += 1
+                    if slot.failures < len(RETRY_DELAYS):
+                        delay = RETRY_DELAYS[slot.failures]
+                        slot.failures += 1
+                        logger.warning("Poll edit failed chat=%s message=%s, retry in %ss: %s", key[0], key[1], delay, e)
+                        slot.requeue(render, waiters, priority)
+                        await asyncio.sleep(delay)
+                        continue
+                    logger.error("Poll edit failed chat=%s message=%s, giving up: %s", key[0], key[1], e)
+                    ok = False
+                finally:
+                    slot.sending = None
+                if ok is None:
+                    # правку сняли ради более важной
+                    slot.requeue(render, waiters, priority)
+                    continue
+                slot.failures = 0
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(ok)
+        finally:
+            slot.task = None
+            if slot.forget and self._slots.get(key) is slot:
+                del self._slots[key]
+
+    async def _edit(self, key: Tuple[int, int], slot: _Slot, render: Render, priority: int) -> Optional[bool]:
+        """Одна правка; исключение send уходит в _drain на повтор."""
+        chat_id, message_id = key
+        try:
+            rendered = render()
+        except Exception as e:
+            self.errors += 1
+            logger.exception("Poll render failed chat=%s message=%s: %s", chat_id, message_id, e)
+            return False
+        if rendered is None:
+            # опрос уже не наш (закрыт, заменён) — слот после правки не нужен
+            slot.forget = True
+            self.skipped += 1
+            return False
+        text, reply_markup = rendered
+        if text == slot.last_text:
+            self.skipped += 1
+            return True
+        ok = await self.send(chat_id, message_id, text, reply_markup, priority)
+        if ok is None:
+            self.dropped += 1
+        elif ok:
+            self.edits += 1
+            slot.last_text = text
+        else:
+            self.errors += 1
+        return ok
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "edits": self.edits, "skipped": self.skipped,
+                "coalesced": self.requests - self.edits - self.skipped - self.errors - self.dropped,
+                "errors": self.errors, "dropped": self.dropped, "messages": len(self._slots)}
@@ -0,0 +1,51 @@
+# render_cache.py
+"""
+Кэш готовых ответов команд только для чтения (/top_*, /schedule, /help).
+
+Ключ — (команда, аргументы, версии данных). Версии растут при изменении истории
+и настроек, поэтому старые ответы не удаляются явно: их ключи больше не совпадут,
+и они уходят по LRU.
+"""
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+# как часто писать в лог долю попаданий (число обращений)
+LOG_EVERY = 500
+
+
+class RenderCache:
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key: Hashable, render: Callable[[], Any]) -> Any:
+        """Готовый ответ по ключу; при промахе — render() и запоминание."""
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            value = self._items[key] = render()
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        else:
+            self.hits += 1
+            self._items.move_to_end(key)
+        if (self.hits + self.misses) % LOG_EVERY == 0:
+            logger.info("Render cache: %s", self.stats())
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items),
+                "hit_rate": round(self.hit_rate(), 3)}
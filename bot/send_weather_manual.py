@@ -4,8 +4,9 @@ import asyncio
 from aiogram import Bot
 
 from .weatherapi_async import WeatherAPI
-from .config import BOT_TOKEN, WEATHERAPI_KEY, LAT, LON, root_chat_id
+from .config import BOT_TOKEN, WEATHERAPI_KEY, LAT, LON, root_chat_id, TG_GLOBAL_RATE, TG_GROUP_RATE, TG_PRIVATE_RATE, TG_CHAT_BURST
 from .weather_auto import send_weather
+from .tg_scheduler import TelegramScheduler
 
 
 async def main():
@@ -17,11 +18,14 @@ async def main():
         cache_ttl=300
     )
 
-    
+    # те же лимиты Telegram, что и у бота
+    telegram = TelegramScheduler(TG_GLOBAL_RATE, TG_GROUP_RATE, TG_PRIVATE_RATE, TG_CHAT_BURST)
 
-    await send_weather(bot, root_chat_id, weather_client)
-
-    await bot.session.close()  # корректно закрываем сессию
+    try:
+        await send_weather(bot, root_chat_id, weather_client, telegram)
+    finally:
+        telegram.close()
+        await bot.session.close()  # корректно закрываем сессию
 
 
 if __name__ == "__main__":
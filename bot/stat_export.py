@@ -0,0 +1,149 @@
+# stat_export.py
+"""
+Потоковая CSV-выгрузка /stat.
+
+Строки участия не собираются в один список:
+    spill_runs()   — отсортированные куски по RUN_SIZE строк, полные куски уходят во временные файлы
+    merge_runs()   — слияние кусков (heapq.merge) в общем порядке, равные ключи — в порядке источника
+    write_csv()    — CSV сразу в gzip/zip поток во SpooledTemporaryFile (до SPOOL_LIMIT — в памяти)
+    export_csv()   — всё вместе по строкам участия; вызывается в пуле задач над снимком истории
+    SpooledInputFile — отправка файла кусками, без чтения целиком в bytes
+Память ограничена размером куска, а не историей.
+"""
+import csv
+import gzip
+import heapq
+import io
+import logging
+import pickle
+import tempfile
+import zipfile
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from aiogram.types import InputFile
+
+logger = logging.getLogger(__name__)
+
+RUN_SIZE = 50_000
+SPOOL_LIMIT = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+FIELDNAMES = ["uid", "fullname", "username", "expires_at", "command"]
+# расширение файла для каждого вида сжатия
+EXTENSIONS = {"zip": "csv.zip", "gzip": "csv.gz", "none": "csv"}
+
+
+# -----------------------------
+# СОРТИРОВКА КУСКАМИ
+# -----------------------------
+def _spill(run: List[Dict[str, Any]]):
+    f = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    for row in run:
+        pickler.dump(row)
+    f.seek(0)
+    return f
+
+
+def _read_run(f) -> Iterator[Dict[str, Any]]:
+    unpickler = pickle.Unpickler(f)
+    try:
+        while True:
+            yield unpickler.load()
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+
+def spill_runs(rows: Iterable[Dict[str, Any]], key: Callable, run_size: int = RUN_SIZE) -> Tuple[list, List[Dict[str, Any]], int]:
+    """
+    -> (временные файлы с отсортированными кусками, последний кусок в памяти, число строк).
+    Источник читается один раз и целиком здесь — дальше история не нужна.
+    """
+    spilled, run, count = [], [], 0
+    for row in rows:
+        run.append(row)
+        count += 1
+        if len(run) >= run_size:
+            run.sort(key=key)
+            spilled.append(_spill(run))
+            run = []
+    run.sort(key=key)
+    if spilled:
+        logger.info("Stat export: %d rows in %d sorted runs", count, len(spilled) + 1)
+    return spilled, run, count
+
+
+def merge_runs(spilled: list, tail: List[Dict[str, Any]], key: Callable) -> Iterator[Dict[str, Any]]:
+    """Строки всех кусков по key; heapq.merge стабилен, куски идут в порядке источника."""
+    if not spilled:
+        return iter(tail)
+    return heapq.merge(*(_read_run(f) for f in spilled), tail, key=key)
+
+
+# -----------------------------
+# ЗАПИСЬ
+# -----------------------------
+def write_csv(rows: Iterable[Dict[str, Any]], compression: str, name: str) -> tempfile.SpooledTemporaryFile:
+    """CSV (FIELDNAMES) в сжатый поток; name — имя файла внутри zip. Файл возвращается с позицией 0."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_LIMIT)
+    if compression == "zip":
+        archive = zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED)
+        raw = archive.open(name, "w", force_zip64=True)
+    elif compression == "gzip":
+        archive = None
+        raw = gzip.GzipFile(filename=name, mode="wb", fileobj=spool)
+    else:
+        archive = None
+        raw = spool
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.DictWriter(text, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+    if raw is spool:
+        text.flush()
+        text.detach()
+    else:
+        text.close()
+    if archive is not None:
+        archive.close()
+    spool.seek(0)
+    return spool
+
+
+def _export_order(row: Dict[str, Any]):
+    return row["expires_at"], row["command"]
+
+
+def export_rows(participations: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Строки участия -> строки CSV: дата тренировки вместо expires_at, строки без даты пропускаются."""
+    for row in participations:
+        # дата тренировки уже разобрана при загрузке записи
+        expires_date = row.pop("date")
+        if expires_date is None:
+            continue
+        row["expires_at"] = expires_date
+        yield row
+
+
+def export_csv(participations: Iterable[Dict[str, Any]], compression: str, name: str):
+    """
+    -> (сжатый CSV, упорядоченный по дате и типу, число строк); без строк — (None, 0).
+    """
+    spilled, tail, count = spill_runs(export_rows(participations), _export_order)
+    if not count:
+        return None, 0
+    return write_csv(merge_runs(spilled, tail, _export_order), compression, name), count
+
+
+class SpooledInputFile(InputFile):
+    """Отправка уже записанного файла кусками (с начала при каждом чтении); закрывает вызывающий."""
+
+    def __init__(self, file, filename: str, chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
@@ -0,0 +1,76 @@
+# stat_report.py
+"""
+XLSX-отчёт /stat на pandas.
+
+Всё идёт в пуле задач (jobs.py), не в цикле бота: extract_columns() раскладывает по колонкам
+строки участия из неизменяемого снимка истории (HistorySnapshot.participations) или уже
+выбранные строки одного пользователя, затем build_xlsx() строит листы на DataFrame:
+
+    Участия         все строки, по дате и типу
+    По месяцам      участник × месяц, число дней тренировок
+    По типам        участник × тип тренировки
+    По дням недели  участник × день недели
+"""
+import io
+from typing import Any, Dict, Iterable, List
+
+import pandas as pd
+
+COLUMNS = ("uid", "fullname", "username", "date", "command")
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+# заголовок колонки «По типам» для опросов без команды
+NO_COMMAND = "(без команды)"
+
+
+def extract_columns(rows: Iterable[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """Строки {uid, fullname, username, date, command} -> колонки; строки без даты пропускаются."""
+    columns: Dict[str, List[Any]] = {name: [] for name in COLUMNS}
+    appends = [columns[name].append for name in COLUMNS]
+    for row in rows:
+        if row.get("date") is None:
+            continue
+        for append, name in zip(appends, COLUMNS):
+            append(row.get(name))
+    return columns
+
+
+def _frame(columns: Dict[str, List[Any]]) -> pd.DataFrame:
+    df = pd.DataFrame(columns, columns=list(COLUMNS))
+    df["date"] = pd.to_datetime(df["date"])
+    df["command"] = df["command"].fillna("").astype(str)
+    df = df.sort_values(["date", "command"], kind="stable").reset_index(drop=True)
+    # подпись участника — из последней по дате строки, где она была
+    label = ("@" + df["username"].where(df["username"].fillna("") != "")).fillna(
+        df["fullname"].where(df["fullname"].fillna("") != ""))
+    names = label.groupby(df["uid"]).last()
+    df["name"] = df["uid"].map(names).fillna("")
+    return df
+
+
+def _pivot(df: pd.DataFrame, columns: str, order: List[Any] = None) -> pd.DataFrame:
+    """Участник × columns: число разных дней тренировок, в конце — итог."""
+    table = df.pivot_table(index=["uid", "name"], columns=columns, values="date",
+                           aggfunc="nunique", fill_value=0, observed=False)
+    if order is not None:
+        table = table.reindex(columns=order, fill_value=0)
+    table["Итого"] = df.groupby(["uid", "name"])["date"].nunique()
+    return table.sort_values("Итого", ascending=False, kind="stable")
+
+
+def build_xlsx(columns: Dict[str, List[Any]]) -> bytes:
+    df = _frame(columns)
+    raw = df[["uid", "fullname", "username", "date", "command"]].copy()
+    raw["date"] = raw["date"].dt.date
+
+    by_month = _pivot(df.assign(month=df["date"].dt.strftime("%Y-%m")), "month")
+    by_command = _pivot(df.assign(command=df["command"].replace("", NO_COMMAND)), "command")
+    weekday = pd.Categorical.from_codes(df["date"].dt.weekday, categories=WEEKDAYS)
+    by_weekday = _pivot(df.assign(weekday=weekday), "weekday", WEEKDAYS)
+
+    out = io.BytesIO()
+    with pd.ExcelWriter(out, engine="openpyxl") as writer:
+        raw.to_excel(writer, sheet_name="Участия", index=False)
+        by_month.to_excel(writer, sheet_name="По месяцам")
+        by_command.to_excel(writer, sheet_name="По типам")
+        by_weekday.to_excel(writer, sheet_name="По дням недели")
+    return out.getvalue()
@@ -0,0 +1,432 @@
+# tg_scheduler.py
+"""
+Планировщик исходящих запросов к Telegram (правки, отправка, закрепление).
+
+Запрос ждёт токен в двух корзинах (token bucket):
+    общей      — GLOBAL_RATE запросов в секунду на бота
+    чата       — GROUP_RATE для групп, PRIVATE_RATE для личных чатов
+Из готовых к отправке первым уходит запрос с более высоким приоритетом:
+    PRIORITY_HIGH   — голоса, закрытие и публикация опроса, правки админа
+    PRIORITY_NORMAL — прочие сообщения (погода при публикации, ответы по таймеру сессии)
+    PRIORITY_LOW    — обновление таймера опроса и погоды
+У запроса может быть ключ (например, ("edit", chat_id, message_id)): новый запрос с тем же ключом
+снимает из очереди ещё не отправленный запрос не выше своего приоритета — тот получает Superseded.
+
+На TelegramRetryAfter (429) чат замирает на retry_after секунд, а запрос паркуется — возвращается
+в начало своей очереди и уйдёт, когда чат разморозится. Припаркованный запрос с ключом снимается
+любым новым запросом с тем же ключом: после паузы уходит только последняя правка сообщения.
+Время и число таких пауз — в stats()["throttled"].
+
+Внутри приоритета запросы лежат по чатам (FIFO), а чаты — в куче по моменту, когда у чата будет токен:
+выбор следующего запроса стоит O(log числа чатов), а не проход по всей очереди.
+close() снимает всё, что ещё ждёт отправки (и припаркованное): такие запросы получают SchedulerClosed;
+перед ним drain() даёт очереди уйти.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_NAMES = ("high", "normal", "low")
+
+# как часто писать в лог метрики очереди (число отправленных запросов)
+LOG_EVERY = 200
+# сколько раз запрос паркуется по 429, прежде чем ошибка уйдёт вызывающему
+MAX_RETRIES = 5
+
+
+class Superseded(Exception):
+    """Запрос снят из очереди: его результат перекрыт более новым запросом с тем же ключом."""
+
+
+class SchedulerClosed(Exception):
+    """Планировщик закрыт (close()), а запрос так и не был отправлен."""
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        # заморозка по 429: до этого момента токенов нет
+        self.blocked_until = 0.0
+
+    def ready_in(self, now: float) -> float:
+        """Через сколько секунд будет целый токен (0 — уже есть)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until: float):
+        """Заморозка после 429; после неё корзина начинает с нуля, без накопленного запаса."""
+        if until > self.blocked_until:
+            self.blocked_until = until
+            self.tokens = 0
+            self.updated = until
+
+
+class _Request:
+    __slots__ = ("chat_id", "priority", "key", "call", "future", "queued", "seq", "retries", "parked_at", "stale")
+
+    def __init__(self, chat_id, priority, key, call, future, queued, seq):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.call = call
+        self.future = future
+        self.queued = queued
+        # порядок постановки: различает запросы с одинаковым queued в куче
+        self.seq = seq
+        self.retries = 0
+        # когда запрос припаркован по 429 (None — не припаркован)
+        self.parked_at: Optional[float] = None
+        # пока запрос отправлялся, его перекрыли: на 429 он не паркуется
+        self.stale = False
+
+
+class _Lane:
+    """
+    Очередь одного приоритета: запросы по чатам и куча чатов (ready_at, seq головы, chat_id).
+    ready_at — нижняя граница момента, когда у чата будет токен: корзина со временем только наполняется,
+    поэтому запись может быть лишь раньше правды и уточняется, когда доходит до вершины кучи.
+    Записи с seq не текущей головы чата устарели и выбрасываются при выборе.
+    """
+    __slots__ = ("chats", "heap")
+
+    def __init__(self):
+        self.chats: Dict[int, Deque[_Request]] = {}
+        self.heap: List[Tuple[float, int, int]] = []
+
+    def __len__(self):
+        return sum(map(len, self.chats.values()))
+
+    def __iter__(self):
+        for queue in self.chats.values():
+            yield from queue
+
+    def push(self, req: _Request, ready_at: float, first: bool = False):
+        """Запрос в очередь своего чата (first — в начало); новая голова чата попадает в кучу."""
+        queue = self.chats.get(req.chat_id)
+        if queue is None:
+            queue = self.chats[req.chat_id] = deque()
+        if first:
+            queue.appendleft(req)
+        else:
+            queue.append(req)
+        if queue[0] is req:
+            heapq.heappush(self.heap, (ready_at, req.seq, req.chat_id))
+
+    def remove(self, req: _Request, ready_at: float):
+        """Снимает запрос из очереди чата; если это была голова — в кучу идёт следующий."""
+        queue = self.chats[req.chat_id]
+        head = queue[0] is req
+        queue.remove(req)
+        if not queue:
+            del self.chats[req.chat_id]
+        elif head:
+            heapq.heappush(self.heap, (ready_at, queue[0].seq, req.chat_id))
+
+    def head(self) -> Optional[Tuple[float, _Request]]:
+        """-> (ready_at, голова чата) с вершины кучи; устаревшие записи выбрасываются."""
+        while self.heap:
+            ready_at, seq, chat_id = self.heap[0]
+            queue = self.chats.get(chat_id)
+            if queue and queue[0].seq == seq:
+                return ready_at, queue[0]
+            heapq.heappop(self.heap)
+        return None
+
+
+class _PriorityStats:
+    __slots__ = ("depth", "max_depth", "sent", "dropped", "errors", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        n = self.sent or 1
+        return {"depth": self.depth, "max_depth": self.max_depth, "sent": self.sent,
+                "dropped": self.dropped, "errors": self.errors,
+                "wait_avg_ms": round(self.wait_total / n * 1000, 1),
+                "wait_max_ms": round(self.wait_max * 1000, 1)}
+
+
+class TelegramScheduler:
+    def __init__(self, global_rate: float = 30.0, group_rate: float = 20 / 60, private_rate: float = 1.0,
+                 chat_burst: float = 3.0):
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, global_rate, now)
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.chat_burst = chat_burst
+        self._chats: Dict[int, TokenBucket] = {}
+        self._lanes: Tuple[_Lane, ...] = tuple(_Lane() for _ in PRIORITY_NAMES)
+        self._seq = itertools.count()
+        # ключ -> ждущие отправки запросы с ним (более важный, который новый не снял, остаётся)
+        self._keys: Dict[Hashable, List[_Request]] = {}
+        self._inflight: Dict[Hashable, _Request] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._running = set()
+        self._closed = False
+        self.metrics: List[_PriorityStats] = [_PriorityStats() for _ in PRIORITY_NAMES]
+        # 429: сколько раз, сумма retry_after, сколько запросы простояли припаркованными, сколько снято новыми
+        self.throttled = 0
+        self.retry_after_total = 0.0
+        self.parked_total = 0.0
+        self.parked_dropped = 0
+
+    # -----------------------------
+    # ПОСТАНОВКА В ОЧЕРЕДЬ
+    # -----------------------------
+    async def call(self, chat_id, fn: Callable[..., Any], /, *args, priority: int = PRIORITY_NORMAL,
+                   key: Optional[Hashable] = None, **kwargs) -> Any:
+        """
+        await fn(*args, **kwargs) в свою очередь по корзинам; Superseded, если запрос снят новым с тем же ключом,
+        SchedulerClosed — если планировщик закрыт до отправки.
+        """
+        if self._closed:
+            raise SchedulerClosed()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        if key is not None:
+            self.supersede(key, priority)
+        future = asyncio.get_running_loop().create_future()
+        now = time.monotonic()
+        req = _Request(int(chat_id), priority, key, lambda: fn(*args, **kwargs), future, now, next(self._seq))
+        self._lanes[priority].push(req, now + self._chat_bucket(req.chat_id, now).ready_in(now))
+        if key is not None:
+            self._keys.setdefault(key, []).append(req)
+        stats = self.metrics[priority]
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        self._wakeup.set()
+        return await future
+
+    def supersede(self, key: Hashable, priority: int) -> bool:
+        """Снимает ещё не отправленные запросы с ключом key, которые не важнее priority или припаркованы."""
+        sending = self._inflight.get(key)
+        if sending is not None:
+            sending.stale = True
+        pending = self._keys.get(key)
+        if not pending:
+            return False
+        keep = [old for old in pending if old.priority < priority and old.parked_at is None]
+        if len(keep) == len(pending):
+            return False
+        if keep:
+            self._keys[key] = keep
+        else:
+            del self._keys[key]
+        now = time.monotonic()
+        for old in pending:
+            if old in keep:
+                continue
+            if old.parked_at is not None:
+                self.parked_dropped += 1
+            self._lanes[old.priority].remove(old, now)
+            stats = self.metrics[old.priority]
+            stats.depth -= 1
+            stats.dropped += 1
+            if not old.future.done():
+                old.future.set_exception(Superseded(key))
+        return True
+
+    def _unkey(self, req: _Request):
+        pending = self._keys.get(req.key)
+        if pending is not None and req in pending:
+            pending.remove(req)
+            if not pending:
+                del self._keys[req.key]
+
+    # -----------------------------
+    # ОТПРАВКА
+    # -----------------------------
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _next(self, now: float) -> Tuple[Optional[_Request], Optional[float]]:
+        """-> (запрос к отправке, None) или (None, сколько ждать; None — очередь пуста)."""
+        wait = None
+        global_wait = self.global_bucket.ready_in(now)
+        for lane in self._lanes:
+            while True:
+                top = lane.head()
+                if top is None:
+                    break
+                ready_at, req = top
+                if req.future.done():
+                    # вызывающий уже не ждёт (отмена) — выбросим при отправке
+                    return req, None
+                chat_wait = self._chat_bucket(req.chat_id, now).ready_in(now)
+                if chat_wait > 0 and now + chat_wait > ready_at:
+                    # у чата токен позже, чем записано в куче (его взяли, чат заморожен) — уточняем
+                    heapq.heapreplace(lane.heap, (now + chat_wait, req.seq, req.chat_id))
+                    continue
+                ready_in = max(chat_wait, global_wait)
+                if ready_in == 0:
+                    return req, None
+                wait = ready_in if wait is None else min(wait, ready_in)
+                break
+        return None, wait
+
+    async def _run(self):
+        while True:
+            try:
+                await self._dispatch_next()
+            except Exception as e:
+                logger.exception("Error in Telegram scheduler: %s", e)
+                await asyncio.sleep(1)
+
+    async def _dispatch_next(self):
+        now = time.monotonic()
+        req, wait = self._next(now)
+        if req is None:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            return
+        if req.key is not None:
+            self._unkey(req)
+        stats = self.metrics[req.priority]
+        stats.depth -= 1
+        if req.future.done():
+            self._lanes[req.priority].remove(req, now)
+            stats.dropped += 1
+            return
+        self.global_bucket.take()
+        bucket = self._chat_bucket(req.chat_id, now)
+        bucket.take()
+        self._lanes[req.priority].remove(req, now + bucket.ready_in(now))
+        if req.parked_at is not None:
+            self.parked_total += now - req.parked_at
+            req.parked_at = None
+        waited = now - req.queued
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        if req.key is not None:
+            self._inflight[req.key] = req
+        task = asyncio.create_task(self._execute(req, stats))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _execute(self, req: _Request, stats: _PriorityStats):
+        try:
+            try:
+                result = await req.call()
+            finally:
+                if req.key is not None and self._inflight.get(req.key) is req:
+                    del self._inflight[req.key]
+        except TelegramRetryAfter as e:
+            if self._closed:
+                # после close() не паркуем: ждать отправки больше некому
+                stats.errors += 1
+                if not req.future.done():
+                    req.future.set_exception(SchedulerClosed())
+                return
+            if req.retries < MAX_RETRIES and not req.future.done():
+                self._park(req, e.retry_after)
+                return
+            stats.errors += 1
+            if not req.future.done():
+                req.future.set_exception(e)
+        except Exception as e:
+            stats.errors += 1
+            if not req.future.done():
+                req.future.set_exception(e)
+        else:
+            if not req.future.done():
+                req.future.set_result(result)
+        stats.sent += 1
+        if sum(s.sent for s in self.metrics) % LOG_EVERY == 0:
+            logger.info("Telegram queue: %s", self.stats())
+
+    def _park(self, req: _Request, retry_after: float):
+        """429: замораживаем чат и возвращаем запрос в начало очереди (если его не перекрыл более новый)."""
+        now = time.monotonic()
+        self.throttled += 1
+        self.retry_after_total += retry_after
+        self._chat_bucket(req.chat_id, now).block(now + retry_after)
+        logger.warning("Telegram flood control: chat %s paused for %ss (%s)", req.chat_id, retry_after,
+                       PRIORITY_NAMES[req.priority])
+        if req.stale or (req.key is not None and req.key in self._keys):
+            # пока запрос отправлялся, пришёл новый с тем же ключом — старый уже не нужен
+            self.parked_dropped += 1
+            self.metrics[req.priority].dropped += 1
+            req.future.set_exception(Superseded(req.key))
+            return
+        req.retries += 1
+        req.parked_at = now
+        self._lanes[req.priority].push(req, now + retry_after, first=True)
+        if req.key is not None:
+            self._keys.setdefault(req.key, []).append(req)
+        stats = self.metrics[req.priority]
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        self._wakeup.set()
+
+    def depth(self) -> int:
+        return sum(map(len, self._lanes))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {name: s.as_dict() for name, s in zip(PRIORITY_NAMES, self.metrics)}
+        stats["throttled"] = {"count": self.throttled, "retry_after_s": round(self.retry_after_total, 1),
+                              "parked_s": round(self.parked_total, 1), "parked_dropped": self.parked_dropped}
+        return stats
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт, пока очередь опустеет и отправки закончатся, не дольше timeout; -> успели ли."""
+        deadline = time.monotonic() + timeout
+        while self.depth() or self._running:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def close(self):
+        """Останавливает отправку; ждущие и припаркованные запросы получают SchedulerClosed."""
+        self._closed = True
+        if self._worker is not None:
+            self._worker.cancel()
+        for lane, stats in zip(self._lanes, self.metrics):
+            for req in lane:
+                stats.dropped += 1
+                if not req.future.done():
+                    req.future.set_exception(SchedulerClosed())
+            stats.depth = 0
+            lane.chats.clear()
+            lane.heap.clear()
+        self._keys.clear()
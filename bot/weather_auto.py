@@ -7,6 +7,7 @@ import logging
 
 from aiogram import Bot
 from .config import LOCAL_TZ  # ваш локальный часовой пояс
+from .tg_scheduler import PRIORITY_LOW, PRIORITY_NORMAL, SchedulerClosed, Superseded, TelegramScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -50,7 +51,7 @@ def save_weather_messages():
 # =============================
 #     ОТПРАВКА ПОГОДЫ
 # =============================
-async def send_weather(bot: Bot, chat_id: int, weather_client):
+async def send_weather(bot: Bot, chat_id: int, weather_client, scheduler: TelegramScheduler):
     """
     Отправляет новый прогноз + сохраняет сообщение.
     """
@@ -74,7 +75,8 @@ async def send_weather(bot: Bot, chat_id: int, weather_client):
 
 
     try:
-        msg = await bot.send_message(chat_id, text, parse_mode="HTML")
+        msg = await scheduler.call(chat_id, bot.send_message, chat_id, text, parse_mode="HTML",
+                                   priority=PRIORITY_NORMAL)
     except Exception as e:
         logger.warning(f"Failed to send weather to chat {chat_id}: {e}")
         return None
@@ -92,7 +94,7 @@ async def send_weather(bot: Bot, chat_id: int, weather_client):
 # =============================
 #     ОБНОВЛЕНИЕ ПОГОДЫ
 # =============================
-async def weather_updater(bot: Bot, weather_client):
+async def weather_updater(bot: Bot, weather_client, scheduler: TelegramScheduler):
     """
     Обновляет погоду каждые N минут, удаляет записи при ошибке,
     очищает историю в полночь.
@@ -140,12 +142,22 @@ async def weather_updater(bot: Bot, weather_client):
                     continue
 
                 try:
-                    await bot.edit_message_text(
+                    await scheduler.call(
+                        chat_id,
+                        bot.edit_message_text,
                         new_text,
                         chat_id=chat_id,
                         message_id=message_id,
-                        parse_mode="HTML"
+                        parse_mode="HTML",
+                        priority=PRIORITY_LOW,
+                        key=("edit", int(chat_id), message_id)
                     )
+                except Superseded:
+                    # сообщение уже правится более важным запросом — обновим в следующий проход
+                    continue
+                except SchedulerClosed:
+                    # бот останавливается — запись о сообщении не трогаем
+                    return
                 except Exception as e:
                     logger.warning(
                         f"[weather_updater] Failed to edit message chat={chat_id}: {e} — removing entry"
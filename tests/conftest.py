@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# пакет bot импортируется из корня репозитория, без установки
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
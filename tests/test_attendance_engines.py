@@ -0,0 +1,133 @@
+"""Инкрементальные счётчики и матрица против эталонного scan_attendance()."""
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from bot.attendance_stats import (AttendanceAggregator, AttendanceDays, AttendanceSummary, compare_reports,
+                                  scan_attendance)
+from bot.bench_history import synthetic_history
+from bot.entry_times import expires_ts, local_bounds, stamp_all
+from bot.history_view import thaw
+from bot.participant import Participant, decode_entry
+
+KINDS = ("all", "saber", "rapier", "openfight")
+
+
+@pytest.fixture
+def entries():
+    entries = [decode_entry(e) for e in synthetic_history(600, users=40, seed=7)]
+    for i, entry in enumerate(entries):
+        # немного опросов с кворумом и меньше чем 4 участника
+        if i % 11 == 0:
+            entry["quorum"] = True
+            entry["participants"] = entry["participants"][:2]
+    stamp_all(entries)
+    return entries
+
+
+def _closed(entries, since, until):
+    since_ts, until_ts = since.timestamp(), until.timestamp()
+    return [e for e in entries if not e.get("active") and since_ts <= expires_ts(e) <= until_ts]
+
+
+def _expected(entries, since, until):
+    return AttendanceSummary(scan_attendance(_closed(entries, since, until), since, until))
+
+
+def _assert_same(actual, expected):
+    assert compare_reports(actual.report, expected.report) == []
+    for kind in KINDS:
+        assert actual.top(kind, 5) == expected.top(kind, 5)
+        assert actual.total_users(kind) == expected.total_users(kind)
+        assert actual.days(kind) == expected.days(kind)
+        assert actual.first_date(kind) == expected.first_date(kind)
+        for user in expected.report.get(kind, {"users": []})["users"]:
+            assert actual.place(kind, user["uid"]) == expected.place(kind, user["uid"])
+            assert actual.count(kind, user["uid"]) == expected.count(kind, user["uid"])
+
+
+def _edit(entries):
+    """Правки закрытых опросов админом: участники, кворум, тип."""
+    changed = []
+    for i, entry in enumerate(entries[5:200:17]):
+        if i % 3 == 0:
+            entry["participants"] = list(entry["participants"]) + [Participant(1, "new", "Новый")]
+        elif i % 3 == 1:
+            entry["quorum"] = not entry.get("quorum", False)
+        else:
+            entry["command"] = "rapier" if entry["command"] != "rapier" else "saber"
+        thaw(entry)
+        changed.append(entry)
+    return changed
+
+
+@pytest.mark.parametrize("days", [30, 120])
+def test_aggregator_matches_scan(entries, days):
+    until = datetime.now(timezone.utc)
+    aggregator = AttendanceAggregator(lambda since, until_: _closed(entries, since, until_), days)
+    since = until - timedelta(days=days)
+    _assert_same(aggregator.summary(until), _expected(entries, since, until))
+
+    for entry in _edit(entries):
+        aggregator.refresh(entry)
+    later = until + timedelta(days=3)
+    _assert_same(aggregator.summary(later), _expected(entries, later - timedelta(days=days), later))
+
+
+def test_attendance_days_matches_scan(entries):
+    days = AttendanceDays(lambda: entries)
+    today = datetime.now(timezone.utc).date()
+    windows = [(today - timedelta(days=60), today), (today - timedelta(days=150), today - timedelta(days=30))]
+    for first, last in windows:
+        since, until = local_bounds(first, last)
+        _assert_same(days.summary(first, last), _expected(entries, since, until))
+
+    for entry in _edit(entries):
+        days.refresh(entry)
+    for first, last in windows:
+        since, until = local_bounds(first, last)
+        _assert_same(days.summary(first, last), _expected(entries, since, until))
+
+
+def test_matrix_matches_scan(entries):
+    pytest.importorskip("numpy")
+    from bot.attendance_matrix import AttendanceMatrix
+
+    matrix = AttendanceMatrix(lambda: entries)
+    until = datetime.now(timezone.utc)
+    for days in (30, 120):
+        since = until - timedelta(days=days)
+        _assert_same(matrix.summary(since, until), _expected(entries, since, until))
+
+
+def test_equal_expiry_order_does_not_depend_on_source(entries):
+    # пары опросов с одним временем окончания: порядок решает (chat_id, message_id), а не порядок записей
+    for older, newer in zip(entries[1::4], entries[::4]):
+        older["expires_at"] = newer["expires_at"]
+    today = datetime.now(timezone.utc).date()
+    first = today - timedelta(days=120)
+    since, until = local_bounds(first, today)
+    expected = _expected(entries[::-1], since, until)
+    assert _expected(entries, since, until).report == expected.report
+
+    aggregator = AttendanceAggregator(lambda since_, until_: _closed(entries, since_, until_), 120)
+    _assert_same(aggregator.summary(until), _expected(entries[::-1], until - timedelta(days=120), until))
+    _assert_same(AttendanceDays(lambda: entries).summary(first, today), expected)
+
+    pytest.importorskip("numpy")
+    from bot.attendance_matrix import AttendanceMatrix
+    _assert_same(AttendanceMatrix(lambda: entries).summary(since, until), expected)
+
+
+def test_aggregator_state_is_not_changed_by_later_edits(entries):
+    until = datetime.now(timezone.utc)
+    aggregator = AttendanceAggregator(lambda since, until_: _closed(entries, since, until_), 120)
+    before = aggregator.summary(until)
+    expected = _expected(entries, until - timedelta(days=120), until)
+    for entry in _edit(entries):
+        aggregator.refresh(entry)
+    after = aggregator.summary(until)
+    assert after is not before
+    # прежний итог читает свой срез: правки после него его не трогают
+    _assert_same(before, expected)
+    _assert_same(after, _expected(entries, until - timedelta(days=120), until))
@@ -0,0 +1,25 @@
+from datetime import date
+
+import pytest
+
+from bot.entry_times import date_window
+
+TODAY = date(2025, 6, 30)
+
+
+@pytest.mark.parametrize("days", [1, 30, 365])
+def test_days_window_has_exactly_that_many_days(days):
+    first, last = date_window(str(days), TODAY)
+    assert last == TODAY
+    assert (last - first).days + 1 == days
+
+
+def test_date_windows_are_inclusive():
+    assert date_window("2025-01-01..2025-01-31", TODAY) == (date(2025, 1, 1), date(2025, 1, 31))
+    assert date_window("2025-06-01", TODAY) == (date(2025, 6, 1), TODAY)
+
+
+@pytest.mark.parametrize("arg", ["0", "x", "2025-02-01..2025-01-01", "99999999", "2025-01-01..9999-12-31"])
+def test_bad_windows_raise_value_error(arg):
+    with pytest.raises(ValueError):
+        date_window(arg, TODAY)
@@ -0,0 +1,55 @@
+import asyncio
+
+from bot.poll_render import PollRenderQueue
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_forgotten_slot_is_removed_after_late_submit():
+    async def scenario():
+        sent = []
+
+        async def send(chat_id, message_id, text, reply_markup, priority):
+            sent.append(text)
+            await asyncio.sleep(0.01)
+            return True
+
+        renders = PollRenderQueue(send, delay=0.01)
+        closing = renders.submit(-100, 1, lambda: ("closed", None), urgent=True)
+        await asyncio.sleep(0)
+        renders.forget(-100, 1)
+        # перерисовка по таймеру после закрытия: опроса уже нет
+        late = renders.submit(-100, 1, lambda: None)
+        results = await asyncio.gather(closing, late)
+        await asyncio.sleep(0)
+        # и после удаления слота: новый не остаётся висеть
+        await renders.submit(-100, 1, lambda: None)
+        await asyncio.sleep(0)
+        return results, sent, renders.stats()
+
+    results, sent, stats = _run(scenario())
+    assert results == [True, False]
+    assert sent == ["closed"]
+    assert stats["messages"] == 0
+
+
+def test_close_sends_pending_render_without_waiting_for_window():
+    async def scenario():
+        sent = []
+
+        async def send(chat_id, message_id, text, reply_markup, priority):
+            sent.append(text)
+            return True
+
+        renders = PollRenderQueue(send, delay=60)
+        vote = renders.submit(-100, 1, lambda: ("voted", None))
+        await asyncio.sleep(0)
+        done = await asyncio.wait_for(renders.close(5), 1)
+        return done, vote.result(), sent
+
+    done, voted, sent = _run(scenario())
+    assert done
+    assert voted is True
+    assert sent == ["voted"]
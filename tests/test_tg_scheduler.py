@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+from bot.tg_scheduler import PRIORITY_HIGH, PRIORITY_LOW, SchedulerClosed, Superseded, TelegramScheduler
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_request_parked_on_429_is_retried_after_pause():
+    async def scenario():
+        telegram = TelegramScheduler(30, 30, 30, 3)
+        calls = []
+
+        async def edit(text):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise TelegramRetryAfter(EditMessageText(text=text), "Too Many Requests", 1)
+            return text
+
+        t0 = time.monotonic()
+        try:
+            result = await telegram.call(-100, edit, "x", priority=PRIORITY_HIGH)
+        finally:
+            telegram.close()
+        return result, calls, t0, telegram.stats()
+
+    result, calls, t0, stats = _run(scenario())
+    assert result == "x"
+    assert len(calls) == 2
+    assert calls[1] - t0 >= 1
+    assert stats["throttled"]["count"] == 1
+    assert stats["high"]["sent"] == 1
+
+
+def test_parked_request_is_superseded_by_newer_with_same_key():
+    async def scenario():
+        telegram = TelegramScheduler(30, 30, 30, 3)
+        sent = []
+
+        async def edit(text):
+            if text == "old":
+                raise TelegramRetryAfter(EditMessageText(text=text), "Too Many Requests", 1)
+            sent.append(text)
+            return text
+
+        key = ("edit", -100, 1)
+        old = asyncio.ensure_future(telegram.call(-100, edit, "old", key=key))
+        await asyncio.sleep(0.1)
+        new = await telegram.call(-100, edit, "new", key=key)
+        try:
+            with pytest.raises(Superseded):
+                await old
+        finally:
+            telegram.close()
+        return new, sent, telegram.stats()
+
+    new, sent, stats = _run(scenario())
+    assert new == "new"
+    assert sent == ["new"]
+    assert stats["throttled"]["parked_dropped"] == 1
+
+
+def _queued(scenario):
+    async def run():
+        # один запрос в чат за раз: остальные ждут токена в очереди
+        telegram = TelegramScheduler(30, 0.5, 0.5, 1)
+        sent = []
+
+        async def edit(text):
+            sent.append(text)
+            return text
+
+        await telegram.call(-100, edit, "first")
+        try:
+            results = await scenario(telegram, edit)
+        finally:
+            telegram.close()
+        return results, sent
+
+    return _run(run())
+
+
+def test_queued_request_is_superseded_by_newer_with_same_key():
+    async def scenario(telegram, edit):
+        key = ("edit", -100, 1)
+        old = asyncio.ensure_future(telegram.call(-100, edit, "old", priority=PRIORITY_HIGH, key=key))
+        await asyncio.sleep(0)
+        new = asyncio.ensure_future(telegram.call(-100, edit, "new", priority=PRIORITY_HIGH, key=key))
+        return await asyncio.gather(old, new, return_exceptions=True)
+
+    (old, new), sent = _queued(scenario)
+    assert isinstance(old, Superseded)
+    assert new == "new"
+    assert sent == ["first", "new"]
+
+
+def test_less_important_request_does_not_supersede_queued():
+    async def scenario(telegram, edit):
+        key = ("edit", -100, 1)
+        high = asyncio.ensure_future(telegram.call(-100, edit, "high", priority=PRIORITY_HIGH, key=key))
+        await asyncio.sleep(0)
+        low = asyncio.ensure_future(telegram.call(-100, edit, "low", priority=PRIORITY_LOW, key=key))
+        return await asyncio.gather(high, low, return_exceptions=True)
+
+    (high, low), sent = _queued(scenario)
+    assert (high, low) == ("high", "low")
+    assert sent == ["first", "high", "low"]
+
+
+def test_request_kept_by_less_important_one_is_still_superseded_later():
+    async def scenario(telegram, edit):
+        key = ("edit", -100, 1)
+        high = asyncio.ensure_future(telegram.call(-100, edit, "high", priority=PRIORITY_HIGH, key=key))
+        await asyncio.sleep(0)
+        low = asyncio.ensure_future(telegram.call(-100, edit, "low", priority=PRIORITY_LOW, key=key))
+        await asyncio.sleep(0)
+        newest = asyncio.ensure_future(telegram.call(-100, edit, "newest", priority=PRIORITY_HIGH, key=key))
+        return await asyncio.gather(high, low, newest, return_exceptions=True)
+
+    (high, low, newest), sent = _queued(scenario)
+    assert isinstance(high, Superseded)
+    assert isinstance(low, Superseded)
+    assert newest == "newest"
+    assert sent == ["first", "newest"]
+
+
+def test_ready_chat_is_not_held_up_by_throttled_one():
+    async def scenario(telegram, edit):
+        queued = [asyncio.ensure_future(telegram.call(-100, edit, f"frozen{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        other = await telegram.call(-200, edit, "other")
+        for future in queued:
+            future.cancel()
+        return other
+
+    other, sent = _queued(scenario)
+    assert other == "other"
+    assert sent == ["first", "other"]
+
+
+def test_close_fails_queued_and_parked_requests():
+    async def scenario():
+        telegram = TelegramScheduler(30, 0.5, 0.5, 1)
+
+        async def edit(text):
+            if text == "parked":
+                raise TelegramRetryAfter(EditMessageText(text=text), "Too Many Requests", 30)
+            return text
+
+        parked = asyncio.ensure_future(telegram.call(-100, edit, "parked", key=("edit", -100, 1)))
+        await asyncio.sleep(0.1)
+        queued = asyncio.ensure_future(telegram.call(-200, edit, "queued"))
+        queued_after = asyncio.ensure_future(telegram.call(-200, edit, "queued after"))
+        await asyncio.sleep(0.1)
+        telegram.close()
+        results = await asyncio.gather(parked, queued, queued_after, return_exceptions=True)
+        with pytest.raises(SchedulerClosed):
+            await telegram.call(-200, edit, "late")
+        return results, telegram.depth()
+
+    (parked, queued, queued_after), depth = _run(scenario())
+    assert isinstance(parked, SchedulerClosed)
+    assert queued == "queued"
+    assert isinstance(queued_after, SchedulerClosed)
+    assert depth == 0